@@ -1,10 +1,23 @@
-import os, json, sqlite3, time, re, threading, logging, uuid, traceback
-from logging.handlers import RotatingFileHandler
+import os, sys, json, sqlite3, time, re, threading, logging, uuid, traceback, atexit, hashlib, zlib, random
+from functools import lru_cache
+from contextlib import contextmanager
+from collections import OrderedDict
+from datetime import date, datetime
 from dotenv import load_dotenv
 from flask import Flask, request, Response
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from tenacity import retry, stop_after_attempt, wait_exponential
+import syllabus_db
+import similarity
+import kvstore
+import userlocks
+import broadcast
+import matching
+import logpipe
+import metrics
+import tracing
 
 # ---- Google Gemini ----
 import google.generativeai as genai
@@ -14,33 +27,96 @@ DB_PATH = "mvp.db"
 
 # ==================== LOGGING ====================
 os.makedirs("logs", exist_ok=True)
+# File and console I/O happen on logpipe's listener thread; logs/app.log is JSON lines.
+# LOG_LEVEL defaults to INFO (DEBUG only controls Flask). Per-message lines logged with
+# extra=HOT are sampled at LOG_SAMPLE_INFO / LOG_SAMPLE_DEBUG (fraction kept, per request).
 logger = logging.getLogger("whatsapp_mvp")
-logger.setLevel(logging.DEBUG if os.environ.get("DEBUG","1") == "1" else logging.INFO)
-_formatter = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
-_file = RotatingFileHandler("logs/app.log", maxBytes=2_000_000, backupCount=3, encoding="utf-8")
-_file.setFormatter(_formatter); _file.setLevel(logging.DEBUG); logger.addHandler(_file)
-_console = logging.StreamHandler(); _console.setFormatter(_formatter); _console.setLevel(logging.DEBUG); logger.addHandler(_console)
+log_listener = logpipe.setup(logger, "logs/app.log",
+                            level=getattr(logging, os.environ.get("LOG_LEVEL", "INFO").upper(), logging.INFO),
+                            sample={logging.INFO: float(os.environ.get("LOG_SAMPLE_INFO", "1")),
+                                    logging.DEBUG: float(os.environ.get("LOG_SAMPLE_DEBUG", "0.1"))})
+
+# ==================== METRICS ====================
+# Served at /metrics (and by metrics.serve() in the Telegram process). Gauges with fn=
+# are read at scrape time, so they cost nothing between scrapes.
+COMMANDS = {"START", "QUIZ", "SUBJECT", "HELP", "PROFILE", "SKIP", "RANK", "RESET", "STATS", "DAILY"}
+inbound_total = metrics.counter("inbound_messages_total", "Inbound messages by channel and command", ["channel", "command"])
+gemini_seconds = metrics.histogram("gemini_request_seconds", "Gemini generate_content latency", ["kind"])
+gemini_errors = metrics.counter("gemini_errors_total", "Gemini requests that raised", ["kind"])
+gemini_tokens = metrics.counter("gemini_tokens_total", "Gemini tokens (estimated when usage is missing)", ["kind", "type"])
+twilio_seconds = metrics.histogram("twilio_send_seconds", "Twilio messages.create latency")
+twilio_errors = metrics.counter("twilio_send_errors_total", "Failed Twilio sends", ["kind"])
+
+def command_label(text):
+    # bounded label for inbound_messages_total: a command word, an answer letter, or text
+    word = (text or "").strip().lstrip("/").split(" ", 1)[0].upper()
+    if word in COMMANDS:
+        return word.lower()
+    if word in ("A", "B", "C", "D"):
+        return "answer"
+    return "number" if word.isdigit() else "text"
+
+def dedupe_step(sess):
+    # where the student is, for de-dup keys: the same text at the next step (the next
+    # question, or "Delhi" as city and then as state) is a new answer, not a repeat
+    return f"{sess['stage']}:{sess['q_index']}" if sess else ""
+
+def _outbox_depth():
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT status, COUNT(*) FROM outbox WHERE status IN ('queued','sending') GROUP BY status")
+    out = {(r[0],): r[1] for r in cur.fetchall()}
+    conn.close()
+    return out
+
+def _queue_depths():
+    return {("log",): log_listener.queue.qsize() if log_listener else 0,
+            ("answer_log",): len(answer_log._rows), ("delivery_log",): len(delivery_log._rows),
+            ("sessions_dirty",): len(state.sessions._dirty) if hasattr(state, "sessions") else 0}
+
+def _threads():
+    return {("jobs",): sum(th.is_alive() for th in _jobs.values()),
+            ("outbox",): sum(th.is_alive() for th in outbox._threads),
+            ("all",): threading.active_count()}
+
+def _cache_counts(field):
+    caches = {"subject_index": matching.subject_index.cache_info(), "trigrams": matching.trigrams.cache_info()}
+    out = {(name,): getattr(info, field) for name, info in caches.items()}
+    if isinstance(getattr(state, "lessons", None), LRUCache):
+        out[("lessons",)] = getattr(state.lessons, field)
+    return out
+
+metrics.gauge("outbox_messages", "Outbox rows waiting or in flight", ["status"], fn=_outbox_depth)
+metrics.gauge("queue_depth", "In-memory queues and write-behind buffers", ["queue"], fn=_queue_depths)
+metrics.gauge("background_threads", "Live background threads", ["group"], fn=_threads)
+metrics.counter("log_records_dropped_total", "Log records dropped on a full queue", fn=lambda: {(): logpipe.dropped(logger)})
+metrics.counter("cache_hits_total", "Cache hits", ["cache"], fn=lambda: _cache_counts("hits"))
+metrics.counter("cache_misses_total", "Cache misses", ["cache"], fn=lambda: _cache_counts("misses"))
 
 # ==================== DB UTIL ====================
 def get_mastered_topics(wa_id, subject_label):
+    # Titles of lessons the student scored 3/3 on, most recent first. Titles that are
+    # near-duplicates of a more recent one ("Photosynthesis" / "Photosynthesis in Plants")
+    # are folded into it.
     conn = db(); cur = conn.cursor()
-    cur.execute("SELECT title FROM lessons WHERE wa_id=? AND subject_label=?", (wa_id, subject_label))
-    lesson_titles = {r[0] for r in cur.fetchall()}
-    cur.execute("SELECT lesson_id, score, total FROM history WHERE wa_id=? AND subject=?", (wa_id, subject_label))
-    mastered = set()
+    cur.execute("""SELECT l.title FROM history h JOIN lessons l ON l.id = h.lesson_id
+                   WHERE h.wa_id=? AND h.subject=? AND h.score=3 AND h.total=3
+                   ORDER BY h.taken_at DESC""", (wa_id, subject_label))
+    mastered = {}
     for r in cur.fetchall():
-        if r[1] == 3 and r[2] == 3:
-            lid = r[0]
-            cur2 = conn.cursor()
-            cur2.execute("SELECT title FROM lessons WHERE id=?", (lid,))
-            row = cur2.fetchone()
-            if row and row[0]:
-                mastered.add(row[0])
+        if r[0]:
+            mastered.setdefault(r[0], None)
     conn.close()
-    return list(mastered)
+    return similarity.dedupe(list(mastered), TITLE_MATCH_THRESHOLD)
+
+def is_topic_mastered(wa_id, subject_label, title):
+    sk = similarity.sketch(title)
+    return any(similarity.similarity(sk, similarity.sketch(t)) >= TITLE_MATCH_THRESHOLD
+               for t in get_mastered_topics(wa_id, subject_label))
+
 def db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=metrics.TimedConnection)
     conn.row_factory = sqlite3.Row
+    conn.helper = metrics.caller()   # db_query_seconds{helper=...}
     return conn
 
 def init_db():
@@ -95,10 +171,189 @@ def init_db():
         questions_json TEXT,   -- JSON list of {q, options[4], ans, explain}
         created_at INTEGER
     )""")
+    # syllabus topics the student has scored full marks on
+    cur.execute("""CREATE TABLE IF NOT EXISTS mastered_topics (
+        wa_id TEXT,
+        board TEXT,
+        grade INTEGER,
+        subject TEXT,
+        topic TEXT,
+        mastered_at TEXT,
+        PRIMARY KEY (wa_id, board, grade, subject, topic)
+    )""")
     # backfill for older schema
     existing_cols = {r[1] for r in cur.execute("PRAGMA table_info(sessions)").fetchall()}
     if "lesson_id" not in existing_cols:
         cur.execute("ALTER TABLE sessions ADD COLUMN lesson_id INTEGER")
+    if "q_sent_at" not in existing_cols:
+        cur.execute("ALTER TABLE sessions ADD COLUMN q_sent_at REAL")  # for answer latency
+    # one session per student (the session store upserts by wa_id)
+    cur.execute("DELETE FROM sessions WHERE id NOT IN (SELECT MAX(id) FROM sessions GROUP BY wa_id)")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_wa_id ON sessions(wa_id)")
+    existing_cols = {r[1] for r in cur.execute("PRAGMA table_info(history)").fetchall()}
+    if "lesson_id" not in existing_cols:
+        cur.execute("ALTER TABLE history ADD COLUMN lesson_id INTEGER")
+    existing_cols = {r[1] for r in cur.execute("PRAGMA table_info(lessons)").fetchall()}
+    if "topic" not in existing_cols:
+        cur.execute("ALTER TABLE lessons ADD COLUMN topic TEXT")  # syllabus topic the lesson was built for
+    if "body_hash" not in existing_cols:
+        cur.execute("ALTER TABLE lessons ADD COLUMN body_hash TEXT")  # lesson_bodies row; replaces intro/questions_json
+    # lesson intro + questions, stored once per distinct content (zlib-compressed JSON)
+    cur.execute("""CREATE TABLE IF NOT EXISTS lesson_bodies (
+        hash TEXT PRIMARY KEY,   -- sha1 of the uncompressed JSON
+        body BLOB
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_lessons_user_subject ON lessons (wa_id, subject_label)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_history_user_subject ON history (wa_id, subject)")
+    # Gemini token usage per call
+    cur.execute("""CREATE TABLE IF NOT EXISTS token_usage (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        wa_id TEXT,
+        subject TEXT,
+        kind TEXT,              -- 'lesson' | 'translate'
+        prompt_tokens INTEGER,
+        response_tokens INTEGER,
+        total_tokens INTEGER,
+        estimated INTEGER DEFAULT 0,  -- 1 if the SDK gave no usage metadata
+        created_at INTEGER
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_user ON token_usage (wa_id, subject)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_time ON token_usage (created_at)")
+    # leaderboards: points per (scope, period, student), kept up to date by record_history()
+    cur.execute("""CREATE TABLE IF NOT EXISTS leaderboard (
+        scope TEXT,             -- 'class:CBSE|8|Mathematics' | 'city:pune' | 'state:Maharashtra'
+        period TEXT,            -- 'all' | 'day:2025-01-31' | 'week:2025-W05'
+        wa_id TEXT,
+        points INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER,
+        PRIMARY KEY (scope, period, wa_id)
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_leaderboard_top ON leaderboard (scope, period, points DESC, updated_at)")
+    # how many students sit at each points value; rank = 1 + students with more points
+    cur.execute("""CREATE TABLE IF NOT EXISTS leaderboard_hist (
+        scope TEXT,
+        period TEXT,
+        points INTEGER,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (scope, period, points)
+    )""")
+    # activity rollups (see ActivityTracker)
+    cur.execute("""CREATE TABLE IF NOT EXISTS activity_users (
+        channel TEXT,
+        wa_id TEXT,
+        last_day TEXT,          -- IST date of the student's latest message
+        PRIMARY KEY (channel, wa_id)
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS activity_last_day (
+        channel TEXT,
+        day TEXT,
+        n INTEGER NOT NULL DEFAULT 0,   -- students whose latest active day is `day`
+        PRIMARY KEY (channel, day)
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS activity_daily (
+        channel TEXT,
+        day TEXT,
+        active INTEGER NOT NULL DEFAULT 0,    -- distinct students that day
+        messages INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (channel, day)
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS activity_channels (
+        channel TEXT PRIMARY KEY,
+        total INTEGER NOT NULL DEFAULT 0
+    )""")
+    # one row per answered quiz question (append-only, written in batches)
+    cur.execute("""CREATE TABLE IF NOT EXISTS answer_log (
+        id INTEGER PRIMARY KEY,
+        session_id INTEGER,     -- one quiz attempt
+        wa_id TEXT,
+        lesson_id INTEGER,
+        q_index INTEGER,
+        chosen TEXT,
+        correct INTEGER,
+        latency_ms INTEGER,     -- since the question was sent
+        at INTEGER
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_answer_log_lesson ON answer_log(lesson_id, q_index)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_answer_log_user ON answer_log(wa_id, id)")
+    # per-question difficulty/discrimination, recomputed by compute_item_stats()
+    cur.execute("""CREATE TABLE IF NOT EXISTS item_stats (
+        lesson_id INTEGER,
+        q_index INTEGER,
+        n INTEGER,
+        p_correct REAL,         -- difficulty: share of correct answers
+        discrimination REAL,    -- correlation with the rest of the quiz score
+        median_ms INTEGER,
+        flagged INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER,
+        PRIMARY KEY (lesson_id, q_index)
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS item_stats_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_answer_id INTEGER NOT NULL DEFAULT 0
+    )""")
+    # outbound WhatsApp messages, delivered by OutboxSender
+    cur.execute("""CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        to_addr TEXT,
+        body TEXT,
+        status TEXT,            -- queued, sending, then Twilio's: sent, delivered, read, failed, undelivered
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL,
+        sid TEXT,
+        last_error TEXT,
+        created_at REAL,
+        sent_at REAL,
+        updated_at REAL,
+        trace TEXT              -- tracing.ref() of the enqueuing span, so the send joins its trace
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_sid ON outbox(sid)")
+    # Twilio status callbacks, append-only (written in batches by delivery_log)
+    cur.execute("""CREATE TABLE IF NOT EXISTS delivery_events (
+        id INTEGER PRIMARY KEY,
+        sid TEXT,
+        to_addr TEXT,
+        status TEXT,
+        error_code TEXT,
+        at REAL
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_delivery_sid ON delivery_events(sid)")
+    # the sender number's rate limit, shared by every process running an OutboxSender:
+    # the theoretical arrival time of the next send (GCRA)
+    cur.execute("CREATE TABLE IF NOT EXISTS outbox_rate (id INTEGER PRIMARY KEY CHECK (id = 1), next_at REAL)")
+    cur.execute("INSERT OR IGNORE INTO outbox_rate (id, next_at) VALUES (1, 0)")
+    # status callbacks that beat messages.create() returning the sid; applied by
+    # OutboxSender once it records the sid
+    cur.execute("""CREATE TABLE IF NOT EXISTS early_status (
+        sid TEXT PRIMARY KEY,
+        status TEXT,
+        rank INTEGER,
+        error TEXT,
+        at REAL
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_delivery_to ON delivery_events(to_addr, at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_sent ON outbox(sent_at)")
+    # per-subject level (shared by WhatsApp and Telegram)
+    cur.execute("""CREATE TABLE IF NOT EXISTS user_subjects (
+        wa_id TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        level INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (wa_id, subject)
+    )""")
+    # per-subject progress aggregates, maintained by record_history()
+    cur.execute("""CREATE TABLE IF NOT EXISTS subject_stats (
+        wa_id TEXT,
+        subject TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        questions INTEGER NOT NULL DEFAULT 0,
+        correct INTEGER NOT NULL DEFAULT 0,
+        levels_json TEXT,       -- {"<level>": [correct, questions, attempts], ...}
+        trend_json TEXT,        -- {"<IST day>": [correct, questions], ...} last 7 days
+        streak INTEGER NOT NULL DEFAULT 0,       -- consecutive full-score quizzes
+        best_streak INTEGER NOT NULL DEFAULT 0,
+        last_taken_at INTEGER,
+        PRIMARY KEY (wa_id, subject)
+    )""")
     conn.commit(); conn.close()
 
 def get_user(wa_id):
@@ -117,61 +372,898 @@ def upsert_user(wa_id, **fields):
         cur.execute(f"UPDATE users SET {k}=? WHERE wa_id=?", (v, wa_id))
     conn.commit(); conn.close()
 
+class LRUCache:
+    # Size-bounded, thread-safe LRU with hit/miss counters. The lock is only held for
+    # dict operations, so it is also fine to call from the Telegram event loop.
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "hit_rate": self.hits / total if total else None}
+
+class SessionStore:
+    # Quiz/onboarding sessions live in memory; changes are written behind to the
+    # sessions table by flush() (every second, and at exit) in one transaction, so a
+    # crash loses at most the last second of progress. A student's session is read
+    # from SQLite on first access after a restart.
+    COLUMNS = ("id", "wa_id", "stage", "q_index", "score", "lesson_id", "created_at", "q_sent_at")
+    # ids only grow (see new_id), so an older snapshot never overwrites a newer row
+    # that complete_quiz() wrote in its own transaction
+    UPSERT_SQL = f"""INSERT INTO sessions ({", ".join(COLUMNS)}) VALUES ({", ".join("?" * len(COLUMNS))})
+                     ON CONFLICT(wa_id) DO UPDATE SET {", ".join(f"{k}=excluded.{k}" for k in COLUMNS if k != "wa_id")}
+                     WHERE excluded.id >= sessions.id"""
+
+    def __init__(self, max_clean=20000):
+        self.max_clean = max_clean
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()   # wa_id -> dict, or None for "no session"
+        self._dirty = set()
+        self._last_id = 0
+
+    def _load(self, wa_id):
+        with self._lock:
+            if wa_id in self._sessions:
+                self._sessions.move_to_end(wa_id)
+                return
+        conn = db(); cur = conn.cursor()
+        cur.execute("SELECT * FROM sessions WHERE wa_id=?", (wa_id,))
+        row = cur.fetchone(); conn.close()
+        with self._lock:
+            if wa_id not in self._sessions:  # a write may have raced the read
+                self._sessions[wa_id] = {k: row[k] for k in self.COLUMNS} if row else None
+            self._evict()
+
+    def _evict(self):
+        # drops least recently used sessions that are already persisted
+        extra = len(self._sessions) - self.max_clean
+        for wa_id in list(self._sessions):
+            if extra <= 0:
+                break
+            if wa_id not in self._dirty:
+                del self._sessions[wa_id]; extra -= 1
+
+    def get(self, wa_id):
+        self._load(wa_id)
+        with self._lock:
+            s = self._sessions.get(wa_id)
+            return dict(s) if s else None
+
+    ID_EPOCH_MS = 1_704_067_200_000   # 2024-01-01
+
+    def new_id(self):
+        # (ms since ID_EPOCH_MS) << 22 | pid: increasing, unique across the processes
+        # sharing mvp.db (Flask and Telegram each allocate their own), and no round trip
+        # to the DB. pid_max is at most 2**22, and the result stays within 63 bits.
+        with self._lock:
+            self._last_id = max(self._last_id + 1, int(time.time() * 1000) - self.ID_EPOCH_MS)
+            return self._last_id << 22 | os.getpid()
+
+    def set(self, wa_id, session, dirty=True):
+        # dirty=False: the caller already wrote this session to the sessions table
+        with self._lock:
+            self._sessions[wa_id] = dict(session)
+            self._sessions.move_to_end(wa_id)
+            if dirty:
+                self._dirty.add(wa_id)
+            else:
+                self._dirty.discard(wa_id)
+            self._evict()
+
+    def update(self, wa_id, fields):
+        self._load(wa_id)
+        with self._lock:
+            s = self._sessions.get(wa_id)
+            if s is None:
+                return False
+            s.update(fields)
+            self._dirty.add(wa_id)
+            return True
+
+    def flush(self):
+        with self._lock:
+            rows = [tuple(self._sessions[w][k] for k in self.COLUMNS) for w in self._dirty if self._sessions.get(w)]
+            self._dirty = set()
+        if not rows:
+            return 0
+        conn = db()
+        try:
+            conn.executemany(self.UPSERT_SQL, rows)
+            conn.commit()
+        except sqlite3.Error:
+            with self._lock:  # retry on the next flush
+                self._dirty.update(r[1] for r in rows)
+            raise
+        finally:
+            conn.close()
+        return len(rows)
+
+class LocalBackend:
+    # Single-process state: sessions written behind to SQLite, parsed lessons in an
+    # LRU and striped per-student thread locks. See kvstore.RedisBackend for the
+    # shared variant used when running several workers on one host.
+    LOCK_STRIPES = 256
+
+    def __init__(self):
+        self.sessions = SessionStore()
+        self.lessons = LRUCache(int(os.environ.get("LESSON_CACHE_SIZE", "512")))
+        self._locks = [threading.RLock() for _ in range(self.LOCK_STRIPES)]
+
+    def new_session_id(self):
+        return self.sessions.new_id()
+
+    def get_session(self, wa_id):
+        return self.sessions.get(wa_id)
+
+    def set_session(self, wa_id, session, persisted=False):
+        self.sessions.set(wa_id, session, dirty=not persisted)
+
+    def update_session(self, wa_id, fields):
+        return self.sessions.update(wa_id, fields)
+
+    def flush(self):
+        return self.sessions.flush()
+
+    def get_lesson(self, lesson_id):
+        return self.lessons.get(lesson_id)
+
+    def put_lesson(self, lesson_id, lesson):
+        self.lessons.put(lesson_id, lesson)
+
+    def invalidate_lesson(self, lesson_id):
+        self.lessons.invalidate(lesson_id)
+
+    @contextmanager
+    def lock(self, wa_id, timeout=5.0):
+        lk = self._locks[zlib.crc32((wa_id or "").encode("utf-8")) % self.LOCK_STRIPES]
+        if not lk.acquire(timeout=timeout):
+            raise TimeoutError(f"lock busy for {wa_id}")
+        try:
+            yield
+        finally:
+            lk.release()
+
+    def stats(self):
+        return dict(self.lessons.stats(), backend="local")
+
+def make_state_backend():
+    # STATE_BACKEND=redis with STATE_REDIS_URLS=redis://h1:6379/0,redis://h2:6379/0
+    if os.environ.get("STATE_BACKEND", "local").lower() == "redis":
+        urls = [u.strip() for u in os.environ.get("STATE_REDIS_URLS", "redis://127.0.0.1:6379/0").split(",") if u.strip()]
+        logger.info(f"[STATE] redis backend with {len(urls)} shard(s)")
+        return kvstore.RedisBackend(urls)
+    return LocalBackend()
+
+state = LocalBackend()
+_state_configured = False   # create_app() picks the configured backend once per process
+
+def new_session(wa_id, stage, q_index=0, score=0, lesson_id=None):
+    return {"id": state.new_session_id(), "wa_id": wa_id, "stage": stage, "q_index": q_index,
+            "score": score, "lesson_id": lesson_id, "created_at": int(time.time()), "q_sent_at": None}
+
 def set_session(wa_id, stage, q_index=0, score=0, lesson_id=None):
-    conn = db(); cur = conn.cursor()
-    cur.execute("DELETE FROM sessions WHERE wa_id=?", (wa_id,))
-    cur.execute(
-        "INSERT INTO sessions (wa_id, stage, q_index, score, lesson_id, created_at) VALUES (?,?,?,?,?,?)",
-        (wa_id, stage, q_index, score, lesson_id, int(time.time()))
-    )
-    conn.commit(); conn.close()
+    state.set_session(wa_id, new_session(wa_id, stage, q_index, score, lesson_id))
 
 def get_session(wa_id):
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM sessions WHERE wa_id=?", (wa_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return state.get_session(wa_id)
 
 def update_session(wa_id, **fields):
+    state.update_session(wa_id, fields)
+
+HISTORY_SQL = "INSERT INTO history (wa_id, subject, level, score, total, taken_at, lesson_id) VALUES (?,?,?,?,?,?,?)"
+MASTERED_SQL = """INSERT OR REPLACE INTO mastered_topics (wa_id, board, grade, subject, topic, mastered_at)
+                  VALUES (?,?,?,?,?,datetime('now'))"""
+SUBJECT_LEVEL_SQL = """INSERT INTO user_subjects (wa_id, subject, level) VALUES (?,?,?)
+                       ON CONFLICT(wa_id, subject) DO UPDATE SET level=excluded.level"""
+
+def _record_history(cur, wa_id, subject_label, level, score, total, lesson_id, now):
+    cur.execute(HISTORY_SQL, (wa_id, subject_label, level, score, total, now, lesson_id))
+    cur.execute("SELECT board, grade, city, state FROM users WHERE wa_id=?", (wa_id,))
+    profile = cur.fetchone()
+    bump_leaderboards(cur, wa_id, profile, subject_label, score, now)
+    bump_subject_stats(cur, wa_id, subject_label, level, score, total, now)
+    return profile
+
+def record_history(wa_id, subject_label, level, score, total, lesson_id=None):
     conn = db(); cur = conn.cursor()
-    sets = ", ".join([f"{k}=?" for k in fields.keys()])
-    values = list(fields.values()) + [wa_id]
-    cur.execute(f"UPDATE sessions SET {sets} WHERE wa_id=?", values)
+    _record_history(cur, wa_id, subject_label, level, score, total, lesson_id, int(time.time()))
     conn.commit(); conn.close()
 
-def record_history(wa_id, subject_label, level, score, total):
+def mark_topic_mastered(wa_id, board, grade, subject_label, topic):
     conn = db(); cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO history (wa_id, subject, level, score, total, taken_at) VALUES (?,?,?,?,?,?)",
-        (wa_id, subject_label, level, score, total, int(time.time()))
-    )
+    cur.execute(MASTERED_SQL, (wa_id, board, grade, subject_label, topic))
     conn.commit(); conn.close()
 
-def save_lesson(wa_id, board, grade, subject_label, level, title, intro, questions):
+def complete_quiz(wa_id, lesson, score, total):
+    # Every write of a finished quiz in one transaction: history, leaderboards, subject
+    # stats, mastered topic, the new level (users + user_subjects), the streak and the
+    # session reset to idle, so a crash cannot leave the quiz open to be scored again.
+    # Returns (new_level, new_streak).
+    now = int(time.time())
+    subject_label = lesson["subject_label"]
+    sess = new_session(wa_id, "idle")
+    conn = db(); cur = conn.cursor()
+    try:
+        profile = _record_history(cur, wa_id, subject_label, lesson["level"], score, total, lesson["id"], now)
+        if score == total and lesson.get("topic"):
+            cur.execute(MASTERED_SQL, (wa_id, syllabus_board(lesson["board"], profile["state"] if profile else None),
+                                       lesson["grade"], subject_label, lesson["topic"]))
+        cur.execute("SELECT * FROM subject_stats WHERE wa_id=? AND subject=?", (wa_id, subject_label))
+        stats = _stats_dict(cur.fetchone(), now)
+        new_level = adapt_level(stats, lesson["level"], score, total)
+        cur.execute("UPDATE users SET level=?, streak=? WHERE wa_id=?", (new_level, stats["streak"], wa_id))
+        cur.execute(SUBJECT_LEVEL_SQL, (wa_id, subject_label, new_level))
+        cur.execute(SessionStore.UPSERT_SQL, tuple(sess[k] for k in SessionStore.COLUMNS))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    state.set_session(wa_id, sess, persisted=True)
+    return new_level, stats["streak"]
+
+def encode_lesson_body(intro, questions):
+    raw = json.dumps({"intro": intro, "questions": questions}, ensure_ascii=False,
+                     sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest(), zlib.compress(raw, 9)
+
+def store_lesson_body(cur, intro, questions):
+    h, blob = encode_lesson_body(intro, questions)
+    cur.execute("INSERT OR IGNORE INTO lesson_bodies (hash, body) VALUES (?,?)", (h, blob))
+    return h
+
+class FrozenDict(dict):
+    # read-only dict for shared lesson bodies; still a dict, so json.dumps and the
+    # Redis backend serialize it as before
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("lesson bodies are shared between students; copy before changing")
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _readonly
+
+def freeze(value):
+    # JSON value -> the same value with lists as tuples and dicts as FrozenDict
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+@lru_cache(maxsize=1024)
+def _read_lesson_body(body_hash):
     conn = db(); cur = conn.cursor()
-    cur.execute("""INSERT INTO lessons (wa_id, board, grade, subject_label, level, title, intro_json, questions_json, created_at)
+    cur.execute("SELECT body FROM lesson_bodies WHERE hash=?", (body_hash,))
+    row = cur.fetchone(); conn.close()
+    if not row:
+        raise KeyError(body_hash)   # not cached, so a body stored later is still found
+    d = json.loads(zlib.decompress(row[0]))
+    return freeze(d["intro"]), freeze(d["questions"])
+
+def lesson_body(body_hash):
+    # (intro, questions) of a stored body, or ((), ()) if there is none.
+    # Bodies are immutable (keyed by content hash), so caching them is always safe.
+    # Not a second copy of state.lessons: a parsed lesson there holds the very intro /
+    # questions objects returned here. It earns its place because one body backs many
+    # lessons (a broadcast gives a whole cohort the same one), which then share one
+    # copy in memory, and the by-hash readers (broadcast sends, similarity loads,
+    # recent_trouble_concepts) skip the decompress. With STATE_BACKEND=redis it is
+    # the only in-process lesson cache. Being shared, they come back as tuples and
+    # FrozenDicts, which raise on any attempt to change them.
+    try:
+        return _read_lesson_body(body_hash)
+    except KeyError:
+        return (), ()
+
+def lesson_content(row):
+    # (intro, questions) of a lessons row, from lesson_bodies or the legacy JSON columns
+    if row["body_hash"]:
+        return lesson_body(row["body_hash"])
+    return json.loads(row["intro_json"] or "[]"), json.loads(row["questions_json"] or "[]")
+
+@tracing.traced("save_lesson")
+def save_lesson(wa_id, board, grade, subject_label, level, title, intro, questions, topic=None):
+    conn = db(); cur = conn.cursor()
+    body_hash = store_lesson_body(cur, intro, questions)
+    cur.execute("""INSERT INTO lessons (wa_id, board, grade, subject_label, level, title, body_hash, created_at, topic)
                    VALUES (?,?,?,?,?,?,?,?,?)""",
-                (wa_id, board, grade, subject_label, level, title, json.dumps(intro), json.dumps(questions), int(time.time())))
+                (wa_id, board, grade, subject_label, level, title, body_hash, int(time.time()), topic))
     lesson_id = cur.lastrowid
     conn.commit(); conn.close()
+    state.put_lesson(lesson_id, {
+        "id": lesson_id, "title": title, "intro": intro, "questions": questions, "subject_label": subject_label,
+        "level": level, "board": board, "grade": grade, "topic": topic
+    })
+    lesson_similarity.add((wa_id, subject_label), lesson_id, lesson_text(title, intro))
     return lesson_id
 
+def invalidate_lesson(lesson_id):
+    # call after changing a lessons row in place
+    state.invalidate_lesson(lesson_id)
+
+# ==================== LESSON SIMILARITY ====================
+# A generated lesson whose title + intro is at least this similar (estimated Jaccard over
+# character shingles) to one the student already has is regenerated.
+DUPLICATE_THRESHOLD = float(os.environ.get("LESSON_DUPLICATE_THRESHOLD", "0.6"))
+DUPLICATE_RETRIES = 1
+TITLE_MATCH_THRESHOLD = 0.5
+
+def lesson_text(title, intro):
+    return " ".join([title or ""] + [str(x) for x in (intro or [])])
+
+def _load_lesson_texts(key):
+    wa_id, subject_label = key
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT id, title, intro_json, questions_json, body_hash FROM lessons WHERE wa_id=? AND subject_label=?",
+                (wa_id, subject_label))
+    rows = [(r["id"], lesson_text(r["title"], lesson_content(r)[0])) for r in cur.fetchall()]
+    conn.close()
+    return rows
+
+lesson_similarity = similarity.SimilarityIndex(_load_lesson_texts)
+
+def similar_lesson(wa_id, subject_label, title, intro):
+    # (lesson_id, score) of the closest earlier lesson for this student and subject
+    return lesson_similarity.nearest((wa_id, subject_label), lesson_text(title, intro))
+
 def load_lesson(lesson_id):
+    # parsed lessons are cached in the state backend (their bodies come from
+    # lesson_body(), see there); callers must not mutate them
+    lesson = state.get_lesson(lesson_id)
+    if lesson is not None:
+        return lesson
     conn = db(); cur = conn.cursor()
     cur.execute("SELECT * FROM lessons WHERE id=?", (lesson_id,))
     row = cur.fetchone()
     conn.close()
     if not row: return None
-    return {
+    intro, questions = lesson_content(row)
+    lesson = {
         "id": row["id"],
         "title": row["title"],
-        "intro": json.loads(row["intro_json"] or "[]"),
-        "questions": json.loads(row["questions_json"] or "[]"),
+        "intro": intro,
+        "questions": questions,
         "subject_label": row["subject_label"],
-        "level": row["level"]
+        "level": row["level"],
+        "board": row["board"],
+        "grade": row["grade"],
+        "topic": row["topic"]
+    }
+    state.put_lesson(lesson_id, lesson)
+    return lesson
+
+# ==================== LEADERBOARD ====================
+IST_OFFSET = 5 * 3600 + 1800  # day/week windows follow Indian time
+LEADERBOARD_KEEP_DAYS = 2
+LEADERBOARD_KEEP_WEEKS = 2
+
+def leaderboard_periods(ts):
+    d = time.gmtime(ts + IST_OFFSET)
+    day = time.strftime("%Y-%m-%d", d)
+    iso = date(d.tm_year, d.tm_mon, d.tm_mday).isocalendar()
+    return {"all": "all", "day": f"day:{day}", "week": f"week:{iso[0]}-W{iso[1]:02d}"}
+
+def leaderboard_scopes(profile, subject_label):
+    scopes = {}
+    if profile is None:
+        return scopes
+    if profile["board"] and profile["grade"] and subject_label:
+        scopes["class"] = f"class:{profile['board'].strip().upper()}|{profile['grade']}|{subject_label}"
+    if profile["city"]:
+        scopes["city"] = f"city:{' '.join(profile['city'].split()).casefold()}"
+    if profile["state"]:
+        scopes["state"] = f"state:{profile['state'].strip()}"
+    return scopes
+
+def bump_leaderboards(cur, wa_id, profile, subject_label, points, now):
+    # Runs inside the caller's transaction: moves the student from their old points
+    # bucket to the new one for every scope/period they belong to.
+    for scope in leaderboard_scopes(profile, subject_label).values():
+        for period in leaderboard_periods(now).values():
+            cur.execute("SELECT points FROM leaderboard WHERE scope=? AND period=? AND wa_id=?", (scope, period, wa_id))
+            row = cur.fetchone()
+            old = row[0] if row else None
+            new = (old or 0) + points
+            cur.execute("""INSERT INTO leaderboard (scope, period, wa_id, points, updated_at) VALUES (?,?,?,?,?)
+                           ON CONFLICT(scope, period, wa_id) DO UPDATE SET points=excluded.points, updated_at=excluded.updated_at""",
+                        (scope, period, wa_id, new, now))
+            if old is not None:
+                cur.execute("UPDATE leaderboard_hist SET n=n-1 WHERE scope=? AND period=? AND points=?", (scope, period, old))
+            cur.execute("""INSERT INTO leaderboard_hist (scope, period, points, n) VALUES (?,?,?,1)
+                           ON CONFLICT(scope, period, points) DO UPDATE SET n=n+1""", (scope, period, new))
+
+def leaderboard_top(scope, period, n=3):
+    conn = db(); cur = conn.cursor()
+    cur.execute("""SELECT l.wa_id, l.points, u.first_name, u.last_name FROM leaderboard l
+                   LEFT JOIN users u ON u.wa_id = l.wa_id
+                   WHERE l.scope=? AND l.period=? ORDER BY l.points DESC, l.updated_at LIMIT ?""", (scope, period, n))
+    rows = [dict(r) for r in cur.fetchall()]
+    conn.close()
+    return rows
+
+def leaderboard_rank(scope, period, wa_id):
+    # (rank, points) or None; ties share a rank
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT points FROM leaderboard WHERE scope=? AND period=? AND wa_id=?", (scope, period, wa_id))
+    row = cur.fetchone()
+    if not row:
+        conn.close(); return None
+    cur.execute("SELECT COALESCE(SUM(n), 0) FROM leaderboard_hist WHERE scope=? AND period=? AND points>?",
+                (scope, period, row[0]))
+    ahead = cur.fetchone()[0]
+    conn.close()
+    return ahead + 1, row[0]
+
+def leaderboard_view(wa_id, window="week", n=3):
+    # Top-n of the student's class board plus their rank in class/city/state for `window`
+    user = get_user(wa_id)
+    if not user:
+        return None
+    period = leaderboard_periods(time.time())[window]
+    scopes = leaderboard_scopes(user, user["subject"])
+    view = {"subject": user["subject"], "top": [], "ranks": {}}
+    if "class" in scopes:
+        view["top"] = leaderboard_top(scopes["class"], period, n)
+    for name, scope in scopes.items():
+        r = leaderboard_rank(scope, period, wa_id)
+        if r:
+            view["ranks"][name] = r
+    return view
+
+def display_name(row):
+    first = (row.get("first_name") or "").strip() or "Student"
+    last = (row.get("last_name") or "").strip()
+    return f"{first} {last[:1]}." if last else first
+
+def rollover_leaderboards(now=None):
+    # Day/week keys roll over by themselves; this drops windows nobody reads any more.
+    now = now or time.time()
+    day_cut = leaderboard_periods(now - LEADERBOARD_KEEP_DAYS * 86400)["day"]
+    week_cut = leaderboard_periods(now - LEADERBOARD_KEEP_WEEKS * 7 * 86400)["week"]
+    conn = db(); cur = conn.cursor()
+    for table in ("leaderboard", "leaderboard_hist"):
+        cur.execute(f"DELETE FROM {table} WHERE period LIKE 'day:%' AND period < ?", (day_cut,))
+        cur.execute(f"DELETE FROM {table} WHERE period LIKE 'week:%' AND period < ?", (week_cut,))
+    cur.execute("DELETE FROM leaderboard_hist WHERE n <= 0")
+    conn.commit(); conn.close()
+    logger.info(f"[RANK] rollover done; kept >= {day_cut}, >= {week_cut}")
+
+def rebuild_leaderboards():
+    # One-off backfill from history (all-time and the current windows)
+    conn = db(); cur = conn.cursor()
+    cur.execute("DELETE FROM leaderboard"); cur.execute("DELETE FROM leaderboard_hist")
+    keep = leaderboard_periods(time.time())
+    cur.execute("""SELECT h.wa_id, h.subject, h.score, h.taken_at, u.board, u.grade, u.city, u.state
+                   FROM history h LEFT JOIN users u ON u.wa_id = h.wa_id ORDER BY h.id""")
+    rows = cur.fetchall()
+    for r in rows:
+        ts = r["taken_at"] or 0
+        periods = leaderboard_periods(ts)
+        bump_leaderboards(cur, r["wa_id"], r, r["subject"], r["score"] or 0, ts)
+        for key in ("day", "week"):
+            if periods[key] != keep[key]:
+                for table in ("leaderboard", "leaderboard_hist"):
+                    cur.execute(f"DELETE FROM {table} WHERE period=?", (periods[key],))
+    conn.commit(); conn.close()
+    return len(rows)
+
+# ==================== PROGRESS AGGREGATES ====================
+TREND_DAYS = 7
+
+def bump_subject_stats(cur, wa_id, subject_label, level, score, total, now):
+    # Runs inside the caller's transaction
+    cur.execute("SELECT * FROM subject_stats WHERE wa_id=? AND subject=?", (wa_id, subject_label))
+    row = cur.fetchone()
+    levels = json.loads(row["levels_json"] or "{}") if row else {}
+    trend = json.loads(row["trend_json"] or "{}") if row else {}
+    lv = levels.setdefault(str(level or 1), [0, 0, 0])
+    lv[0] += score; lv[1] += total; lv[2] += 1
+    day = ist_day(now)
+    td = trend.setdefault(day, [0, 0])
+    td[0] += score; td[1] += total
+    oldest = ist_day(now - (TREND_DAYS - 1) * 86400)
+    trend = {d: v for d, v in trend.items() if d >= oldest}
+    streak = ((row["streak"] if row else 0) + 1) if total and score == total else 0
+    best = max(streak, row["best_streak"] if row else 0)
+    cur.execute("""INSERT INTO subject_stats (wa_id, subject, attempts, questions, correct, levels_json, trend_json,
+                                              streak, best_streak, last_taken_at)
+                   VALUES (?,?,1,?,?,?,?,?,?,?)
+                   ON CONFLICT(wa_id, subject) DO UPDATE SET
+                       attempts=attempts+1, questions=questions+excluded.questions, correct=correct+excluded.correct,
+                       levels_json=excluded.levels_json, trend_json=excluded.trend_json,
+                       streak=excluded.streak, best_streak=excluded.best_streak, last_taken_at=excluded.last_taken_at""",
+                (wa_id, subject_label, total, score, json.dumps(levels), json.dumps(trend), streak, best, now))
+
+def backfill_subject_stats():
+    # Replays history once into subject_stats (for databases created before it existed)
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT 1 FROM subject_stats LIMIT 1")
+    if cur.fetchone():
+        conn.close(); return 0
+    cur.execute("SELECT wa_id, subject, level, score, total, taken_at FROM history ORDER BY taken_at, id")
+    rows = cur.fetchall()
+    for r in rows:
+        bump_subject_stats(cur, r["wa_id"], r["subject"], r["level"], r["score"], r["total"], r["taken_at"] or time.time())
+    conn.commit(); conn.close()
+    if rows:
+        logger.info(f"[STATS] backfilled subject_stats from {len(rows)} history rows")
+    return len(rows)
+
+def _stats_dict(row, now):
+    levels = json.loads(row["levels_json"] or "{}")
+    oldest = ist_day(now - (TREND_DAYS - 1) * 86400)
+    recent = [v for d, v in json.loads(row["trend_json"] or "{}").items() if d >= oldest]
+    c7, q7 = sum(v[0] for v in recent), sum(v[1] for v in recent)
+    return {
+        "subject": row["subject"],
+        "attempts": row["attempts"],
+        "questions": row["questions"],
+        "correct": row["correct"],
+        "accuracy": row["correct"] / row["questions"] if row["questions"] else None,
+        "levels": {int(k): {"correct": v[0], "questions": v[1], "attempts": v[2],
+                            "accuracy": v[0] / v[1] if v[1] else None} for k, v in levels.items()},
+        "accuracy_7d": c7 / q7 if q7 else None,
+        "questions_7d": q7,
+        "streak": row["streak"],
+        "best_streak": row["best_streak"],
+        "last_taken_at": row["last_taken_at"],
     }
 
+def get_subject_stats(wa_id, subject_label):
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT * FROM subject_stats WHERE wa_id=? AND subject=?", (wa_id, subject_label))
+    row = cur.fetchone(); conn.close()
+    return _stats_dict(row, time.time()) if row else None
+
+def all_subject_stats(wa_id):
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT * FROM subject_stats WHERE wa_id=? ORDER BY last_taken_at DESC", (wa_id,))
+    rows = cur.fetchall(); conn.close()
+    now = time.time()
+    return [_stats_dict(r, now) for r in rows]
+
+def adapt_level(stats, level, score, total):
+    # >= 2/3 on this quiz moves up a level. A weak quiz only moves down once the
+    # student's overall accuracy at this level is below half over 2+ quizzes, so one
+    # unlucky quiz does not undo a level.
+    level = level or 1
+    if score >= (total * 2) // 3:
+        return level + 1
+    at_level = (stats or {}).get("levels", {}).get(level)
+    if at_level and at_level["attempts"] >= 2 and (at_level["accuracy"] or 0) < 0.5:
+        return max(1, level - 1)
+    return level
+
+def get_subject_level(wa_id, subject_label):
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT level FROM user_subjects WHERE wa_id=? AND subject=?", (wa_id, subject_label))
+    row = cur.fetchone(); conn.close()
+    return row["level"] if row else 1
+
+def set_subject_level(wa_id, subject_label, level):
+    conn = db(); cur = conn.cursor()
+    cur.execute(SUBJECT_LEVEL_SQL, (wa_id, subject_label, level))
+    conn.commit(); conn.close()
+
+def trend_arrow(s):
+    if s["accuracy_7d"] is None or s["accuracy"] is None:
+        return ""
+    diff = s["accuracy_7d"] - s["accuracy"]
+    return "↑" if diff > 0.05 else ("↓" if diff < -0.05 else "→")
+
+def pct(x):
+    return f"{round(100 * x)}%" if x is not None else "–"
+
+# ==================== ACTIVITY ====================
+def ist_day(ts):
+    return time.strftime("%Y-%m-%d", time.gmtime(ts + IST_OFFSET))
+
+def channel_of(wa_id):
+    return wa_id.split(":", 1)[0] if wa_id and ":" in wa_id else "other"
+
+class ActivityTracker:
+    # Counts active students per channel without scanning users.
+    # touch() is called for every inbound message and only updates memory: an online
+    # sliding window plus a batch of pending (channel, wa_id) -> last timestamp. flush()
+    # runs once a minute and folds the batch into the rollup tables, where each student
+    # is filed under their latest active day, so DAU/WAU/MAU are sums over 1/7/30 rows.
+
+    def __init__(self, online_window=600):
+        self.online_window = online_window
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._messages = {}
+        self._online = {}   # channel -> OrderedDict(wa_id -> last ts), oldest first
+
+    def touch(self, wa_id, ts=None):
+        if not wa_id:
+            return
+        ts = ts or time.time()
+        ch = channel_of(wa_id)
+        with self._lock:
+            self._pending[(ch, wa_id)] = ts
+            key = (ch, ist_day(ts))
+            self._messages[key] = self._messages.get(key, 0) + 1
+            win = self._online.setdefault(ch, OrderedDict())
+            win[wa_id] = ts
+            win.move_to_end(wa_id)
+
+    def online(self, channel, now=None):
+        cutoff = (now or time.time()) - self.online_window
+        with self._lock:
+            win = self._online.get(channel)
+            if not win:
+                return 0
+            while win and next(iter(win.values())) < cutoff:
+                win.popitem(last=False)
+            return len(win)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            messages, self._messages = self._messages, {}
+        if not pending and not messages:
+            return 0
+        conn = db(); cur = conn.cursor()
+        try:
+            for (ch, wa_id), ts in pending.items():
+                day = ist_day(ts)
+                cur.execute("SELECT last_day FROM activity_users WHERE channel=? AND wa_id=?", (ch, wa_id))
+                row = cur.fetchone()
+                last = row[0] if row else None
+                if last is not None and last >= day:
+                    continue
+                cur.execute("""INSERT INTO activity_users (channel, wa_id, last_day) VALUES (?,?,?)
+                               ON CONFLICT(channel, wa_id) DO UPDATE SET last_day=excluded.last_day""", (ch, wa_id, day))
+                if last is None:
+                    cur.execute("""INSERT INTO activity_channels (channel, total) VALUES (?,1)
+                                   ON CONFLICT(channel) DO UPDATE SET total=total+1""", (ch,))
+                else:
+                    cur.execute("UPDATE activity_last_day SET n=n-1 WHERE channel=? AND day=?", (ch, last))
+                cur.execute("""INSERT INTO activity_last_day (channel, day, n) VALUES (?,?,1)
+                               ON CONFLICT(channel, day) DO UPDATE SET n=n+1""", (ch, day))
+                cur.execute("""INSERT INTO activity_daily (channel, day, active) VALUES (?,?,1)
+                               ON CONFLICT(channel, day) DO UPDATE SET active=active+1""", (ch, day))
+            for (ch, day), n in messages.items():
+                cur.execute("""INSERT INTO activity_daily (channel, day, messages) VALUES (?,?,?)
+                               ON CONFLICT(channel, day) DO UPDATE SET messages=messages+excluded.messages""", (ch, day, n))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            with self._lock:  # put the batch back for the next run
+                for k, ts in pending.items():
+                    self._pending[k] = max(ts, self._pending.get(k, 0))
+                for k, n in messages.items():
+                    self._messages[k] = self._messages.get(k, 0) + n
+            raise
+        finally:
+            conn.close()
+        return len(pending)
+
+activity = ActivityTracker()
+
+def activity_stats(channel, now=None):
+    now = now or time.time()
+    today = ist_day(now)
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT total FROM activity_channels WHERE channel=?", (channel,))
+    row = cur.fetchone(); total = row[0] if row else 0
+    cur.execute("SELECT active, messages FROM activity_daily WHERE channel=? AND day=?", (channel, today))
+    row = cur.fetchone(); dau, msgs = (row[0], row[1]) if row else (0, 0)
+    cur.execute("SELECT COALESCE(SUM(n), 0) FROM activity_last_day WHERE channel=? AND day>=?", (channel, ist_day(now - 6 * 86400)))
+    wau = cur.fetchone()[0]
+    cur.execute("SELECT COALESCE(SUM(n), 0) FROM activity_last_day WHERE channel=? AND day>=?", (channel, ist_day(now - 29 * 86400)))
+    mau = cur.fetchone()[0]
+    conn.close()
+    return {"total": total, "online": activity.online(channel, now), "dau": dau, "wau": wau, "mau": mau, "messages": msgs}
+
+def backfill_activity():
+    # Seeds the rollups from users.last_seen (ISO-8601) or created_at, once.
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM activity_channels")
+    if cur.fetchone()[0]:
+        conn.close(); return 0
+    cols = {r[1] for r in cur.execute("PRAGMA table_info(users)").fetchall()}
+    seen_col = "last_seen" if "last_seen" in cols else "NULL"
+    cur.execute(f"SELECT wa_id, {seen_col} AS last_seen, created_at FROM users WHERE wa_id IS NOT NULL")
+    n = 0
+    for r in cur.fetchall():
+        ts = r["created_at"] or 0
+        if r["last_seen"]:
+            try:
+                ts = datetime.fromisoformat(r["last_seen"]).timestamp()
+            except ValueError:
+                pass
+        ch, day = channel_of(r["wa_id"]), ist_day(ts)
+        cur.execute("INSERT OR IGNORE INTO activity_users (channel, wa_id, last_day) VALUES (?,?,?)", (ch, r["wa_id"], day))
+        if not cur.rowcount:
+            continue
+        cur.execute("""INSERT INTO activity_channels (channel, total) VALUES (?,1)
+                       ON CONFLICT(channel) DO UPDATE SET total=total+1""", (ch,))
+        cur.execute("""INSERT INTO activity_last_day (channel, day, n) VALUES (?,?,1)
+                       ON CONFLICT(channel, day) DO UPDATE SET n=n+1""", (ch, day))
+        cur.execute("""INSERT INTO activity_daily (channel, day, active) VALUES (?,?,1)
+                       ON CONFLICT(channel, day) DO UPDATE SET active=active+1""", (ch, day))
+        n += 1
+    conn.commit(); conn.close()
+    return n
+
+# ==================== BACKGROUND JOBS ====================
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+def start_job(name, interval_s, fn):
+    # Calls fn() every interval_s seconds on a daemon thread (once per process per name)
+    with _jobs_lock:
+        if name in _jobs:
+            return
+        def loop():
+            while True:
+                time.sleep(interval_s)
+                try:
+                    fn()
+                except Exception as e:
+                    logger.error(f"[JOB] {name} failed: {e}")
+                    logger.debug(traceback.format_exc())
+        th = threading.Thread(target=loop, name=f"job-{name}", daemon=True)
+        _jobs[name] = th
+        th.start()
+
+class BatchWriter:
+    # Buffers rows for one INSERT statement and writes them with executemany, either
+    # from a periodic flush() or inline once max_batch rows are waiting.
+
+    def __init__(self, sql, max_batch=200):
+        self.sql = sql
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._rows = []
+
+    def add(self, row):
+        with self._lock:
+            self._rows.append(row)
+            full = len(self._rows) >= self.max_batch
+        if full:
+            self.flush()
+
+    def pending(self):
+        # rows not written yet, oldest first (a copy)
+        with self._lock:
+            return list(self._rows)
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return 0
+        conn = db()
+        try:
+            conn.executemany(self.sql, rows)
+            conn.commit()
+        except sqlite3.Error:
+            with self._lock:  # keep them for the next flush
+                self._rows[:0] = rows
+            raise
+        finally:
+            conn.close()
+        return len(rows)
+
+# ==================== ANSWER LOG / ITEM STATS ====================
+ITEM_MIN_N = 5            # answers before an item can be flagged
+ITEM_MIN_P = 0.15         # almost nobody gets it right
+ITEM_MIN_DISC = -0.1      # strong students do worse on it than weak ones
+
+answer_log = BatchWriter("""INSERT INTO answer_log (session_id, wa_id, lesson_id, q_index, chosen, correct, latency_ms, at)
+                            VALUES (?,?,?,?,?,?,?,?)""")
+
+def log_answer(sess, wa_id, lesson_id, q_index, chosen, correct, now=None):
+    now = now or time.time()
+    sent = sess["q_sent_at"] if "q_sent_at" in sess.keys() else None
+    latency = int((now - sent) * 1000) if sent else None
+    answer_log.add((sess["id"], wa_id, lesson_id, q_index, chosen, int(correct), latency, int(now)))
+
+def _median(xs):
+    xs = sorted(xs)
+    return xs[len(xs) // 2] if xs else None
+
+def _corr(xs, ys):
+    n = len(xs)
+    mx, my = sum(xs) / n, sum(ys) / n
+    sxy = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+    sxx = sum((x - mx) ** 2 for x in xs)
+    syy = sum((y - my) ** 2 for y in ys)
+    return sxy / (sxx * syy) ** 0.5 if sxx and syy else None
+
+def compute_item_stats():
+    # Recomputes stats for lessons that received answers since the last run.
+    # Discrimination is the point-biserial correlation between getting the item right
+    # and the score on the other questions of the same attempt.
+    answer_log.flush()
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT last_answer_id FROM item_stats_state WHERE id=1")
+    row = cur.fetchone(); since = row[0] if row else 0
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM answer_log")
+    upto = cur.fetchone()[0]
+    if upto <= since:
+        conn.close(); return 0
+    cur.execute("SELECT DISTINCT lesson_id FROM answer_log WHERE id>? AND id<=?", (since, upto))
+    lesson_ids = [r[0] for r in cur.fetchall()]
+    now = int(time.time())
+    for lid in lesson_ids:
+        cur.execute("SELECT session_id, q_index, correct, latency_ms FROM answer_log WHERE lesson_id=? AND id<=?", (lid, upto))
+        attempts = {}
+        for r in cur.fetchall():
+            attempts.setdefault(r["session_id"], {})[r["q_index"]] = (r["correct"], r["latency_ms"])
+        totals = {sid: sum(c for c, _ in a.values()) for sid, a in attempts.items()}
+        for qi in sorted({qi for a in attempts.values() for qi in a}):
+            item, rest, lat = [], [], []
+            for sid, a in attempts.items():
+                if qi in a:
+                    c, ms = a[qi]
+                    item.append(c); rest.append(totals[sid] - c)
+                    if ms is not None:
+                        lat.append(ms)
+            n = len(item)
+            p = sum(item) / n
+            disc = _corr(item, rest) if n > 1 else None
+            flagged = n >= ITEM_MIN_N and (p < ITEM_MIN_P or (disc is not None and disc < ITEM_MIN_DISC))
+            cur.execute("""INSERT OR REPLACE INTO item_stats
+                           (lesson_id, q_index, n, p_correct, discrimination, median_ms, flagged, updated_at)
+                           VALUES (?,?,?,?,?,?,?,?)""", (lid, qi, n, p, disc, _median(lat), int(flagged), now))
+    cur.execute("""INSERT INTO item_stats_state (id, last_answer_id) VALUES (1, ?)
+                   ON CONFLICT(id) DO UPDATE SET last_answer_id=excluded.last_answer_id""", (upto,))
+    conn.commit(); conn.close()
+    logger.info(f"[ITEMS] item stats updated for {len(lesson_ids)} lessons")
+    return len(lesson_ids)
+
+def flagged_questions(lesson_id):
+    conn = db(); cur = conn.cursor()
+    cur.execute("SELECT q_index FROM item_stats WHERE lesson_id=? AND flagged=1", (lesson_id,))
+    out = {r[0] for r in cur.fetchall()}
+    conn.close()
+    return out
+
+def usable_questions(lesson):
+    # Questions of a stored lesson minus the ones flagged as bad, for serving it again
+    bad = flagged_questions(lesson["id"])
+    return [q for i, q in enumerate(lesson["questions"]) if i not in bad]
+
+# ==================== INBOUND GUARDS ====================
+# per-student serialization and double-tap/retry suppression (see userlocks.py)
+inbound_locks = userlocks.KeyedLocks()
+inbound_dedupe = userlocks.Deduper(window=float(os.environ.get("DEDUPE_WINDOW_S", "2")))
+inbound_inflight = userlocks.InFlight()
+generating = userlocks.InFlight()   # students with a lesson being generated
+
 # ==================== SUBJECTS / BOARDS ====================
 BOARD_SUBJECTS = {
     "CBSE": {
@@ -215,6 +1307,59 @@ def subject_to_topic_hint(subject_label: str):
     if any(x in s for x in ["computer","ict"]): return "computer science"
     return s
 
+# ==================== TOPIC SCHEDULER ====================
+# Topics are picked from the syllabus, not by the model. Never-attempted topics go
+# first (syllabus order); after that, topics come back spaced out: an attempt without
+# full marks is retried after REVIEW_INTERVALS_DAYS[attempts-1] days, a mastered topic
+# after MASTERED_REVIEW_DAYS.
+REVIEW_INTERVALS_DAYS = (1, 3, 7, 14)
+MASTERED_REVIEW_DAYS = 30
+
+def syllabus_board(board, state=None):
+    # users.board ('CBSE', 'ICSE', 'SSC', 'STATE', 'STATE: Maharashtra') -> syllabus.board
+    b = (board or "").strip()
+    if b.upper().startswith("STATE"):
+        name = b.split(":", 1)[1] if ":" in b else (state or "")
+        return name.strip().title() or None
+    if b.upper() == "SSC": return "Maharashtra"
+    return b.upper() or None
+
+def next_topic(wa_id, board, grade, subject_label, state=None, now=None):
+    sboard = syllabus_board(board, state)
+    topics = syllabus_db.topic_index.topics(sboard, grade, subject_label)
+    if not topics:
+        return None
+    now = now or time.time()
+    conn = db(); cur = conn.cursor()
+    # only this board and grade: "Fractions" mastered in grade 6 is not mastered in grade 7.
+    # mastered_topics holds the syllabus_board() key, lessons the profile's board as typed
+    cur.execute("""SELECT topic, CAST(strftime('%s', mastered_at) AS INTEGER) FROM mastered_topics
+                   WHERE wa_id=? AND board=? AND grade=? AND subject=?""", (wa_id, sboard, grade, subject_label))
+    mastered = {r[0]: r[1] or 0 for r in cur.fetchall()}
+    cur.execute("""SELECT board, topic, COUNT(*), MAX(created_at) FROM lessons
+                   WHERE wa_id=? AND grade=? AND subject_label=? AND topic IS NOT NULL GROUP BY board, topic""",
+                (wa_id, grade, subject_label))
+    attempts = {}
+    for b, topic, n, last in cur.fetchall():
+        if syllabus_board(b, state) == sboard:
+            seen, latest = attempts.get(topic, (0, 0))
+            attempts[topic] = (seen + n, max(latest, last or 0))
+    conn.close()
+
+    fresh = syllabus_db.topic_index.unseen(sboard, grade, subject_label, mastered.keys() | attempts.keys())
+    if fresh:
+        return fresh[0]
+    day = 86400
+    due = {}
+    for topic in topics:
+        if topic in mastered:
+            due[topic] = mastered[topic] + MASTERED_REVIEW_DAYS * day
+        elif topic in attempts:
+            n, last = attempts[topic]
+            due[topic] = last + REVIEW_INTERVALS_DAYS[min(n, len(REVIEW_INTERVALS_DAYS)) - 1] * day
+    # most overdue first; if nothing is due yet, the one that comes due soonest
+    return min(due, key=due.get) if due else topics[0]
+
 # ==================== AI GENERATION (Gemini) ====================
 AI_JSON_SCHEMA = """
 Return ONLY a JSON object with keys:
@@ -228,6 +1373,75 @@ Return ONLY a JSON object with keys:
 No backticks, no markdown fences, no extra commentary outside JSON.
 """
 
+# Upper bound for the lesson prompt; the mastered-topics exclusion list is cut to fit.
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "900"))
+
+def estimate_tokens(text: str) -> int:
+    # ~4 bytes per token; Devanagari costs more tokens per character, which utf-8 bytes reflect
+    return max(1, len((text or "").encode("utf-8")) // 4)
+
+def exclusion_clause(titles, budget_tokens):
+    if not titles or budget_tokens <= 0:
+        return ""
+    head = "\nDo NOT repeat any topic whose title contains any of these phrases (student scored 3/3): "
+    tail = ". If you must pick a new topic, make sure it is clearly different from these."
+    room = budget_tokens - estimate_tokens(head + tail) - 8
+    kept = []
+    for title in titles:  # most recent first
+        cost = estimate_tokens(title + ", ")
+        if cost > room:
+            break
+        kept.append(title); room -= cost
+    if not kept:
+        return ""
+    more = len(titles) - len(kept)
+    summary = f" (and {more} older topics already covered)" if more else ""
+    return f"{head}{', '.join(kept)}{summary}{tail}"
+
+def gemini_call(kind, prompt, **kwargs):
+    # every Gemini request goes through here, so latency and errors are measured per kind
+    start = time.perf_counter()
+    try:
+        with tracing.span("gemini", kind="model", call=kind):
+            return gemini_model.generate_content(prompt, **kwargs)
+    except Exception:
+        gemini_errors.inc(kind)
+        raise
+    finally:
+        gemini_seconds.observe(time.perf_counter() - start, kind)
+
+def record_token_usage(wa_id, subject_label, kind, response, prompt, text):
+    usage = getattr(response, "usage_metadata", None)
+    p = getattr(usage, "prompt_token_count", None) if usage else None
+    r = getattr(usage, "candidates_token_count", None) if usage else None
+    estimated = p is None or r is None
+    if estimated:
+        p, r = estimate_tokens(prompt), estimate_tokens(text)
+    gemini_tokens.inc(kind, "prompt", n=p)
+    gemini_tokens.inc(kind, "response", n=r)
+    try:
+        conn = db(); cur = conn.cursor()
+        cur.execute("""INSERT INTO token_usage (wa_id, subject, kind, prompt_tokens, response_tokens, total_tokens, estimated, created_at)
+                       VALUES (?,?,?,?,?,?,?,?)""",
+                    (wa_id, subject_label, kind, p, r, p + r, int(estimated), int(time.time())))
+        conn.commit(); conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"[AI] token usage not recorded: {e}")
+    return p, r
+
+def token_usage_report(days=30, top=10):
+    since = int(time.time()) - days * 86400
+    conn = db(); cur = conn.cursor()
+    cur.execute("""SELECT wa_id, SUM(total_tokens) AS tokens, SUM(kind='lesson') AS lessons
+                   FROM token_usage WHERE created_at>=? GROUP BY wa_id ORDER BY tokens DESC LIMIT ?""", (since, top))
+    top_users = [dict(r) for r in cur.fetchall()]
+    cur.execute("""SELECT date(created_at, 'unixepoch') AS day, COUNT(*) AS lessons,
+                          AVG(prompt_tokens) AS avg_prompt, AVG(total_tokens) AS avg_total
+                   FROM token_usage WHERE kind='lesson' AND created_at>=? GROUP BY day ORDER BY day""", (since,))
+    per_day = [dict(r) for r in cur.fetchall()]
+    conn.close()
+    return {"top_users": top_users, "per_day": per_day}
+
 def extract_json(s: str) -> str:
     if s.startswith("```"):
         m = re.search(r"```(?:json)?\s*(\{.*\})\s*```", s, flags=re.S)
@@ -236,24 +1450,28 @@ def extract_json(s: str) -> str:
     return m.group(1) if m else s
 
 @retry(stop=stop_after_attempt(2), wait=wait_exponential(multiplier=1, min=1, max=4))
-def ai_generate_lesson(board, grade, subject_label, level, city, state, recent_mistakes=None, wa_id=None):
+@tracing.traced("ai_generate_lesson")
+def ai_generate_lesson(board, grade, subject_label, level, city, state, recent_mistakes=None, wa_id=None, topic=None):
     start = time.monotonic()
     topic_hint = subject_to_topic_hint(subject_label)
     recent = ""
     if recent_mistakes:
         recent = f"\nCommon trouble areas to remediate: {', '.join(recent_mistakes[:4])}."
-    mastered_topics = get_mastered_topics(wa_id=wa_id, subject_label=subject_label) if subject_label and wa_id else []
+    if topic is None and subject_label and wa_id:
+        topic = next_topic(wa_id, board, grade, subject_label, state=state)
     exclude_str = ""
-    if mastered_topics:
-        exclude_str = ("\nDo NOT repeat any topic whose title contains any of these phrases (student scored 3/3): "
-                      f"{', '.join(mastered_topics)}. If you must pick a new topic, make sure it is clearly different from these.")
-    logger.info(f"[AI] Prompt for {wa_id}:\n{exclude_str}")
-    prompt = (
+    if topic:
+        # the scheduler already skipped mastered topics, so the prompt stays the same size
+        exclude_str = f"\nToday's syllabus topic: \"{topic}\". Teach exactly this topic."
+    prompt_head = (
         "You are an expert Indian school tutor who generates short daily lessons and 3 multiple-choice questions. "
         "Keep content aligned with Indian curricula (CBSE/ICSE/State), culturally neutral, and age-appropriate. "
         "Use simple, clear language.\n\n"
         f"Student profile: Board={board}, Grade={grade}, Subject={subject_label} (topic family={topic_hint}), "
-        f"City={city}, State={state}. Current Level={level}.{recent}{exclude_str}\n"
+        f"City={city}, State={state}. Current Level={level}.{recent}"
+    )
+    prompt_tail = (
+        "\n"
         "Create a tiny 'topic of the day' lesson that gets slightly more advanced with higher levels. "
         "THEN generate exactly 3 MCQs with options A-D, each with a short explanation for the correct answer.\n"
         "For each MCQ, if relevant, include an 'image_url' field with a direct link to a suitable image (diagram, chart, etc). "
@@ -261,22 +1479,40 @@ def ai_generate_lesson(board, grade, subject_label, level, city, state, recent_m
         "If no media is relevant, omit these fields.\n\n"
         f"{AI_JSON_SCHEMA}"
     )
+    if not topic:
+        mastered_topics = get_mastered_topics(wa_id=wa_id, subject_label=subject_label) if subject_label and wa_id else []
+        room = PROMPT_TOKEN_BUDGET - estimate_tokens(prompt_head + prompt_tail)
+        exclude_str = exclusion_clause(mastered_topics, room)
+    logger.debug(f"[AI] Prompt for {wa_id}:\n{exclude_str}", extra=logpipe.HOT)
+    prompt = prompt_head + exclude_str + prompt_tail
     try:
         logger.info(f"[AI] start board={board} grade={grade} subject={subject_label} level={level} city={city} state={state}")
-        response = gemini_model.generate_content(prompt)
-        txt = (response.text or "").strip()
-        raw = extract_json(txt)
-        data = json.loads(raw)
-        # Validate
-        assert isinstance(data.get("title"), str) and data["title"]
-        intro = data.get("intro"); assert isinstance(intro, list) and 1 <= len(intro) <= 4
-        qs = data.get("questions", []); assert isinstance(qs, list) and len(qs) == 3
-        for q in qs:
-            assert set(q.keys()) >= {"q","options","ans","explain"}
-            assert isinstance(q["options"], list) and len(q["options"]) == 4
-            assert q["ans"] in ("A","B","C","D")
+        for attempt in range(DUPLICATE_RETRIES + 1):
+            response = gemini_call("lesson", prompt)
+            txt = (response.text or "").strip()
+            p_tok, r_tok = record_token_usage(wa_id, subject_label, "lesson", response, prompt, txt)
+            raw = extract_json(txt)
+            data = json.loads(raw)
+            # Validate
+            assert isinstance(data.get("title"), str) and data["title"]
+            intro = data.get("intro"); assert isinstance(intro, list) and 1 <= len(intro) <= 4
+            qs = data.get("questions", []); assert isinstance(qs, list) and len(qs) == 3
+            for q in qs:
+                assert set(q.keys()) >= {"q","options","ans","explain"}
+                assert isinstance(q["options"], list) and len(q["options"]) == 4
+                assert q["ans"] in ("A","B","C","D")
+            if not (wa_id and subject_label):
+                break
+            dup_id, dup_score = similar_lesson(wa_id, subject_label, data["title"], intro)
+            if dup_score < DUPLICATE_THRESHOLD:
+                break
+            logger.info(f"[AI] near-duplicate of lesson {dup_id} (sim={dup_score:.2f}) title={data['title']!r}")
+            if attempt < DUPLICATE_RETRIES:
+                prompt += (f"\nA draft titled \"{data['title']}\" was too close to a lesson this student already had. "
+                           "Cover a different aspect or sub-topic with a new title and new questions.")
+        data["topic"] = topic
         elapsed = time.monotonic() - start
-        logger.info(f"[AI] ok in {elapsed:.2f}s title={data.get('title','')!r}")
+        logger.info(f"[AI] ok in {elapsed:.2f}s tokens={p_tok}+{r_tok} title={data.get('title','')!r}")
         logger.info(f"[AI] returned topic title: {data.get('title','')!r}")
         return data
     except Exception as e:
@@ -294,43 +1530,373 @@ def help_text():
         "SUBJECT — choose from your board's subjects\n"
         "PROFILE — update name/grade\n"
         "STATS — see your recent scores\n"
-        "RANK — mock leaderboard\n"
+        "RANK — this week's leaderboard for your class\n"
+        "DAILY 7:30 — get a topic every day at that time (DAILY OFF to stop)\n"
         "RESET — reset session"
     )
 
+def topic_message(title, level, intro):
+    return f"📚 Today’s topic: {title} — Level {level}\n\n" + "\n".join(intro[:3]) + "\n\nType QUIZ to begin."
+
+def leaderboard_text(wa_id):
+    view = leaderboard_view(wa_id)
+    if not view or not view["top"]:
+        return "🏆 No scores on the leaderboard this week yet. Finish a quiz to get on it!"
+    lines = [f"🏆 This week — {view['subject']}:"]
+    for i, r in enumerate(view["top"], 1):
+        lines.append(f"{i}) {display_name(r)} — {r['points']} pts")
+    labels = {"class": "Class", "city": "City", "state": "State"}
+    for name, (rank, pts) in view["ranks"].items():
+        lines.append(f"{labels[name]}: you are #{rank} with {pts} pts")
+    return "\n".join(lines)
+
 def display_subject(subject_label: str):
     return subject_label or "Subject"
 
-def recent_trouble_concepts(wa_id, subject_label):
+def recent_trouble_concepts(wa_id, subject_label, limit=3):
+    # Questions this student recently got wrong in the subject, skipping flagged items
+    # (bad questions, not gaps). Falls back to weak levels from the aggregates.
+    if not subject_label:
+        return []
+    # answers still buffered in answer_log count too (newest first), without a flush
+    buffered = [(r[2], r[3]) for r in reversed(answer_log.pending()) if r[1] == wa_id and not r[5]][:20]
     conn = db(); cur = conn.cursor()
-    cur.execute("SELECT subject, score, total FROM history WHERE wa_id=? ORDER BY taken_at DESC LIMIT 5", (wa_id,))
-    rows = cur.fetchall(); conn.close()
-    for r in rows:
-        if r["score"] < r["total"]:
-            return [subject_label]
-    return []
+    wrong = []
+    if buffered:
+        ids = sorted({lesson_id for lesson_id, _ in buffered})
+        marks = ",".join("?" * len(ids))
+        cur.execute(f"""SELECT id, topic, intro_json, questions_json, body_hash FROM lessons
+                        WHERE id IN ({marks}) AND subject_label=?""", (*ids, subject_label))
+        lessons = {r["id"]: r for r in cur.fetchall()}
+        cur.execute(f"SELECT lesson_id, q_index FROM item_stats WHERE flagged=1 AND lesson_id IN ({marks})", ids)
+        flagged = {(r[0], r[1]) for r in cur.fetchall()}
+        wrong = [(lessons[l], q) for l, q in buffered if l in lessons and (l, q) not in flagged]
+    cur.execute("""SELECT a.lesson_id, a.q_index, l.topic, l.intro_json, l.questions_json, l.body_hash
+                   FROM answer_log a JOIN lessons l ON l.id = a.lesson_id
+                   LEFT JOIN item_stats s ON s.lesson_id = a.lesson_id AND s.q_index = a.q_index
+                   WHERE a.wa_id=? AND l.subject_label=? AND a.correct=0 AND COALESCE(s.flagged, 0)=0
+                   ORDER BY a.id DESC LIMIT 20""", (wa_id, subject_label))
+    wrong += [(r, r["q_index"]) for r in cur.fetchall()]
+    conn.close()
+    out, seen = [], set()
+    for r, q_index in wrong:
+        try:
+            q = lesson_content(r)[1][q_index]["q"]
+        except (ValueError, IndexError, KeyError, TypeError):
+            continue
+        concept = f"{r['topic']}: {q}" if r["topic"] else q
+        if concept in seen:
+            continue
+        seen.add(concept); out.append(concept)
+        if len(out) >= limit:
+            return out
+    if out:
+        return out
+    s = get_subject_stats(wa_id, subject_label)
+    if not s:
+        return []
+    weak = [(lv, v) for lv, v in sorted(s["levels"].items()) if v["questions"] and v["accuracy"] < 0.6]
+    return [f"{subject_label} level {lv} questions ({pct(v['accuracy'])} correct)" for lv, v in weak]
+
+def stats_text(wa_id):
+    rows = all_subject_stats(wa_id)
+    if not rows:
+        return "No quiz history yet. Type START to begin!"
+    lines = ["📈 Your progress:"]
+    for s in rows:
+        level = get_subject_level(wa_id, s["subject"])
+        lines.append(f"- {s['subject']} L{level}: {pct(s['accuracy'])} ({s['correct']}/{s['questions']}), "
+                     f"{s['attempts']} quizzes, streak {s['streak']} (best {s['best_streak']})")
+        if s["questions_7d"]:
+            lines.append(f"  last 7 days: {pct(s['accuracy_7d'])} {trend_arrow(s)}")
+    return "\n".join(lines)
 
 # ==================== TWILIO SENDER ====================
 twilio_client = None
 TWILIO_FROM = None
 STATUS_CALLBACK_URL = None
 
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_RATE_PER_S = float(os.environ.get("OUTBOX_RATE_PER_S", "10"))          # whole sender number
+OUTBOX_PER_TO_PER_S = float(os.environ.get("OUTBOX_PER_RECIPIENT_PER_S", "1"))  # one recipient
+# Twilio status callbacks can arrive out of order; never move a message backwards
+STATUS_RANK = {"queued": 0, "sending": 1, "accepted": 1, "sent": 2, "failed": 3, "undelivered": 3, "delivered": 4, "read": 5}
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.ts = burst, time.monotonic()
+
+    def wait_time(self, now):
+        # seconds until a token is available (0 = take it now)
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+def run_locked(wa_id, fn):
+    # fn() as if it were one more inbound message from the student (see /whatsapp)
+    with inbound_locks.hold(wa_id):
+        return fn()
+
 def send_whatsapp(to_wa, body_text):
-    if not twilio_client or not TWILIO_FROM:
-        logger.error("Twilio client not initialized")
-        return
+    # Queued in the outbox; OutboxSender delivers it
+    return outbox.enqueue(to_wa, body_text)
+
+class OutboxSender:
+    # Delivers outbox rows through Twilio from a few worker threads. A row is claimed
+    # by flipping queued -> sending (atomic, so several processes can share the table),
+    # one recipient at a time to keep their messages in order. Failures are retried
+    # with exponential backoff; Twilio's 4xx errors other than 429 are permanent.
+    # The sender-number rate is reserved in the claim transaction (outbox_rate), so it
+    # holds across the Flask and Telegram processes; the per-recipient rate is local.
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._per_to = {}
+        self._threads = []
+
+    def enqueue(self, to_addr, body):
+        now = time.time()
+        conn = db(); cur = conn.cursor()
+        cur.execute("""INSERT INTO outbox (to_addr, body, status, attempts, next_attempt_at, created_at, updated_at, trace)
+                       VALUES (?,?,'queued',0,?,?,?,?)""", (to_addr, body, now, now, now, tracing.ref()))
+        msg_id = cur.lastrowid
+        conn.commit(); conn.close()
+        self._wake.set()
+        return msg_id
+
+    def start(self, workers=2):
+        if self._threads:
+            return
+        self.requeue_stale()
+        start_job("outbox-requeue", 30, self.requeue_stale)
+        for n in range(workers):
+            th = threading.Thread(target=self._run, name=f"outbox-{n}", daemon=True)
+            self._threads.append(th)
+            th.start()
+
+    def requeue_stale(self, age=60):
+        # Rows left 'sending' by a crashed worker go out again (at-least-once). Run at
+        # start and then periodically: a restart within `age` seconds of the crash
+        # would otherwise leave the row, and so its recipient, stuck for good.
+        now = time.time()
+        conn = db()
+        n = conn.execute("UPDATE outbox SET status='queued', updated_at=? WHERE status='sending' AND sid IS NULL AND updated_at < ?",
+                         (now, now - age)).rowcount
+        conn.execute("DELETE FROM early_status WHERE at < ?", (now - 86400,))  # never matched a send
+        conn.commit(); conn.close()
+        if n:
+            logger.warning(f"[OUTBOX] requeued {n} message(s) stuck in 'sending'")
+            self._wake.set()
+        return n
+
+    def _claim(self):
+        # (row, 0) for a claimed message, else (None, seconds to wait)
+        now = time.time()
+        conn = db(); cur = conn.cursor()
+        try:
+            cur.execute("""SELECT id FROM outbox WHERE status='queued' AND next_attempt_at<=?
+                             AND to_addr NOT IN (SELECT to_addr FROM outbox WHERE status='sending')
+                           ORDER BY id LIMIT 8""", (now,))
+            for (msg_id,) in cur.fetchall():
+                # the recipient check is repeated in the UPDATE, so the claim is atomic:
+                # another worker or process may have claimed a message to them since
+                cur.execute("""UPDATE outbox SET status='sending', updated_at=? WHERE id=? AND status='queued'
+                                 AND NOT EXISTS (SELECT 1 FROM outbox s WHERE s.to_addr=outbox.to_addr AND s.status='sending')""",
+                            (now, msg_id))
+                if cur.rowcount:
+                    wait = self._reserve(cur, now)
+                    conn.commit()
+                    cur.execute("SELECT * FROM outbox WHERE id=?", (msg_id,))
+                    return cur.fetchone(), wait
+            cur.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status='queued'")
+            nxt = cur.fetchone()[0]
+            return None, min(5.0, max(0.05, nxt - now)) if nxt else 5.0
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _reserve(cur, now):
+        # takes the next send slot inside the caller's write transaction; returns the
+        # seconds to wait for it (up to one second's worth of sends may go at once)
+        step = 1.0 / OUTBOX_RATE_PER_S
+        burst = max(1.0, OUTBOX_RATE_PER_S) * step
+        cur.execute("SELECT next_at FROM outbox_rate WHERE id=1")
+        row = cur.fetchone()
+        slot = max(row[0] if row else 0.0, now) + step
+        cur.execute("INSERT OR REPLACE INTO outbox_rate (id, next_at) VALUES (1, ?)", (slot,))
+        return max(0.0, slot - now - burst)
+
+    def _throttle(self, to_addr):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                b = self._per_to.get(to_addr)
+                if b is None:
+                    if len(self._per_to) > 10000:  # forget recipients whose bucket has refilled
+                        self._per_to = {k: v for k, v in self._per_to.items()
+                                        if v.tokens + (now - v.ts) * v.rate < v.burst}
+                    b = self._per_to[to_addr] = TokenBucket(OUTBOX_PER_TO_PER_S, 3)
+                wait = b.wait_time(now)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _run(self):
+        while True:
+            try:
+                row, wait = self._claim()
+            except sqlite3.Error as e:
+                logger.error(f"[OUTBOX] claim failed: {e}")
+                row, wait = None, 5.0
+            if row is None:
+                self._wake.wait(timeout=wait)
+                self._wake.clear()
+                continue
+            if wait:
+                time.sleep(wait)   # the sender number's slot
+            self._throttle(row["to_addr"])
+            with tracing.span("twilio.send", kind="send", parent=row["trace"], attempt=row["attempts"] + 1):
+                self._deliver(row)
+
+    def _deliver(self, row):
+        now = time.time()
+        try:
+            if not twilio_client or not TWILIO_FROM:
+                raise RuntimeError("Twilio client not initialized")
+            start = time.perf_counter()
+            try:
+                msg = twilio_client.messages.create(
+                    from_=TWILIO_FROM,
+                    to=row["to_addr"],
+                    body=row["body"],
+                    status_callback=STATUS_CALLBACK_URL  # e.g., https://<ngrok>/twilio-status
+                )
+            finally:
+                twilio_seconds.observe(time.perf_counter() - start)
+        except Exception as e:
+            attempts = row["attempts"] + 1
+            status = getattr(e, "status", None)
+            permanent = isinstance(status, int) and 400 <= status < 500 and status != 429
+            if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+                new_status, nxt = "failed", None
+            else:
+                new_status, nxt = "queued", now + min(600, 5 * 2 ** attempts) * (0.5 + random.random())
+            twilio_errors.inc("permanent" if permanent else "retry")
+            logger.error(f"[SEND] ERROR id={row['id']} to={row['to_addr']} attempt={attempts}: {e}")
+            logger.debug("[SEND] TRACE:\n" + traceback.format_exc())
+            conn = db()
+            conn.execute("""UPDATE outbox SET status=?, attempts=?, next_attempt_at=?, last_error=?, updated_at=?
+                            WHERE id=?""", (new_status, attempts, nxt, str(e)[:500], now, row["id"]))
+            conn.commit(); conn.close()
+            return
+        logger.info(f"[SEND] sid={msg.sid} id={row['id']} to={row['to_addr']} len={len(row['body'])}", extra=logpipe.HOT)
+        conn = db(); cur = conn.cursor()
+        cur.execute("""UPDATE outbox SET sid=?, attempts=attempts+1, sent_at=?, updated_at=?,
+                              status=CASE WHEN status='sending' THEN 'sent' ELSE status END
+                       WHERE id=?""", (msg.sid, now, now, row["id"]))
+        # a status callback may have arrived before the sid did (see reconcile_status);
+        # this transaction already holds the write lock, so none can slip in between
+        cur.execute("SELECT status, rank, error FROM early_status WHERE sid=?", (msg.sid,))
+        early = cur.fetchone()
+        if early:
+            if early["rank"] > STATUS_RANK["sent"]:
+                cur.execute("UPDATE outbox SET status=?, last_error=COALESCE(?, last_error) WHERE id=?",
+                            (early["status"], early["error"], row["id"]))
+            cur.execute("DELETE FROM early_status WHERE sid=?", (msg.sid,))
+        conn.commit(); conn.close()
+
+outbox = OutboxSender()
+
+# ==================== DELIVERY HEALTH ====================
+delivery_log = BatchWriter("INSERT INTO delivery_events (sid, to_addr, status, error_code, at) VALUES (?,?,?,?,?)")
+
+def percentile(xs, p):
+    # nearest-rank percentile of a sorted list
+    if not xs:
+        return None
+    return xs[min(len(xs) - 1, max(0, int(round(p / 100 * len(xs) + 0.5)) - 1))]
+
+def delivery_health(hours=24, now=None):
+    # Per send hour (IST; messages that never went out count at their failure time):
+    # counts, failure rate and send->delivered / send->read latency percentiles in seconds.
+    # Callbacks reach delivery_events in batches (delivery_log, every 5 s, in the process
+    # serving /twilio-status), so the last few seconds may not be counted yet.
+    now = now or time.time()
+    conn = db(); cur = conn.cursor()
+    cur.execute("""SELECT o.sent_at, o.updated_at, o.status AS final,
+                          MIN(CASE WHEN e.status='delivered' THEN e.at END) AS delivered_at,
+                          MIN(CASE WHEN e.status='read' THEN e.at END) AS read_at
+                   FROM outbox o LEFT JOIN delivery_events e ON e.sid = o.sid
+                   WHERE o.sent_at >= ? OR (o.sent_at IS NULL AND o.status='failed' AND o.updated_at >= ?)
+                   GROUP BY o.id""", (now - hours * 3600, now - hours * 3600))
+    buckets = {}
+    for r in cur.fetchall():
+        ts = r["sent_at"]
+        hour = time.strftime("%Y-%m-%d %H:00", time.gmtime((ts or r["updated_at"]) + IST_OFFSET))
+        b = buckets.setdefault(hour, {"hour": hour, "messages": 0, "sent": 0, "delivered": 0, "read": 0, "failed": 0,
+                                      "dl": [], "rl": []})
+        b["messages"] += 1
+        if ts:
+            b["sent"] += 1
+        if r["final"] in ("failed", "undelivered"):
+            b["failed"] += 1
+        if r["delivered_at"] and ts:
+            b["delivered"] += 1; b["dl"].append(r["delivered_at"] - ts)
+        if r["read_at"] and ts:
+            b["read"] += 1; b["rl"].append(r["read_at"] - ts)
+    conn.close()
+    out = []
+    for hour in sorted(buckets):
+        b = buckets[hour]
+        dl, rl = sorted(b.pop("dl")), sorted(b.pop("rl"))
+        b.update(fail_rate=b["failed"] / b["messages"],
+                 deliver_p50=percentile(dl, 50), deliver_p90=percentile(dl, 90), deliver_p99=percentile(dl, 99),
+                 read_p50=percentile(rl, 50), read_p90=percentile(rl, 90))
+        out.append(b)
+    return out
+
+def failing_recipients(days=7, min_failures=3, limit=20):
+    # from delivery_events, which can be up to 5 s behind (see delivery_health)
+    conn = db(); cur = conn.cursor()
+    cur.execute("""SELECT to_addr, COUNT(*) AS failures, MAX(error_code) AS error_code, MAX(at) AS last_at
+                   FROM delivery_events WHERE status IN ('failed','undelivered') AND at >= ?
+                   GROUP BY to_addr HAVING COUNT(*) >= ? ORDER BY failures DESC LIMIT ?""",
+                (time.time() - days * 86400, min_failures, limit))
+    rows = [dict(r) for r in cur.fetchall()]
+    conn.close()
+    return rows
+
+def reconcile_status(sid, status, error_code=None, error_message=None):
+    # Applies a Twilio status callback to the queued message. A callback can beat
+    # messages.create() returning the sid; it is then kept in early_status for the
+    # sender to apply, and False is returned.
+    if not sid or not status:
+        return False
+    status = status.lower()
+    rank = STATUS_RANK.get(status, 0)
+    err = f"{error_code}: {error_message}" if error_code else None
+    conn = db(); cur = conn.cursor()
     try:
-        msg = twilio_client.messages.create(
-            from_=TWILIO_FROM,
-            to=to_wa,
-            body=body_text,
-            status_callback=STATUS_CALLBACK_URL  # e.g., https://<ngrok>/twilio-status
-        )
-        logger.info(f"[SEND] sid={msg.sid} to={to_wa} len={len(body_text)}")
-    except Exception as e:
-        logger.error(f"[SEND] ERROR to={to_wa}: {e}")
-        logger.debug("[SEND] TRACE:\n" + traceback.format_exc())
-
+        cur.execute("BEGIN IMMEDIATE")  # look up and park in one step against the sender
+        cur.execute("SELECT id, status FROM outbox WHERE sid=?", (sid,))
+        row = cur.fetchone()
+        if row is None:
+            cur.execute("""INSERT INTO early_status (sid, status, rank, error, at) VALUES (?,?,?,?,?)
+                           ON CONFLICT(sid) DO UPDATE SET status=excluded.status, rank=excluded.rank,
+                                                          error=COALESCE(excluded.error, early_status.error), at=excluded.at
+                           WHERE excluded.rank >= early_status.rank""", (sid, status, rank, err, time.time()))
+        elif rank >= STATUS_RANK.get(row["status"], 0):
+            cur.execute("UPDATE outbox SET status=?, last_error=COALESCE(?, last_error), updated_at=? WHERE id=?",
+                        (status, err, time.time(), row["id"]))
+        conn.commit()
+    finally:
+        conn.close()
+    return row is not None
 
 def _ensure_columns():
     con = db(); cur = con.cursor()
@@ -347,25 +1913,48 @@ def _ensure_columns():
     # users.state
     if not has_col("users","state"):
         cur.execute("ALTER TABLE users ADD COLUMN state TEXT")
+    # users.daily_time ('HH:MM' IST for the daily topic push, NULL = off)
+    if not has_col("users","daily_time"):
+        cur.execute("ALTER TABLE users ADD COLUMN daily_time TEXT")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_daily_time ON users(daily_time)")
+    # outbox.trace
+    if not has_col("outbox","trace"):
+        cur.execute("ALTER TABLE outbox ADD COLUMN trace TEXT")
     con.commit(); con.close()
 
 # ==================== FLASK APP ====================
-def create_app():
+def create_app(gemini=None, twilio=None):
+    # gemini / twilio: stand-ins for the real clients (see benchmarks/loadtest.py). Clients
+    # already set up by an earlier call are kept, so the Telegram adapter's own
+    # create_app() does not replace injected ones.
     global gemini_model, twilio_client, TWILIO_FROM, STATUS_CALLBACK_URL
 
     load_dotenv()
     init_db()
+    # once: the session-flush job and the atexit hook below stay bound to this object
+    global state, _state_configured
+    if not _state_configured:
+        state = make_state_backend()
+        _state_configured = True
+    syllabus_db.topic_index.refresh()  # load syllabus topics into memory once at startup
 
     # Gemini API (latest SDK)
-    genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-    model_name = os.environ.get("GEMINI_MODEL", "gemini-1.5-flash")
-    gemini_model = genai.GenerativeModel(model_name)
+    if gemini is not None:
+        gemini_model = gemini
+    elif gemini_model is None:
+        genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+        model_name = os.environ.get("GEMINI_MODEL", "gemini-1.5-flash")
+        gemini_model = genai.GenerativeModel(model_name)
 
     # Twilio
     account_sid = os.environ.get("TWILIO_ACCOUNT_SID")
     auth_token = os.environ.get("TWILIO_AUTH_TOKEN")
     TWILIO_FROM = os.environ.get("TWILIO_WHATSAPP_SANDBOX", "whatsapp:+14155238886")
-    twilio_client = Client(account_sid, auth_token)
+    if twilio is not None:
+        twilio_client = twilio
+    elif twilio_client is None:
+        # pooled keep-alive connections, shared by the outbox workers
+        twilio_client = Client(account_sid, auth_token, http_client=TwilioHttpClient(pool_connections=True, timeout=15))
 
     # Status callback URL (from .env; set it to your ngrok URL)
     STATUS_CALLBACK_URL = os.environ.get("STATUS_CALLBACK_URL")
@@ -373,10 +1962,35 @@ def create_app():
     app = Flask(__name__)
 
     _ensure_columns()
+    start_job("leaderboard-rollover", 3600, rollover_leaderboards)
+    backfill_activity()
+    backfill_subject_stats()
+    outbox.start(int(os.environ.get("OUTBOX_WORKERS", "2")))
+    start_job("session-flush", 1, state.flush)
+    atexit.register(state.flush)
+    start_job("activity-flush", 60, activity.flush)
+    atexit.register(activity.flush)
+    start_job("answer-log-flush", 10, answer_log.flush)
+    start_job("delivery-log-flush", 5, delivery_log.flush)
+    atexit.register(delivery_log.flush)
+    start_job("item-stats", 900, compute_item_stats)
+    atexit.register(answer_log.flush)
 
     @app.route("/health")
     def health():
-        return {"ok": True}
+        return {"ok": True, "state": state.stats()}
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+    @app.route("/traces")
+    def traces():
+        # ?root=whatsapp%20start: latency percentiles and where the time goes
+        # ?limit=N: recent spans to list (50 when missing or not a number, at least 1)
+        spans = tracing.recent()
+        limit = max(1, request.args.get("limit", 50, type=int))
+        return {"summary": tracing.summarize(spans, request.args.get("root")), "recent": spans[-limit:]}
 
     @app.route("/twilio-status", methods=["POST"])
     def twilio_status():
@@ -385,15 +1999,37 @@ def create_app():
         to = request.form.get("To")
         errc = request.form.get("ErrorCode")
         errmsg = request.form.get("ErrorMessage")
-        logger.info(f"[STATUS] sid={sid} to={to} status={status} err={errc}:{errmsg}")
+        logger.info(f"[STATUS] sid={sid} to={to} status={status} err={errc}:{errmsg}", extra=logpipe.HOT)
+        delivery_log.add((sid, to, (status or "").lower(), errc, time.time()))
+        if not reconcile_status(sid, status, errc, errmsg):
+            logger.info(f"[STATUS] sid={sid} not in outbox yet, kept for the sender", extra=logpipe.HOT)
         return ("", 204)
 
     @app.route("/whatsapp", methods=["POST"])
     def whatsapp():
         req_id = str(uuid.uuid4())[:8]
+        logpipe.request_id.set(req_id)
         wa_id = request.form.get("From")  # e.g., 'whatsapp:+91...'
         body = (request.form.get("Body") or "").strip()
-        logger.info(f"[{req_id}] INBOUND from={wa_id} body={body!r}")
+        sid = request.form.get("MessageSid")
+        command = command_label(body)
+        inbound_total.inc("whatsapp", command)
+        # webhook retries and double sends: drop, reply with empty TwiML
+        key = f"{wa_id}:{body.upper()}:{dedupe_step(get_session(wa_id) if wa_id else None)}"
+        dup = [inbound_dedupe.seen(f"sid:{sid}")] if sid else []
+        dup.append(inbound_dedupe.seen(key))
+        if any(dup) or not inbound_inflight.begin(key):
+            logger.info(f"[{req_id}] DUPLICATE from={wa_id} body={body!r} dropped", extra=logpipe.HOT)
+            return Response(str(MessagingResponse()), mimetype="application/xml")
+        try:
+            with inbound_locks.hold(wa_id), tracing.span(f"whatsapp {command}", req=req_id):
+                return handle_whatsapp(req_id, wa_id, body)
+        finally:
+            inbound_inflight.end(key)
+
+    def handle_whatsapp(req_id, wa_id, body):
+        logger.info(f"[{req_id}] INBOUND from={wa_id} body={body!r}", extra=logpipe.HOT)
+        activity.touch(wa_id)
 
         resp = MessagingResponse()
         msg = resp.message()
@@ -403,12 +2039,14 @@ def create_app():
         up = text.upper()
 
         # -------- Onboarding: first -> last -> DOB -> city -> state -> board -> grade --------
-        if not user:
-            sess = get_session(wa_id)
+        # The user row exists from the first answer on, so the session stage (not the
+        # row) says whether onboarding is still running.
+        sess = get_session(wa_id)
+        if not user or (sess and sess["stage"].startswith("ask_")):
             if not sess:
                 set_session(wa_id, "ask_first")
                 msg.body("👋 Welcome! I'm your Learning Buddy.\nWhat's your *first name*?")
-                logger.info(f"[{req_id}] ACK new-user ask_first")
+                logger.info(f"[{req_id}] ACK new-user ask_first", extra=logpipe.HOT)
                 return Response(str(resp), mimetype="application/xml")
 
             stage = sess["stage"]
@@ -418,38 +2056,39 @@ def create_app():
                 upsert_user(wa_id, first_name=text_norm)
                 set_session(wa_id, "ask_last")
                 msg.body(f"Thanks, {text_norm}! What's your *last name*?")
-                logger.info(f"[{req_id}] ACK ask_last")
+                logger.info(f"[{req_id}] ACK ask_last", extra=logpipe.HOT)
                 return Response(str(resp), mimetype="application/xml")
 
             if stage == "ask_last":
                 upsert_user(wa_id, last_name=text_norm)
                 set_session(wa_id, "ask_dob")
                 msg.body("Got it. What's your *date of birth*? (YYYY-MM-DD)")
-                logger.info(f"[{req_id}] ACK ask_dob")
+                logger.info(f"[{req_id}] ACK ask_dob", extra=logpipe.HOT)
                 return Response(str(resp), mimetype="application/xml")
 
             if stage == "ask_dob":
                 valid = len(text_norm) == 10 and text_norm[4] == "-" and text_norm[7] == "-"
                 if not valid:
                     msg.body("Please send DOB in format YYYY-MM-DD (e.g., 2013-04-25).")
-                    logger.info(f"[{req_id}] ACK invalid_dob")
+                    logger.info(f"[{req_id}] ACK invalid_dob", extra=logpipe.HOT)
                     return Response(str(resp), mimetype="application/xml")
                 upsert_user(wa_id, dob=text_norm)
                 set_session(wa_id, "ask_city")
                 msg.body("Which *city* do you live in?")
-                logger.info(f"[{req_id}] ACK ask_city")
+                logger.info(f"[{req_id}] ACK ask_city", extra=logpipe.HOT)
                 return Response(str(resp), mimetype="application/xml")
 
             if stage == "ask_city":
                 upsert_user(wa_id, city=text_norm)
                 set_session(wa_id, "ask_state")
                 msg.body("Which *state* are you in? (e.g., Maharashtra, Karnataka)")
-                logger.info(f"[{req_id}] ACK ask_state")
+                logger.info(f"[{req_id}] ACK ask_state", extra=logpipe.HOT)
                 return Response(str(resp), mimetype="application/xml")
 
             if stage == "ask_state":
-                upsert_user(wa_id, state=text_norm)
-                suggested = suggest_board_for_state(text_norm)
+                state_name = matching.match_state(text_norm) or text_norm
+                upsert_user(wa_id, state=state_name)
+                suggested = suggest_board_for_state(state_name)
                 if suggested:
                     upsert_user(wa_id, board=suggested)
                     set_session(wa_id, "ask_grade")
@@ -457,32 +2096,34 @@ def create_app():
                 else:
                     set_session(wa_id, "ask_board")
                     msg.body("Which *board* do you study under?\nA) CBSE\nB) ICSE\nC) State Board\nReply A, B, or C.")
-                logger.info(f"[{req_id}] ACK ask_board_or_grade")
+                logger.info(f"[{req_id}] ACK ask_board_or_grade", extra=logpipe.HOT)
                 return Response(str(resp), mimetype="application/xml")
 
             if stage == "ask_board":
-                upU = text_norm.strip().upper()[:1]
+                upU = text_norm.strip().upper()
+                if len(upU) > 1:  # "cbse", "state board", "सीबीएसई"
+                    upU = {"CBSE": "A", "ICSE": "B", "State": "C"}.get(matching.match_board(upU), upU[:1])
                 if upU not in ("A","B","C"):
                     msg.body("Please reply A (CBSE), B (ICSE), or C (State Board).")
-                    logger.info(f"[{req_id}] ACK invalid_board_choice")
+                    logger.info(f"[{req_id}] ACK invalid_board_choice", extra=logpipe.HOT)
                     return Response(str(resp), mimetype="application/xml")
                 board = {"A":"CBSE","B":"ICSE","C":"STATE"}[upU]
                 upsert_user(wa_id, board=board)
                 set_session(wa_id, "ask_grade")
                 msg.body("Great. Which *grade* are you in? (e.g., 6, 7, 8)")
-                logger.info(f"[{req_id}] ACK ask_grade")
+                logger.info(f"[{req_id}] ACK ask_grade", extra=logpipe.HOT)
                 return Response(str(resp), mimetype="application/xml")
 
             if stage == "ask_grade":
                 grade_clean = "".join(ch for ch in text_norm if ch.isdigit())
                 if not grade_clean:
                     msg.body("Please send a number like 6, 7, 8, 9, 10.")
-                    logger.info(f"[{req_id}] ACK invalid_grade")
+                    logger.info(f"[{req_id}] ACK invalid_grade", extra=logpipe.HOT)
                 else:
                     upsert_user(wa_id, grade=grade_clean, subject="Mathematics", level=1, streak=0)
                     set_session(wa_id, "idle")
                     msg.body("Profile saved ✅\nType SUBJECT to pick what you want to learn today.")
-                    logger.info(f"[{req_id}] ACK profile_saved")
+                    logger.info(f"[{req_id}] ACK profile_saved", extra=logpipe.HOT)
                 return Response(str(resp), mimetype="application/xml")
 
         # Re-fetch after upsert
@@ -491,7 +2132,7 @@ def create_app():
         # ---------------- Commands ----------------
         if up == "HELP":
             msg.body(help_text())
-            logger.info(f"[{req_id}] ACK help")
+            logger.info(f"[{req_id}] ACK help", extra=logpipe.HOT)
 
         elif up == "SUBJECT":
             subs = subjects_for(user["board"], user["grade"]) or ["English", "Mathematics", "Science", "Social Science"]
@@ -499,12 +2140,12 @@ def create_app():
             letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
             mapping_lines = [f"{letters[i]}) {sname}" for i, sname in enumerate(subs)]
             msg.body("Choose a subject:\n" + "\n".join(mapping_lines) + "\nReply with the letter (A, B, C...).")
-            logger.info(f"[{req_id}] ACK subject_list board={user['board']} grade={user['grade']}")
+            logger.info(f"[{req_id}] ACK subject_list board={user['board']} grade={user['grade']}", extra=logpipe.HOT)
 
         elif up == "PROFILE":
             set_session(wa_id, "profile_name")
             msg.body("Update your name? Send the new name, or type SKIP.")
-            logger.info(f"[{req_id}] ACK profile_name")
+            logger.info(f"[{req_id}] ACK profile_name", extra=logpipe.HOT)
 
         elif up == "SKIP":
             sess = get_session(wa_id)
@@ -515,78 +2156,88 @@ def create_app():
                 else:
                     set_session(wa_id, "idle")
                     msg.body("Profile unchanged. Type START to continue.")
-                logger.info(f"[{req_id}] ACK skip")
+                logger.info(f"[{req_id}] ACK skip", extra=logpipe.HOT)
             else:
                 msg.body("Nothing to skip. Type HELP for options.")
-                logger.info(f"[{req_id}] ACK skip_nothing")
+                logger.info(f"[{req_id}] ACK skip_nothing", extra=logpipe.HOT)
 
         elif up == "RANK":
-            msg.body("🏆 Leaderboard (MVP mock):\n1) You — 3 pts\n2) Student B — 2 pts\n3) Student C — 1 pt")
-            logger.info(f"[{req_id}] ACK rank")
+            msg.body(leaderboard_text(wa_id))
+            logger.info(f"[{req_id}] ACK rank", extra=logpipe.HOT)
 
         elif up == "RESET":
             set_session(wa_id, "idle", 0, 0, None)
             msg.body("Session reset. Type START to begin.")
-            logger.info(f"[{req_id}] ACK reset")
+            logger.info(f"[{req_id}] ACK reset", extra=logpipe.HOT)
 
         elif up == "STATS":
-            conn = db(); cur = conn.cursor()
-            cur.execute(
-                "SELECT subject, level, score, total, taken_at FROM history WHERE wa_id=? ORDER BY taken_at DESC LIMIT 5",
-                (wa_id,)
-            ); rows = cur.fetchall(); conn.close()
-            if not rows:
-                msg.body("No quiz history yet. Type START to begin!")
+            msg.body(stats_text(wa_id))
+            logger.info(f"[{req_id}] ACK stats", extra=logpipe.HOT)
+
+        elif up.startswith("DAILY"):
+            arg = text[5:].strip()
+            if arg.upper() == "OFF":
+                upsert_user(wa_id, daily_time=None)
+                msg.body("Daily topic turned off. Type DAILY 7:30 to turn it back on.")
+            elif broadcast.parse_daily_time(arg):
+                upsert_user(wa_id, daily_time=broadcast.parse_daily_time(arg))
+                msg.body(f"⏰ You'll get a new topic every day at {broadcast.parse_daily_time(arg)} (IST). Type DAILY OFF to stop.")
             else:
-                lines = ["📈 Recent quizzes:"]
-                for r in rows:
-                    lines.append(f"- {r['subject']} L{r['level']}: {r['score']}/{r['total']}")
-                msg.body("\n".join(lines))
-            logger.info(f"[{req_id}] ACK stats n={len(rows) if rows else 0}")
+                cur_time = user["daily_time"]
+                msg.body((f"Your daily topic comes at {cur_time} (IST). " if cur_time else "") +
+                         "Type DAILY followed by a time, e.g. DAILY 7:30 or DAILY 19:00.")
+            logger.info(f"[{req_id}] ACK daily {arg!r}", extra=logpipe.HOT)
+
+        elif up == "START" and not generating.begin(wa_id):
+            msg.body("⏳ Your lesson is still being prepared. It will arrive here shortly.")
+            logger.info(f"[{req_id}] ACK start_in_progress", extra=logpipe.HOT)
 
         elif up == "START":
             # Immediate ACK, then generate + send in background
             msg.body("💡 Got it! Generating today’s topic… you’ll get it here shortly. Then type QUIZ to begin.")
-            logger.info(f"[{req_id}] ACK start")
+            logger.info(f"[{req_id}] ACK start", extra=logpipe.HOT)
 
+            @tracing.traced("generate_and_send")
             def do_generate_and_send():
                 thread_id = str(uuid.uuid4())[:8]
+                logpipe.request_id.set(req_id)
                 logger.info(f"[{req_id}/{thread_id}] BG generation started")
                 try:
                     u = get_user(wa_id)
-                    level = u["level"] or 1
+                    level = get_subject_level(wa_id, u["subject"]) if u["subject"] else (u["level"] or 1)
                     trouble = recent_trouble_concepts(wa_id, u["subject"])
                     lesson = ai_generate_lesson(
                         board=u["board"], grade=u["grade"], subject_label=u["subject"],
-                        level=level, city=u["city"], state=u["state"], recent_mistakes=trouble
+                        level=level, city=u["city"], state=u["state"], recent_mistakes=trouble, wa_id=wa_id
                     )
                     lesson_id = save_lesson(
                         wa_id=wa_id,
                         board=u["board"], grade=u["grade"], subject_label=u["subject"],
-                        level=level, title=lesson["title"], intro=lesson["intro"], questions=lesson["questions"]
+                        level=level, title=lesson["title"], intro=lesson["intro"], questions=lesson["questions"],
+                        topic=lesson.get("topic")
                     )
                     set_session(wa_id, "lesson", 0, 0, lesson_id)
-                    intro = "\n".join(lesson["intro"][:3])
-                    body = f"📚 Today’s topic: {lesson['title']} — Level {level}\n\n{intro}\n\nType QUIZ to begin."
-                    send_whatsapp(wa_id, body)
+                    send_whatsapp(wa_id, topic_message(lesson["title"], level, lesson["intro"]))
                     logger.info(f"[{req_id}/{thread_id}] BG done; lesson_id={lesson_id}")
                 except Exception as e:
                     logger.error(f"[{req_id}/{thread_id}] BG ERROR: {e}")
                     logger.debug(traceback.format_exc())
                     send_whatsapp(wa_id, "Sorry, I couldn’t generate today’s topic just now. Please try START again.")
-            threading.Thread(target=do_generate_and_send, daemon=True).start()
+                finally:
+                    generating.end(wa_id)
+            threading.Thread(target=tracing.wrap(do_generate_and_send), daemon=True).start()
 
         elif up == "QUIZ":
             sess = get_session(wa_id)
             if not sess or not sess["lesson_id"]:
                 msg.body("Type START first to get today's lesson.")
-                logger.info(f"[{req_id}] ACK quiz_no_lesson")
+                logger.info(f"[{req_id}] ACK quiz_no_lesson", extra=logpipe.HOT)
             else:
                 lesson = load_lesson(sess["lesson_id"])
                 idx = sess["q_index"]; qs = lesson["questions"]
                 if idx >= len(qs):
                     msg.body("You've completed today's questions. Type START to begin again.")
-                    logger.info(f"[{req_id}] ACK quiz_already_done")
+                    logger.info(f"[{req_id}] ACK quiz_already_done", extra=logpipe.HOT)
                 else:
                     qobj = qs[idx]
                     textq = (
@@ -597,9 +2248,9 @@ def create_app():
                         f"D) {qobj['options'][3]}\n"
                         f"Reply with A, B, C or D."
                     )
-                    update_session(wa_id, stage="quiz")
+                    update_session(wa_id, stage="quiz", q_sent_at=time.time())
                     msg.body(textq)
-                    logger.info(f"[{req_id}] Q{idx+1} sent")
+                    logger.info(f"[{req_id}] Q{idx+1} sent", extra=logpipe.HOT)
 
         # Letter inputs: subject selection OR quiz answers
         elif len(up) == 1 and up in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
@@ -609,18 +2260,18 @@ def create_app():
                 idx = ord(up) - ord('A')
                 if idx < 0 or idx >= len(subs):
                     msg.body("Please choose a valid option from the list. Type SUBJECT to see options again.")
-                    logger.info(f"[{req_id}] ACK invalid_subject_choice")
+                    logger.info(f"[{req_id}] ACK invalid_subject_choice", extra=logpipe.HOT)
                 else:
                     chosen = subs[idx]
                     upsert_user(wa_id, subject=chosen, level=1)
                     set_session(wa_id, "idle", 0, 0, None)
                     msg.body(f"Subject set to *{chosen}*. Type START to begin.")
-                    logger.info(f"[{req_id}] ACK subject_set {chosen}")
+                    logger.info(f"[{req_id}] ACK subject_set {chosen}", extra=logpipe.HOT)
             elif sess and sess["stage"] == "quiz":
                 msg.body(process_ai_answer(user, sess, up, req_id))
             else:
                 msg.body("Not sure what you meant. Type SUBJECT to choose a subject or HELP for commands.")
-                logger.info(f"[{req_id}] ACK unknown_letter")
+                logger.info(f"[{req_id}] ACK unknown_letter", extra=logpipe.HOT)
 
         else:
             # Profile update flow or default
@@ -635,30 +2286,43 @@ def create_app():
                         upsert_user(wa_id, first_name=name_txt)
                     set_session(wa_id, "profile_grade")
                     msg.body("Got it! Now update your grade? (e.g., 6, 7, 8) or type SKIP.")
-                    logger.info(f"[{req_id}] ACK profile_name_set")
+                    logger.info(f"[{req_id}] ACK profile_name_set", extra=logpipe.HOT)
                 elif sess["stage"] == "profile_grade":
                     grade_clean = "".join(ch for ch in text if ch.isdigit())
                     if grade_clean:
                         upsert_user(wa_id, grade=grade_clean)
                         set_session(wa_id, "idle")
                         msg.body("Profile updated. Type START to continue.")
-                        logger.info(f"[{req_id}] ACK profile_grade_set")
+                        logger.info(f"[{req_id}] ACK profile_grade_set", extra=logpipe.HOT)
                     else:
                         msg.body("Please send a number like 6, 7, 8 or type SKIP.")
-                        logger.info(f"[{req_id}] ACK profile_grade_invalid")
+                        logger.info(f"[{req_id}] ACK profile_grade_invalid", extra=logpipe.HOT)
+                elif sess["stage"] == "choose_subject":
+                    subs = subjects_for(user["board"], user["grade"]) or ["English","Mathematics","Science","Social Science"]
+                    chosen = matching.match_subject(text, subs)
+                    if chosen:
+                        upsert_user(wa_id, subject=chosen, level=1)
+                        set_session(wa_id, "idle", 0, 0, None)
+                        msg.body(f"Subject set to *{chosen}*. Type START to begin.")
+                        logger.info(f"[{req_id}] ACK subject_set {chosen} from {text!r}", extra=logpipe.HOT)
+                    else:
+                        near = matching.subject_candidates(text, subs)
+                        msg.body((f"Did you mean {' or '.join(near)}? " if near else "") +
+                                 "Reply with the letter from the list, or type SUBJECT to see it again.")
+                        logger.info(f"[{req_id}] ACK subject_unclear {text!r}", extra=logpipe.HOT)
                 elif sess["stage"] == "quiz":
                     up1 = text.strip().upper()[:1]
                     if up1 in ("A","B","C","D"):
                         msg.body(process_ai_answer(user, sess, up1, req_id))
                     else:
                         msg.body("Please reply with A, B, C or D.")
-                        logger.info(f"[{req_id}] ACK quiz_invalid_char")
+                        logger.info(f"[{req_id}] ACK quiz_invalid_char", extra=logpipe.HOT)
                 else:
                     msg.body("👋 Hi! Type START to begin, or HELP for commands.")
-                    logger.info(f"[{req_id}] ACK default")
+                    logger.info(f"[{req_id}] ACK default", extra=logpipe.HOT)
             else:
                 msg.body("👋 Hi! Type START to begin, or HELP for commands.")
-                logger.info(f"[{req_id}] ACK default_no_session")
+                logger.info(f"[{req_id}] ACK default_no_session", extra=logpipe.HOT)
 
         return Response(str(resp), mimetype="application/xml")
 
@@ -668,7 +2332,15 @@ def create_app():
 def process_ai_answer(user, sess, answer, req_id=""):
     if answer not in ("A","B","C","D"):
         return "Please reply with A, B, C or D."
-
+    # one answer at a time per student, even across workers; the session is re-read
+    # under the lock so a concurrent answer is not scored twice
+    with state.lock(user["wa_id"]):
+        sess = get_session(user["wa_id"])
+        if not sess or sess["stage"] != "quiz":
+            return "Type START to begin a new session."
+        return _process_ai_answer(user, sess, answer)
+
+def _process_ai_answer(user, sess, answer):
     lesson = load_lesson(sess["lesson_id"])
     if not lesson:
         set_session(user["wa_id"], "idle", 0, 0, None)
@@ -680,7 +2352,8 @@ def process_ai_answer(user, sess, answer, req_id=""):
 
     q = qs[idx]; score = sess["score"]
     correct = (answer == q["ans"])
-    logger.info(f"[ANS] {user['wa_id']} answered {answer} (correct={correct}) at q_index={idx}")
+    logger.info(f"[ANS] {user['wa_id']} answered {answer} (correct={correct}) at q_index={idx}", extra=logpipe.HOT)
+    log_answer(sess, user["wa_id"], lesson["id"], idx, answer, correct)
 
     if correct:
         score += 1; result = "✅ Correct!"
@@ -689,13 +2362,7 @@ def process_ai_answer(user, sess, answer, req_id=""):
 
     idx += 1
     if idx >= len(qs):
-        record_history(user["wa_id"], lesson["subject_label"], lesson["level"], score, len(qs))
-        threshold = (len(qs) * 2) // 3  # >= 2/3 → level up
-        level = user["level"] or 1
-        new_level = level + 1 if score >= threshold else max(1, level - 1)
-        new_streak = (user["streak"] + 1) if score == len(qs) else 0
-        upsert_user(user["wa_id"], level=new_level, streak=new_streak)
-        set_session(user["wa_id"], "idle", 0, 0, None)
+        new_level, new_streak = complete_quiz(user["wa_id"], lesson, score, len(qs))
         return (
             f"{result}\n\n🎉 Quiz complete! You scored {score}/{len(qs)}.\n"
             f"Next time I'll set Level {new_level} for {lesson['subject_label']}.\n"
@@ -703,7 +2370,7 @@ def process_ai_answer(user, sess, answer, req_id=""):
             f"Type START to learn more, SUBJECT to switch topics, or STATS for your history."
         )
     else:
-        update_session(user["wa_id"], q_index=idx, score=score)
+        update_session(user["wa_id"], q_index=idx, score=score, q_sent_at=time.time())
         nq = qs[idx]
         return (
             f"{result}\n\nNext:\n"
@@ -715,9 +2382,20 @@ def process_ai_answer(user, sess, answer, req_id=""):
             f"Reply with A, B, C or D."
         )
 
+# ==================== DAILY BROADCAST ====================
+def start_broadcast():
+    # WhatsApp side of the daily topic push (see broadcast.py); only the process
+    # serving /whatsapp may send it, since it owns those students' sessions
+    if os.environ.get("BROADCAST_ENABLED", "0") != "1":
+        return
+    broadcast.register_channel("whatsapp", lambda lesson, level, lang: topic_message(lesson["title"], level, lesson["intro"]),
+                               send_whatsapp, rate=OUTBOX_RATE_PER_S, locked=run_locked)
+    broadcast.start(sys.modules[__name__])
+
 # ==================== MAIN ====================
 if __name__ == "__main__":
     load_dotenv()
     app = create_app()
+    start_broadcast()
     port = int(os.environ.get("PORT", "5000"))
     app.run(host="0.0.0.0", port=port, debug=bool(int(os.environ.get("DEBUG", "1"))))
@@ -0,0 +1,60 @@
+# bench_i18n.py
+# Per-message rendering cost in the Telegram adapter: the old t() (dict chain +
+# str.format on every call) against the compiled catalog, and freshly built
+# keyboards against the cached ones. Also prints what the catalog validation found.
+#   python benchmarks/bench_i18n.py [iterations]
+# Runs against a throwaway mvp.db in a temp dir; no network calls are made.
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("GOOGLE_API_KEY", "bench")
+os.environ.setdefault("SYLLABUS_DB", os.path.join(ROOT, "syllabus.db"))
+os.chdir(tempfile.mkdtemp(prefix="bench_i18n_"))
+os.makedirs("logs", exist_ok=True)
+
+import telegram_adapter as ta
+
+def legacy_t(key, lang, **kwargs):
+    lang = lang if lang in ta.CAT else "en"
+    return (ta.CAT[lang].get(key) or ta.CAT["en"].get(key, key)).format(**kwargs)
+
+def bench(label, fn, n):
+    fn()
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    us = (time.perf_counter() - start) / n * 1e6
+    print(f"  {label:<34} {us:8.2f} us/op")
+    return us
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    subs = ["Mathematics", "Science", "English", "Hindi", "Social Science"]
+    # the messages of a typical onboarding/lesson turn, with and without placeholders
+    def turn(t):
+        return lambda: (t("ASK_FIRST", "hi"), t("ASK_LAST", "mr", first="Asha"), t("WELCOME", "mr"),
+                        t("TOPIC", "hi", title="Fractions", level="Beginner", intro="..."), t("HELP", "en"))
+    cases = [
+        ("t(): legacy", turn(legacy_t), "t(): compiled", turn(ta.t)),
+        ("kb_boards: build", lambda: ta.kb_boards.__wrapped__("hi"), "kb_boards: cached", lambda: ta.kb_boards("hi")),
+        ("kb_states_page: build", lambda: ta.kb_states_page.__wrapped__("mr", 8), "kb_states_page: cached",
+         lambda: ta.kb_states_page("mr", 8)),
+        ("kb_subjects: build", lambda: ta._kb_subjects.__wrapped__(tuple(subs)), "kb_subjects: cached",
+         lambda: ta.kb_subjects(subs)),
+        ("kb_abcd: build", ta.kb_abcd.__wrapped__, "kb_abcd: cached", ta.kb_abcd),
+    ]
+    print(f"iterations: {n}")
+    for old_label, old, new_label, new in cases:
+        a = bench(old_label, old, n)
+        b = bench(new_label, new, n)
+        print(f"  {'':<34} x{a / b:.1f}")
+    print(f"catalog problems: {len(ta._i18n_problems)}")
+    for p in ta._i18n_problems:
+        print(f"  {p}")
+
+if __name__ == "__main__":
+    main()
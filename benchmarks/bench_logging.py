@@ -0,0 +1,92 @@
+# bench_logging.py
+# Latency that logging adds to one inbound message on the request path: the old
+# synchronous RotatingFileHandler + console setup against logpipe's queue pipeline,
+# with and without sampling, and again with a slow console (e.g. a piped terminal
+# or a loaded disk) to show that the queue keeps it off the caller's thread. Both
+# setups run at the same level, so only the handler path differs.
+#   python benchmarks/bench_logging.py [messages] [INFO|DEBUG]
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import logpipe
+
+class SlowStream:
+    # a console that takes ~200us per write
+    def __init__(self, delay=0.0002):
+        self.delay = delay
+        self.sink = open(os.devnull, "w")
+
+    def write(self, s):
+        time.sleep(self.delay)
+        return self.sink.write(s)
+
+    def flush(self):
+        pass
+
+def legacy(path, stream, level):
+    log = logging.getLogger(f"bench.legacy.{path}")
+    log.setLevel(level); log.propagate = False
+    fmt = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+    f = RotatingFileHandler(path, maxBytes=2_000_000, backupCount=3, encoding="utf-8")
+    f.setFormatter(fmt); log.addHandler(f)
+    c = logging.StreamHandler(stream); c.setFormatter(fmt); log.addHandler(c)
+    return log, None
+
+def piped(path, stream, level, sample=None):
+    log = logging.getLogger(f"bench.pipe.{path}")
+    saved, sys.stderr = sys.stderr, stream
+    try:
+        listener = logpipe.setup(log, path, level=level, sample=sample, max_queue=1_000_000)
+    finally:
+        sys.stderr = saved
+    return log, listener
+
+def one_message(log, i):
+    # what handle_whatsapp logs for an ordinary answer
+    req = f"{i:08x}"
+    logpipe.request_id.set(req)
+    log.info(f"[{req}] INBOUND from=whatsapp:+9198{i:08d} body='B'", extra=logpipe.HOT)
+    log.info(f"[ANS] whatsapp:+9198{i:08d} answered B (correct=True) at q_index=1", extra=logpipe.HOT)
+    log.info(f"[{req}] Q3 sent", extra=logpipe.HOT)
+    log.debug(f"[AI] Prompt for whatsapp:+9198{i:08d}:\n" + "x" * 400, extra=logpipe.HOT)
+
+def run(label, setup, n):
+    tmp = tempfile.mkdtemp(prefix="bench_logging_")
+    log, listener = setup(os.path.join(tmp, "app.log"))
+    for i in range(200):
+        one_message(log, i)
+    lat = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        one_message(log, i)
+        lat.append((time.perf_counter() - t0) * 1e6)
+    t0 = time.perf_counter()
+    if listener:
+        logpipe.stop(listener)   # drain: the work moved off the request path, not away
+    drain = (time.perf_counter() - t0) * 1e3
+    lat.sort()
+    print(f"  {label:<28} mean {statistics.fmean(lat):8.1f}us  p50 {lat[len(lat) // 2]:8.1f}us  "
+          f"p99 {lat[int(len(lat) * 0.99)]:8.1f}us  drain {drain:7.1f}ms")
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    name = sys.argv[2].upper() if len(sys.argv) > 2 else "INFO"
+    level = logging.getLevelName(name)
+    null = open(os.devnull, "w")
+    print(f"per-message logging latency, {n} messages, level {name}")
+    run("sync (before)", lambda p: legacy(p, null, level), n)
+    run("queue (after)", lambda p: piped(p, null, level), n)
+    run("queue + 10% INFO sampling", lambda p: piped(p, null, level, {logging.INFO: 0.1}), n)
+    print("slow console")
+    run("sync (before)", lambda p: legacy(p, SlowStream(), level), n)
+    run("queue (after)", lambda p: piped(p, SlowStream(), level), n)
+
+if __name__ == "__main__":
+    main()
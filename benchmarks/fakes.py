@@ -0,0 +1,197 @@
+# fakes.py
+# Local stand-ins for the outside services, for load tests (see loadtest.py):
+#   FakeGemini          - generate_content() with a latency/error profile; returns
+#                         schema-valid lessons (and echoes lessons back for translation)
+#   FakeTwilioServer    - Twilio's Messages REST endpoint on localhost; point a real
+#                         twilio Client at it with LocalTwilioHttpClient
+#   FakeBotRequest      - PTB request backend answering Bot API calls locally
+#   TelegramUpdates     - builds Update objects (messages and button taps) for a chat
+# Everything random is drawn from seeded generators, so a run is repeatable given the
+# same seed and concurrency.
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from telegram import Update
+from telegram.request import BaseRequest
+from twilio.http.http_client import TwilioHttpClient
+
+# ---------- Gemini ----------
+class FakeGeminiError(Exception):
+    pass
+
+class FakeGemini:
+    # latency: median seconds; jitter: lognormal sigma; error_rate / slow_rate: fraction
+    # of calls that raise / take slow_factor times longer
+
+    def __init__(self, latency=0.8, jitter=0.3, error_rate=0.0, slow_rate=0.0, slow_factor=10.0, seed=1):
+        self.latency, self.jitter = latency, jitter
+        self.error_rate, self.slow_rate, self.slow_factor = error_rate, slow_rate, slow_factor
+        self.seed = seed
+        self._lock = threading.Lock()
+        self.calls = self.errors = 0
+
+    def generate_content(self, prompt, **kwargs):
+        with self._lock:
+            n = self.calls = self.calls + 1
+        rng = random.Random(f"{self.seed}:{n}")
+        delay = self.latency * rng.lognormvariate(0, self.jitter) if self.latency else 0
+        if rng.random() < self.slow_rate:
+            delay *= self.slow_factor
+        time.sleep(delay)
+        if rng.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            raise FakeGeminiError("503 The model is overloaded. Please try again later.")
+        if prompt.startswith("Translate"):
+            text = prompt.split("\n\n", 1)[1]
+        else:
+            text = json.dumps(self.lesson(n, rng), ensure_ascii=False)
+        usage = SimpleNamespace(prompt_token_count=len(prompt) // 4, candidates_token_count=len(text) // 4)
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+    @staticmethod
+    def lesson(n, rng):
+        # titles differ per call so the near-duplicate check does not ask again
+        topic = rng.choice(["Fractions", "Photosynthesis", "Magnetism", "Democracy", "Tenses", "Ratios"])
+        return {
+            "title": f"{topic} part {n}",
+            "intro": [f"{topic} is part {n} of today's plan.", "Read carefully, then try the quiz."],
+            "questions": [{"q": f"Question {i + 1} on {topic}?",
+                           "options": [f"{l}) option {l}" for l in "ABCD"],
+                           "ans": rng.choice("ABCD"),
+                           "explain": "Because the lesson says so."} for i in range(3)],
+        }
+
+# ---------- Twilio ----------
+class FakeTwilioServer:
+    # POST /2010-04-01/Accounts/<sid>/Messages.json -> 201 with a message sid.
+    # error_rate of requests get a 429 (Twilio's "too many requests")
+
+    def __init__(self, latency=0.05, error_rate=0.0, seed=1, port=0):
+        self.latency, self.error_rate = latency, error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.messages = []      # (to, body)
+        self.rejected = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode())
+                with fake.lock:
+                    fail = fake.rng.random() < fake.error_rate
+                    if fail:
+                        fake.rejected += 1
+                    else:
+                        fake.messages.append((form.get("To", [""])[0], form.get("Body", [""])[0]))
+                        n = len(fake.messages)
+                time.sleep(fake.latency)
+                if fail:
+                    self._reply(429, {"code": 20429, "message": "Too Many Requests", "status": 429})
+                else:
+                    self._reply(201, {"sid": f"SM{n:032x}", "status": "queued", "to": form.get("To", [""])[0],
+                                      "body": form.get("Body", [""])[0]})
+
+            def _reply(self, code, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name="fake-twilio", daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+class LocalTwilioHttpClient(TwilioHttpClient):
+    # the real twilio Client, with api.twilio.com swapped for a local base URL
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(pool_connections=True, timeout=15, **kwargs)
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, url.replace("https://api.twilio.com", self.base_url), *args, **kwargs)
+
+# ---------- Telegram ----------
+class FakeBotRequest(BaseRequest):
+    # Bot API answered locally after `latency` seconds; sent texts are counted per method
+
+    def __init__(self, latency=0.03):
+        self.latency = latency
+        self.calls = {}
+        self._mid = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        api = url.rsplit("/", 1)[-1]
+        self.calls[api] = self.calls.get(api, 0) + 1
+        params = request_data.parameters if request_data else {}
+        if api == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Owl", "username": "btrlrn_load_bot"}
+        elif api in ("sendMessage", "editMessageText", "sendPhoto"):
+            self._mid += 1
+            chat_id = params.get("chat_id", 0)
+            result = {"message_id": params.get("message_id", self._mid), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+class TelegramUpdates:
+    # Update objects for simulated students, bound to a Bot using FakeBotRequest
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_id = 0
+        self._message_id = 0
+
+    def _ids(self):
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    def _chat(self, chat_id):
+        return {"id": chat_id, "type": "private", "first_name": f"Student{chat_id}"}
+
+    def message(self, chat_id, text):
+        uid, mid = self._ids()
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+        return Update.de_json({"update_id": uid, "message": {
+            "message_id": mid, "date": int(time.time()), "chat": self._chat(chat_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"Student{chat_id}"},
+            "text": text, "entities": entities}}, self.bot)
+
+    def button(self, chat_id, data):
+        uid, mid = self._ids()
+        return Update.de_json({"update_id": uid, "callback_query": {
+            "id": f"cb{uid}", "chat_instance": str(chat_id), "data": data,
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"Student{chat_id}"},
+            "message": {"message_id": mid, "date": int(time.time()), "chat": self._chat(chat_id),
+                        "text": "…"}}}, self.bot)
@@ -0,0 +1,263 @@
+# loadtest.py
+# Drives the WhatsApp webhook and the Telegram handlers with simulated students going
+# onboarding -> START -> QUIZ, against a throwaway mvp.db and the local stand-ins in
+# fakes.py (no Gemini key, Twilio account, Telegram token or network needed).
+#   python benchmarks/loadtest.py --students 2000 --tg-students 200 --concurrency 32
+#   python benchmarks/loadtest.py --gemini-latency 1.5 --gemini-errors 0.05 --twilio-errors 0.02
+# WhatsApp students post to /whatsapp from a thread pool; Telegram students run as
+# asyncio tasks through the same per_user-wrapped handlers the bot registers. Both
+# run at once, sharing the DB. Reports throughput, p50/p99/max latency per step,
+# "database is locked" errors and what the fakes saw.
+import argparse
+import asyncio
+import logging
+import os
+import random
+import runpy
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CITIES = [("Pune", "Maharashtra"), ("Nagpur", "Maharashtra"), ("Bengaluru", "Karnataka"), ("Jaipur", "Rajasthan"),
+          ("Lucknow", "Uttar Pradesh"), ("Patna", "Bihar"), ("Chennai", "Tamil Nadu"), ("Indore", "Madhya Pradesh")]
+FIRST = ["Asha", "Ravi", "Meera", "Arjun", "Zoya", "Kabir", "Isha", "Vikram"]
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}     # (channel, step) -> [seconds]
+        self.errors = {}      # (channel, step) -> count
+        self.messages = {}    # channel -> count
+        self.students = {}    # channel -> finished scripts
+
+    def record(self, channel, step, seconds, ok=True):
+        with self.lock:
+            self.samples.setdefault((channel, step), []).append(seconds)
+            if not ok:
+                self.errors[(channel, step)] = self.errors.get((channel, step), 0) + 1
+            if step != "lesson_ready":
+                self.messages[channel] = self.messages.get(channel, 0) + 1
+
+    def done(self, channel):
+        with self.lock:
+            self.students[channel] = self.students.get(channel, 0) + 1
+
+class LockErrors(logging.Handler):
+    # counts "database is locked" wherever the app reports it
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.other = 0
+
+    def emit(self, record):
+        text = f"{record.getMessage()} {record.exc_text or ''}"
+        if record.exc_info and record.exc_info[1] is not None:
+            text += str(record.exc_info[1])
+        if "database is locked" in text:
+            self.count += 1
+        elif record.levelno >= logging.ERROR:
+            self.other += 1
+
+# ---------- WhatsApp ----------
+def whatsapp_student(engine, flask_app, stats, i, seed, lesson_timeout):
+    client = flask_app.test_client()
+    wa = f"whatsapp:+9170{i:08d}"
+    rng = random.Random(f"{seed}:wa:{i}")
+    city, state = rng.choice(CITIES)
+    n = [0]
+
+    def say(body, step):
+        n[0] += 1
+        t0 = time.perf_counter()
+        r = client.post("/whatsapp", data={"From": wa, "Body": body, "MessageSid": f"SMload{i}x{n[0]}"})
+        stats.record("whatsapp", step, time.perf_counter() - t0, r.status_code == 200)
+
+    for body in ["hi", rng.choice(FIRST), "Kumar", "2012-04-25", city, state]:
+        say(body, "onboard")
+    if engine.get_session(wa)["stage"] == "ask_board":   # Maharashtra goes straight to SSC
+        say("A", "onboard")
+    say(str(rng.randint(6, 10)), "onboard")
+    say("SUBJECT", "subject")
+    say("A", "subject")
+    say("START", "start")
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < lesson_timeout:
+        sess = engine.get_session(wa)
+        if sess and sess["stage"] == "lesson" and sess["lesson_id"]:
+            break
+        if wa not in engine.generating._keys and time.perf_counter() - t0 > 0.05:
+            break   # generation ended without a lesson (model error)
+        time.sleep(0.02)
+    sess = engine.get_session(wa)
+    ready = bool(sess and sess["stage"] == "lesson")
+    stats.record("whatsapp", "lesson_ready", time.perf_counter() - t0, ready)
+    if not ready:
+        return
+    say("QUIZ", "quiz")
+    for _ in range(3):
+        say(rng.choice("ABCD"), "answer")
+    stats.done("whatsapp")
+
+def run_whatsapp(engine, flask_app, stats, args):
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        futures = [pool.submit(whatsapp_student, engine, flask_app, stats, i, args.seed, args.lesson_timeout)
+                   for i in range(args.students)]
+        for f in futures:
+            try:
+                f.result()
+            except Exception as e:
+                stats.record("whatsapp", "script", 0.0, False)
+                logging.getLogger("loadtest").warning(f"whatsapp student failed: {e!r}")
+
+# ---------- Telegram ----------
+async def telegram_student(ta, handlers, updates, ctx, stats, i, seed):
+    chat = 50_000_000 + i
+    rng = random.Random(f"{seed}:tg:{i}")
+    city, _ = rng.choice(CITIES)
+    # state board, confirming the state guessed from the city: the CBSE/ICSE buttons
+    # never ask for the state, which profile_missing_for_flow() then wants
+    script = [("msg", "/start", "onboard"), ("btn", "LANG:en", "onboard"), ("msg", rng.choice(FIRST), "onboard"),
+              ("msg", "Kumar", "onboard"), ("msg", "25-04-2012", "onboard"), ("msg", city, "onboard"),
+              ("btn", "BOARD:STATE", "onboard"), ("btn", "YN:Y", "onboard"),
+              ("btn", f"GRADE:{rng.randint(6, 10)}", "onboard"), ("btn", "SUBJ:0", "start"), ("msg", "QUIZ", "quiz")]
+    for q in range(3):
+        script.append(("btn", f"ANS:{rng.choice('ABCD')}:{q}", "answer"))
+        if q < 2:
+            script.append(("btn", "NEXTQ", "quiz"))
+    for kind, data, step in script:
+        if kind == "btn":
+            update, handler = updates.button(chat, data), handlers["button"]
+        else:
+            update = updates.message(chat, data)
+            handler = handlers["start"] if data == "/start" else handlers["text"]
+        t0 = time.perf_counter()
+        ok = True
+        try:
+            await handler(update, ctx)
+        except Exception as e:
+            ok = False
+            logging.getLogger("loadtest").warning(f"telegram {data!r} failed: {e!r}")
+        stats.record("telegram", step, time.perf_counter() - t0, ok)
+    stats.done("telegram")
+
+async def run_telegram(ta, stats, args, bot_latency):
+    from telegram import Bot
+    from fakes import FakeBotRequest, TelegramUpdates
+    req = FakeBotRequest(bot_latency)
+    bot = Bot("123456:LOADTEST", request=req, get_updates_request=FakeBotRequest(bot_latency))
+    await bot.initialize()
+    updates = TelegramUpdates(bot)
+    ctx = SimpleNamespace(bot=bot)
+    handlers = {"start": ta.per_user(ta.start_cmd), "text": ta.per_user(ta.text_handler),
+                "button": ta.per_user(ta.on_button)}
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        async with sem:
+            await telegram_student(ta, handlers, updates, ctx, stats, i, args.seed)
+    await asyncio.gather(*(one(i) for i in range(args.tg_students)))
+    return req.calls
+
+# ---------- report ----------
+def pct(xs, p):
+    return xs[min(len(xs) - 1, max(0, int(round(p / 100 * len(xs) + 0.5)) - 1))] if xs else 0.0
+
+def report(stats, wall, extra):
+    print(f"\nwall time {wall:.1f}s")
+    for ch in sorted(stats.messages):
+        print(f"{ch:<9} scripts finished {stats.students.get(ch, 0):>6}   messages {stats.messages[ch]:>7}   "
+              f"throughput {stats.messages[ch] / wall:8.1f} msg/s")
+    print(f"\n{'channel':<9} {'step':<13} {'n':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7}")
+    for (ch, step), xs in sorted(stats.samples.items()):
+        xs = sorted(xs)
+        print(f"{ch:<9} {step:<13} {len(xs):>7} {pct(xs, 50) * 1e3:>9.1f} {pct(xs, 99) * 1e3:>9.1f} "
+              f"{xs[-1] * 1e3:>9.1f} {stats.errors.get((ch, step), 0):>7}")
+    print()
+    for k, v in extra.items():
+        print(f"{k:<28} {v}")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1] if __doc__ else None)
+    ap.add_argument("--students", type=int, default=1000, help="WhatsApp students")
+    ap.add_argument("--tg-students", type=int, default=200, help="Telegram students")
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--gemini-latency", type=float, default=0.2, help="median seconds per Gemini call")
+    ap.add_argument("--gemini-jitter", type=float, default=0.3)
+    ap.add_argument("--gemini-errors", type=float, default=0.0, help="fraction of Gemini calls that fail")
+    ap.add_argument("--gemini-slow", type=float, default=0.0, help="fraction of Gemini calls 10x slower")
+    ap.add_argument("--twilio-latency", type=float, default=0.05)
+    ap.add_argument("--twilio-errors", type=float, default=0.0, help="fraction of sends answered 429")
+    ap.add_argument("--telegram-latency", type=float, default=0.03)
+    ap.add_argument("--lesson-timeout", type=float, default=60.0)
+    ap.add_argument("--drain", type=float, default=30.0, help="seconds to wait for the outbox to empty")
+    ap.add_argument("--workdir", help="where mvp.db and logs/ go (default: a new temp dir)")
+    args = ap.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="btrlrn_load_")
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+    os.chdir(workdir)
+    for k, v in {"SYLLABUS_DB": os.path.join(ROOT, "syllabus.db"), "GEOCODE_REMOTE": "0",
+                 "LOG_LEVEL": "WARNING", "OUTBOX_RATE_PER_S": "200", "TWILIO_ACCOUNT_SID": "AC" + "0" * 32,
+                 "TWILIO_AUTH_TOKEN": "loadtest", "BROADCAST_ENABLED": "0", "METRICS_PORT": "0"}.items():
+        os.environ.setdefault(k, v)
+
+    from twilio.rest import Client
+    from fakes import FakeGemini, FakeTwilioServer, LocalTwilioHttpClient
+    import app as engine
+
+    gemini = FakeGemini(args.gemini_latency, args.gemini_jitter, args.gemini_errors, args.gemini_slow, seed=args.seed)
+    twilio_server = FakeTwilioServer(args.twilio_latency, args.twilio_errors, seed=args.seed)
+    twilio = Client(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"],
+                    http_client=LocalTwilioHttpClient(twilio_server.url))
+    flask_app = engine.create_app(gemini=gemini, twilio=twilio)
+    with redirect_stdout(None):   # users.first_seen/last_seen, which the Telegram adapter writes
+        runpy.run_path(os.path.join(ROOT, "migrate_users_seen.py"))
+    import telegram_adapter as ta    # its create_app() keeps the injected clients
+
+    lock_errors = LockErrors()
+    for name in ("whatsapp_mvp", flask_app.logger.name):
+        logging.getLogger(name).addHandler(lock_errors)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    stats = Stats()
+    print(f"workdir {workdir}: {args.students} WhatsApp + {args.tg_students} Telegram students, "
+          f"concurrency {args.concurrency}, seed {args.seed}")
+    start = time.perf_counter()
+    wa_thread = threading.Thread(target=run_whatsapp, args=(engine, flask_app, stats, args))
+    wa_thread.start()
+    tg_calls = asyncio.run(run_telegram(ta, stats, args, args.telegram_latency)) if args.tg_students else {}
+    wa_thread.join()
+    wall = time.perf_counter() - start
+
+    deadline = time.time() + args.drain
+    while time.time() < deadline and engine._outbox_depth():
+        time.sleep(0.2)
+    engine.state.flush()
+    conn = engine.db(); cur = conn.cursor()
+    cur.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+    outbox = dict(cur.fetchall())
+    cur.execute("SELECT COUNT(DISTINCT wa_id) FROM history")
+    finished_quiz = cur.fetchone()[0]
+    conn.close()
+    report(stats, wall, {
+        "database is locked errors": lock_errors.count,
+        "other logged errors": lock_errors.other,
+        "students with a quiz result": finished_quiz,
+        "gemini calls / errors": f"{gemini.calls} / {gemini.errors}",
+        "twilio messages / 429s": f"{len(twilio_server.messages)} / {twilio_server.rejected}",
+        "outbox by status": outbox,
+        "telegram api calls": tg_calls,
+    })
+    twilio_server.stop()
+
+if __name__ == "__main__":
+    main()
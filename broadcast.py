@@ -0,0 +1,436 @@
+# broadcast.py
+# Daily "topic of the day" push at each student's preferred time (users.daily_time,
+# "HH:MM" IST, set with DAILY HH:MM). Each process registers the channel it sends on
+# (app.py: whatsapp, telegram_adapter.py: telegram) and runs two jobs once a minute,
+# prepare_tick() (plan, generate) and send_tick() (send):
+#   plan     - LEAD_MIN before a 15-minute slot, one run per (day, slot, channel) lists
+#              the students due in it (empty slots get no run) and groups them by
+#              syllabus board/grade/subject/level; a group teaches the topic most of
+#              its students are due for next
+#   generate - one lesson per group (not per student), GEN_CONCURRENCY at a time, then
+#              one translation of it per other language its students use
+#   send     - from the slot start, each student gets their own lessons row pointing
+#              at the group's shared body and is messaged through the channel's
+#              rate-limited sender, CHUNK students per transaction. Students in the
+#              middle of something (a quiz, onboarding, a profile edit) are skipped.
+# A long send therefore does not hold up planning and generating the slots behind
+# it. Runs, groups and items are SQLite rows, so a restart resumes where
+# it stopped, and a lease on the run keeps two workers of one channel from sending it
+# twice.
+import calendar
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+engine = None    # the app module, set by start(); app.py may be running as __main__
+
+SLOT_MIN = 15
+LEAD_MIN = int(os.environ.get("BROADCAST_LEAD_MIN", "45"))
+GEN_CONCURRENCY = int(os.environ.get("BROADCAST_GEN_CONCURRENCY", "4"))
+GEN_MAX_ATTEMPTS = 3
+CHUNK = 200
+LEASE_S = 120
+QUIET_STAGES = ("idle", "lesson")   # nothing in progress that the daily lesson would cut into
+
+_channels = {}   # name -> Channel
+_prepare_lock = threading.Lock()
+_send_lock = threading.Lock()
+
+def _unlocked(wa_id, fn):
+    return fn()
+
+class Channel:
+    # render(lesson, level, lang) -> text; send(wa_id, text) raises on failure;
+    # translate(lesson, lang) -> lesson; locked(wa_id, fn) runs fn under the lock the
+    # channel's inbound handlers take for that student; rate (msg/s) is only used to
+    # warn when a slot cannot be sent inside its window
+    def __init__(self, name, render, send, translate=None, rate=10.0, locked=None):
+        self.name, self.render, self.send, self.translate, self.rate = name, render, send, translate, rate
+        self.locked = locked or _unlocked
+
+def register_channel(name, render, send, translate=None, rate=10.0, locked=None):
+    _channels[name] = Channel(name, render, send, translate, rate, locked)
+
+def init_tables():
+    conn = engine.db(); cur = conn.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS broadcast_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        day TEXT,
+        slot TEXT,              -- 'HH:MM' IST, start of the 15-minute bucket
+        channel TEXT,
+        status TEXT,            -- planning, generating, sending, done
+        students INTEGER DEFAULT 0,
+        lease_until REAL,
+        created_at REAL,
+        finished_at REAL,
+        UNIQUE (day, slot, channel)
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS broadcast_groups (
+        run_id INTEGER,
+        group_key TEXT,         -- JSON [board, grade, subject, level, lang]
+        status TEXT,            -- pending, generating, ready, failed
+        attempts INTEGER DEFAULT 0,
+        title TEXT,
+        body_hash TEXT,
+        updated_at REAL,
+        topic TEXT,
+        PRIMARY KEY (run_id, group_key)
+    )""")
+    if "topic" not in {r[1] for r in cur.execute("PRAGMA table_info(broadcast_groups)").fetchall()}:
+        cur.execute("ALTER TABLE broadcast_groups ADD COLUMN topic TEXT")
+    cur.execute("""CREATE TABLE IF NOT EXISTS broadcast_items (
+        run_id INTEGER,
+        wa_id TEXT,
+        board TEXT,             -- users.board, copied onto the lessons row
+        group_key TEXT,
+        status TEXT,            -- pending, sending, sent, skipped, failed
+        lesson_id INTEGER,
+        error TEXT,
+        PRIMARY KEY (run_id, wa_id)
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_items_status ON broadcast_items(run_id, status)")
+    conn.commit(); conn.close()
+
+def parse_daily_time(text):
+    # '7:30', '07.30', '1930', '7' -> 'HH:MM', else None
+    t = (text or "").strip().replace(".", ":")
+    if ":" not in t:
+        t = f"{t[:-2]}:{t[-2:]}" if len(t) > 2 else f"{t}:00"
+    try:
+        h, m = (int(x) for x in t.split(":"))
+    except ValueError:
+        return None
+    return f"{h:02d}:{m:02d}" if 0 <= h < 24 and 0 <= m < 60 else None
+
+def slot_epoch(day, slot):
+    return calendar.timegm(time.strptime(f"{day} {slot}", "%Y-%m-%d %H:%M")) - engine.IST_OFFSET
+
+def upcoming_slots(now):
+    # (day, slot) from the current slot up to LEAD_MIN ahead
+    step = SLOT_MIN * 60
+    t = (int(now + engine.IST_OFFSET) // step) * step - engine.IST_OFFSET
+    out = []
+    while t <= now + LEAD_MIN * 60:
+        ist = time.gmtime(t + engine.IST_OFFSET)
+        out.append((time.strftime("%Y-%m-%d", ist), time.strftime("%H:%M", ist)))
+        t += step
+    return out
+
+def parse_key(key):
+    # (board, grade, subject, level, lang); runs planned before the topic moved out of
+    # the key have it in fifth place
+    k = json.loads(key)
+    return tuple(k[:4]) + (k[-1],)
+
+def base_key(key):
+    # the English group a translated one is made from
+    return json.dumps(list(parse_key(key)[:4]) + ["en"], ensure_ascii=False)
+
+# ---------- plan ----------
+def plan(channel, day, slot):
+    conn = engine.db(); cur = conn.cursor()
+    h, m = (int(x) for x in slot.split(":"))
+    times = [f"{h:02d}:{mm:02d}" for mm in range(m, m + SLOT_MIN)]
+    cur.execute(f"""SELECT wa_id, board, grade, subject, state, language FROM users
+                    WHERE daily_time IN ({",".join("?" * len(times))}) AND wa_id LIKE ?
+                      AND subject IS NOT NULL AND grade IS NOT NULL""",
+                (*times, f"{channel.name}:%"))
+    users = cur.fetchall()
+    if not users:   # nobody in this slot (yet): no run
+        conn.close(); return None
+    now = time.time()
+    cur.execute("INSERT OR IGNORE INTO broadcast_runs (day, slot, channel, status, created_at) VALUES (?,?,?,'planning',?)",
+                (day, slot, channel.name, now))
+    if cur.rowcount:
+        run_id = cur.lastrowid
+    else:
+        # already planned, unless a worker died while planning it (inserts below are idempotent)
+        cur.execute("""UPDATE broadcast_runs SET created_at=? WHERE day=? AND slot=? AND channel=?
+                       AND status='planning' AND created_at<?""", (now, day, slot, channel.name, now - 600))
+        if not cur.rowcount:
+            conn.close(); return None
+        cur.execute("SELECT id FROM broadcast_runs WHERE day=? AND slot=? AND channel=?", (day, slot, channel.name))
+        run_id = cur.fetchone()[0]
+    conn.commit()   # do not hold the write lock while the students are grouped
+    items, topics = [], {}   # base key -> Counter of the members' next topics
+    for u in users:
+        level = engine.get_subject_level(u["wa_id"], u["subject"])
+        lang = (u["language"] or "en") if channel.translate else "en"
+        base = [engine.syllabus_board(u["board"], u["state"]) or u["board"], u["grade"], u["subject"], level]
+        topics.setdefault(json.dumps(base + ["en"], ensure_ascii=False), Counter())[
+            engine.next_topic(u["wa_id"], u["board"], u["grade"], u["subject"], state=u["state"])] += 1
+        items.append((run_id, u["wa_id"], u["board"], json.dumps(base + [lang], ensure_ascii=False)))
+    groups = {k: topics[base_key(k)].most_common(1)[0][0] for k in {i[3] for i in items} | topics.keys()}
+    cur.executemany("INSERT OR IGNORE INTO broadcast_items (run_id, wa_id, board, group_key, status) VALUES (?,?,?,?,'pending')", items)
+    cur.executemany("INSERT OR IGNORE INTO broadcast_groups (run_id, group_key, status, updated_at, topic) VALUES (?,?,'pending',?,?)",
+                    [(run_id, k, time.time(), t) for k, t in groups.items()])
+    cur.execute("UPDATE broadcast_runs SET students=?, status='generating' WHERE id=?", (len(items), run_id))
+    conn.commit(); conn.close()
+    engine.logger.info(f"[BCAST] planned run={run_id} {channel.name} {day} {slot}: {len(items)} students, {len(groups)} lessons")
+    need_s = len(items) / channel.rate
+    if need_s > SLOT_MIN * 60:
+        engine.logger.warning(f"[BCAST] run={run_id} needs ~{need_s / 60:.0f} min at {channel.rate}/s, "
+                              f"longer than the {SLOT_MIN} min slot")
+    return run_id
+
+# ---------- generate ----------
+def _generate_group(channel, run_id, key, topic):
+    board, grade, subject, level, lang = parse_key(key)
+    try:
+        if lang == "en":
+            lesson = engine.ai_generate_lesson(board=board, grade=grade, subject_label=subject, level=level,
+                                               city=None, state=None, topic=topic)
+        else:
+            conn = engine.db(); cur = conn.cursor()
+            cur.execute("SELECT title, body_hash FROM broadcast_groups WHERE run_id=? AND group_key=?", (run_id, base_key(key)))
+            base = cur.fetchone(); conn.close()
+            intro, questions = engine.lesson_body(base["body_hash"])
+            lesson = channel.translate({"title": base["title"], "intro": intro, "questions": questions}, lang)
+        conn = engine.db(); cur = conn.cursor()
+        body_hash = engine.store_lesson_body(cur, lesson["intro"], lesson["questions"])
+        cur.execute("""UPDATE broadcast_groups SET status='ready', title=?, body_hash=?, updated_at=?
+                       WHERE run_id=? AND group_key=?""", (lesson["title"], body_hash, time.time(), run_id, key))
+        conn.commit(); conn.close()
+    except Exception as e:
+        engine.logger.error(f"[BCAST] generation failed run={run_id} group={key}: {e}")
+        conn = engine.db()
+        conn.execute("""UPDATE broadcast_groups SET attempts=attempts+1, updated_at=?,
+                            status=CASE WHEN attempts+1 >= ? THEN 'failed' ELSE 'pending' END
+                        WHERE run_id=? AND group_key=?""", (time.time(), GEN_MAX_ATTEMPTS, run_id, key))
+        conn.commit(); conn.close()
+
+def _claim_groups(conn, run_id, translations):
+    # pending English groups, or translations whose English group is done (a failed
+    # one fails its translations too); [(key, topic)]
+    cur = conn.cursor()
+    now = time.time()
+    cur.execute("SELECT group_key, status, topic FROM broadcast_groups WHERE run_id=?", (run_id,))
+    rows = {r["group_key"]: r for r in cur.fetchall()}
+    claimed = []
+    for k, r in rows.items():
+        if r["status"] != "pending" or (parse_key(k)[4] != "en") != translations:
+            continue
+        status = "generating"
+        if translations:
+            base = rows.get(base_key(k))
+            if base is None or base["status"] == "failed":
+                status = "failed"
+            elif base["status"] != "ready":
+                continue
+        cur.execute("UPDATE broadcast_groups SET status=?, updated_at=? WHERE run_id=? AND group_key=? AND status='pending'",
+                    (status, now, run_id, k))
+        if cur.rowcount and status == "generating":
+            claimed.append((k, r["topic"]))
+    conn.commit()
+    return claimed
+
+def generate(channel, run_id):
+    # True once every group is ready or failed
+    conn = engine.db(); cur = conn.cursor()
+    # groups left in 'generating' by a crashed worker are retried
+    cur.execute("UPDATE broadcast_groups SET status='pending' WHERE run_id=? AND status='generating' AND updated_at<?",
+                (run_id, time.time() - 600))
+    conn.commit()
+    for translations in (False, True):
+        claimed = _claim_groups(conn, run_id, translations)
+        if claimed:
+            with ThreadPoolExecutor(max_workers=GEN_CONCURRENCY) as pool:
+                list(pool.map(lambda kt: _generate_group(channel, run_id, *kt), claimed))
+    cur.execute("SELECT COUNT(*) FROM broadcast_groups WHERE run_id=? AND status IN ('pending','generating')", (run_id,))
+    left = cur.fetchone()[0]
+    conn.close()
+    return left == 0
+
+# ---------- send ----------
+def _lease(cur, run_id, take=False):
+    now = time.time()
+    if take:
+        cur.execute("UPDATE broadcast_runs SET lease_until=? WHERE id=? AND (lease_until IS NULL OR lease_until<?)",
+                    (now + LEASE_S, run_id, now))
+        return cur.rowcount == 1
+    cur.execute("UPDATE broadcast_runs SET lease_until=? WHERE id=?", (now + LEASE_S, run_id))
+    return True
+
+def send(channel, run_id):
+    conn = engine.db(); cur = conn.cursor()
+    if not _lease(cur, run_id, take=True):
+        conn.close(); return False
+    cur.execute("UPDATE broadcast_runs SET status='sending' WHERE id=?", (run_id,))
+    # items a crashed worker had claimed are sent again, reusing the lesson it created
+    cur.execute("UPDATE broadcast_items SET status='pending' WHERE run_id=? AND status='sending'", (run_id,))
+    conn.commit()
+    cur.execute("SELECT group_key, status, title, body_hash, topic FROM broadcast_groups WHERE run_id=?", (run_id,))
+    groups = {r["group_key"]: r for r in cur.fetchall()}
+    while True:
+        cur.execute("SELECT wa_id, board, group_key, lesson_id FROM broadcast_items WHERE run_id=? AND status='pending' LIMIT ?",
+                    (run_id, CHUNK))
+        items = cur.fetchall()
+        if not items:
+            break
+        # 1) claim the chunk and create its lessons rows in one short transaction
+        done, todo = [], []
+        for it in items:
+            g = groups.get(it["group_key"])
+            _, grade, subject, level, lang = parse_key(it["group_key"])
+            if not g or g["status"] != "ready":
+                done.append(("failed", None, "lesson generation failed", run_id, it["wa_id"])); continue
+            sess = engine.get_session(it["wa_id"])
+            if sess and sess["stage"] not in QUIET_STAGES:   # do not cut into a quiz or onboarding
+                done.append(("skipped", None, f"busy: {sess['stage']}", run_id, it["wa_id"])); continue
+            lesson_id = it["lesson_id"]
+            if not lesson_id:
+                cur.execute("""INSERT INTO lessons (wa_id, board, grade, subject_label, level, title, body_hash, created_at, topic)
+                               VALUES (?,?,?,?,?,?,?,?,?)""",
+                            (it["wa_id"], it["board"], grade, subject, level, g["title"], g["body_hash"], int(time.time()), g["topic"]))
+                lesson_id = cur.lastrowid
+                done.append(("sending", lesson_id, None, run_id, it["wa_id"]))
+            todo.append((it["wa_id"], g, subject, level, lang, lesson_id))
+        cur.executemany("UPDATE broadcast_items SET status=?, lesson_id=?, error=? WHERE run_id=? AND wa_id=?", done)
+        _lease(cur, run_id)
+        conn.commit()
+        # 2) send outside the transaction (the WhatsApp sender writes to the outbox)
+        results = []
+        for wa_id, g, subject, level, lang, lesson_id in todo:
+            intro, _ = engine.lesson_body(g["body_hash"])
+            try:
+                channel.send(wa_id, channel.render({"title": g["title"], "intro": intro}, level, lang))
+            except Exception as e:
+                engine.logger.warning(f"[BCAST] send failed run={run_id} to={wa_id}: {e}")
+                results.append(("failed", str(e)[:300], run_id, wa_id)); continue
+            channel.locked(wa_id, lambda: _start_lesson(wa_id, lesson_id))
+            engine.lesson_similarity.add((wa_id, subject), lesson_id, engine.lesson_text(g["title"], intro))
+            results.append(("sent", None, run_id, wa_id))
+        cur.executemany("UPDATE broadcast_items SET status=?, error=? WHERE run_id=? AND wa_id=?", results)
+        _lease(cur, run_id)
+        conn.commit()   # progress is durable per chunk
+    cur.execute("SELECT status, COUNT(*) FROM broadcast_items WHERE run_id=? GROUP BY status", (run_id,))
+    counts = dict(cur.fetchall())
+    cur.execute("UPDATE broadcast_runs SET status='done', finished_at=?, lease_until=NULL WHERE id=?", (time.time(), run_id))
+    conn.commit(); conn.close()
+    engine.logger.info(f"[BCAST] run={run_id} {channel.name} done: {counts}")
+    return True
+
+def _start_lesson(wa_id, lesson_id):
+    # under the student's lock: they may have started a quiz or a profile edit since
+    sess = engine.get_session(wa_id)
+    if not sess or sess["stage"] in QUIET_STAGES:
+        engine.set_session(wa_id, "lesson", 0, 0, lesson_id)
+
+def _open_runs(channel, statuses):
+    conn = engine.db(); cur = conn.cursor()
+    cur.execute(f"""SELECT id, day, slot FROM broadcast_runs WHERE channel=?
+                    AND status IN ({",".join("?" * len(statuses))})""", (channel.name, *statuses))
+    runs = cur.fetchall(); conn.close()
+    return runs
+
+def _groups_left(run_id):
+    conn = engine.db(); cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM broadcast_groups WHERE run_id=? AND status IN ('pending','generating')", (run_id,))
+    left = cur.fetchone()[0]
+    conn.close()
+    return left
+
+def prepare_tick(now=None):
+    # plan the coming slots and generate their lessons
+    if not _prepare_lock.acquire(blocking=False):   # previous tick still generating
+        return
+    try:
+        now = now or time.time()
+        for channel in list(_channels.values()):
+            for day, slot in upcoming_slots(now):
+                plan(channel, day, slot)
+            for r in _open_runs(channel, ("generating",)):
+                generate(channel, r["id"])
+    finally:
+        _prepare_lock.release()
+
+def send_tick(now=None):
+    # send the runs whose slot has started and whose lessons are ready
+    if not _send_lock.acquire(blocking=False):   # previous tick still sending
+        return
+    try:
+        now = now or time.time()
+        for channel in list(_channels.values()):
+            for r in _open_runs(channel, ("generating", "sending")):
+                if now >= slot_epoch(r["day"], r["slot"]) and not _groups_left(r["id"]):
+                    send(channel, r["id"])
+    finally:
+        _send_lock.release()
+
+def tick(now=None):
+    prepare_tick(now)
+    send_tick(now)
+
+def start(app_module):
+    global engine
+    engine = app_module
+    init_tables()
+    engine.start_job("broadcast-prepare", 60, prepare_tick)
+    engine.start_job("broadcast-send", 60, send_tick)
+
+def run_status(limit=10):
+    conn = engine.db(); cur = conn.cursor()
+    cur.execute("""SELECT r.id, r.day, r.slot, r.channel, r.status, r.students,
+                          SUM(i.status='sent') AS sent, SUM(i.status='failed') AS failed, SUM(i.status='skipped') AS skipped
+                   FROM broadcast_runs r LEFT JOIN broadcast_items i ON i.run_id = r.id
+                   GROUP BY r.id ORDER BY r.id DESC LIMIT ?""", (limit,))
+    rows = [dict(r) for r in cur.fetchall()]
+    conn.close()
+    return rows
+
+# ---------- Telegram Bot API sender ----------
+class TelegramSender:
+    # Blocking sendMessage over a pooled HTTP session, for the broadcast thread. Kept
+    # under Telegram's limits (~30 msg/s per bot, 1 msg/s per chat); a 429 waits out
+    # its retry_after, 5xx backs off.
+
+    def __init__(self, token, rate=25.0):
+        self.url = f"https://api.telegram.org/bot{token}/sendMessage"
+        self.rate = rate
+        self.http = requests.Session()
+        self.http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+        self._lock = threading.Lock()
+        self._global = engine.TokenBucket(rate, rate)
+        self._per_chat = {}
+
+    def _throttle(self, chat_id):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                b = self._per_chat.get(chat_id)
+                if b is None:
+                    if len(self._per_chat) > 10000:  # forget chats whose bucket has refilled
+                        self._per_chat = {k: v for k, v in self._per_chat.items()
+                                          if v.tokens + (now - v.ts) * v.rate < v.burst}
+                    b = self._per_chat[chat_id] = engine.TokenBucket(1.0, 1)
+                wait = b.wait_time(now)
+                if not wait:
+                    wait = self._global.wait_time(now)
+                    if wait:
+                        b.tokens += 1
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def send(self, wa_id, text, parse_mode="Markdown"):
+        chat_id = wa_id.split(":", 1)[1]
+        for attempt in range(5):
+            self._throttle(chat_id)
+            r = self.http.post(self.url, json={"chat_id": chat_id, "text": text, "parse_mode": parse_mode}, timeout=15)
+            if r.status_code == 429:
+                retry = (r.json().get("parameters") or {}).get("retry_after", 1)
+                engine.logger.warning(f"[BCAST] telegram 429, retry after {retry}s")
+                time.sleep(retry)
+                continue
+            if r.status_code >= 500:
+                time.sleep(2 ** attempt)
+                continue
+            if not r.ok:
+                raise RuntimeError(f"telegram {r.status_code}: {r.text[:200]}")
+            return
+        raise RuntimeError("telegram send retries exhausted")
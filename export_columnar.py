@@ -0,0 +1,196 @@
+# export_columnar.py
+# Incremental export of mvp.db into partitioned Parquet (or Arrow IPC) files for
+# offline analysis. Needs pyarrow (pip install pyarrow); the bot itself does not.
+#
+#   python export_columnar.py [--db mvp.db] [--out export] [--format parquet|arrow] [--chunk 5000]
+#
+# Append-only tables (history, lessons, answer_log) are read in rowid order from the
+# last watermark, one chunk at a time, and written as
+#   <out>/<table>/dt=<YYYY-MM-DD>/part-<first rowid>-<last rowid>.<ext>
+# Tables that are updated in place (users, user_subjects, mastered_topics) have no
+# reliable rowid watermark, so every run writes a fresh chunked snapshot under
+#   <out>/<table>/dt=<export day>/snapshot-<run>-<n>.<ext>
+# Lesson questions (lessons.questions_json or the lesson_bodies blob) are flattened into
+# a lesson_questions table, one row per question.
+# The DB is opened read-only and every chunk is its own short read, so the bot never
+# waits on the exporter; watermarks live in <out>/_watermarks.json.
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+IST_OFFSET = 5.5 * 3600
+
+APPEND_TABLES = {"history": "taken_at", "lessons": "created_at", "answer_log": "at"}
+SNAPSHOT_TABLES = ("users", "user_subjects", "mastered_topics")
+
+QUESTION_COLUMNS = [("lesson_id", "INTEGER"), ("q_index", "INTEGER"), ("q", "TEXT"),
+                    ("option_a", "TEXT"), ("option_b", "TEXT"), ("option_c", "TEXT"), ("option_d", "TEXT"),
+                    ("ans", "TEXT"), ("explain", "TEXT")]
+
+def arrow_type(decl):
+    decl = (decl or "").upper()
+    if "INT" in decl:
+        return pa.int64()
+    if "REAL" in decl or "FLOA" in decl or "DOUB" in decl:
+        return pa.float64()
+    return pa.string()
+
+def table_columns(con, table):
+    return [(r[1], r[2]) for r in con.execute(f"PRAGMA table_info({table})")]
+
+def table_exists(con, table):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() is not None
+
+def loads_or_empty(s):
+    try:
+        return json.loads(s or "[]")
+    except ValueError:
+        return []
+
+def day_of(ts):
+    return time.strftime("%Y-%m-%d", time.gmtime((ts or 0) + IST_OFFSET))
+
+class Exporter:
+    def __init__(self, db_path, out_dir, fmt="parquet", chunk=5000):
+        self.con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        self.out = out_dir
+        self.fmt = fmt
+        self.chunk = chunk
+        self.state_path = os.path.join(out_dir, "_watermarks.json")
+        os.makedirs(out_dir, exist_ok=True)
+        try:
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {}
+
+    def save_state(self):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.state_path)
+
+    def write(self, table, dt, name, columns, rows):
+        arrays = []
+        for i, (c, decl) in enumerate(columns):
+            vals = [r[i] for r in rows]
+            try:
+                arrays.append(pa.array(vals, arrow_type(decl)))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # SQLite does not enforce declared types; keep odd columns as text
+                arrays.append(pa.array([None if v is None else str(v) for v in vals], pa.string()))
+        data = pa.Table.from_arrays(arrays, names=[c for c, _ in columns])
+        folder = os.path.join(self.out, table, f"dt={dt}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{name}.{'parquet' if self.fmt == 'parquet' else 'arrow'}")
+        tmp = path + ".tmp"
+        if self.fmt == "parquet":
+            pq.write_table(data, tmp, compression="zstd")
+        else:
+            with ipc.new_file(tmp, data.schema) as w:
+                w.write_table(data)
+        os.replace(tmp, path)  # readers never see half-written files
+
+    def chunks(self, table, cols, since):
+        # each SELECT is its own short read transaction
+        sel = ", ".join(f'"{c}"' for c, _ in cols)
+        while True:
+            rows = self.con.execute(f"SELECT rowid, {sel} FROM {table} WHERE rowid>? ORDER BY rowid LIMIT ?",
+                                    (since, self.chunk)).fetchall()
+            if not rows:
+                return
+            yield rows
+            since = rows[-1][0]
+
+    def export_append(self, table, ts_col):
+        if not table_exists(self.con, table):
+            return 0
+        cols = table_columns(self.con, table)
+        names = [c for c, _ in cols]
+        ts_i = names.index(ts_col)
+        since = self.state.get(table, 0)
+        n = 0
+        for rows in self.chunks(table, cols, since):
+            by_day = {}
+            for r in rows:
+                by_day.setdefault(day_of(r[1 + ts_i]), []).append(r)
+            for dt, part in by_day.items():
+                out_cols, out_rows = cols, [r[1:] for r in part]
+                if table == "lessons":
+                    out_cols, out_rows = self.flatten_lessons(cols, out_rows, dt, part[0][0], part[-1][0])
+                self.write(table, dt, f"part-{part[0][0]}-{part[-1][0]}", out_cols, out_rows)
+            n += len(rows)
+            self.state[table] = rows[-1][0]
+            self.save_state()
+        return n
+
+    def flatten_lessons(self, cols, rows, dt, first, last):
+        # intro_json -> intro text, questions_json -> lesson_questions rows
+        # (bodies moved to lesson_bodies are decompressed here)
+        names = [c for c, _ in cols]
+        i_intro, i_qs, i_id = names.index("intro_json"), names.index("questions_json"), names.index("id")
+        i_body = names.index("body_hash") if "body_hash" in names else None
+        keep = [i for i in range(len(names)) if i not in (i_intro, i_qs)]
+        out_cols = [cols[i] for i in keep] + [("intro", "TEXT"), ("n_questions", "INTEGER")]
+        out_rows, q_rows = [], []
+        for r in rows:
+            if i_body is not None and r[i_body]:
+                blob = self.con.execute("SELECT body FROM lesson_bodies WHERE hash=?", (r[i_body],)).fetchone()
+                body = json.loads(zlib.decompress(blob[0])) if blob else {}
+                intro, qs = body.get("intro", []), body.get("questions", [])
+            else:
+                intro, qs = loads_or_empty(r[i_intro]), loads_or_empty(r[i_qs])
+            out_rows.append([r[i] for i in keep] + ["\n".join(map(str, intro)), len(qs)])
+            for qi, q in enumerate(qs):
+                opts = (list(q.get("options") or []) + [None] * 4)[:4]
+                q_rows.append((r[i_id], qi, q.get("q"), *opts, q.get("ans"), q.get("explain")))
+        if q_rows:
+            self.write("lesson_questions", dt, f"part-{first}-{last}", QUESTION_COLUMNS, q_rows)
+        return out_cols, out_rows
+
+    def export_snapshot(self, table, run):
+        if not table_exists(self.con, table):
+            return 0
+        cols = table_columns(self.con, table)
+        dt = day_of(time.time())
+        n = 0
+        for i, rows in enumerate(self.chunks(table, cols, 0)):
+            self.write(table, dt, f"snapshot-{run}-{i:04d}", cols, [r[1:] for r in rows])
+            n += len(rows)
+        return n
+
+    def run(self):
+        run = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        counts = {}
+        for table, ts_col in APPEND_TABLES.items():
+            counts[table] = self.export_append(table, ts_col)
+        for table in SNAPSHOT_TABLES:
+            counts[table] = self.export_snapshot(table, run)
+        self.con.close()
+        return counts
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Export mvp.db to partitioned columnar files")
+    ap.add_argument("--db", default="mvp.db")
+    ap.add_argument("--out", default="export")
+    ap.add_argument("--format", choices=("parquet", "arrow"), default="parquet")
+    ap.add_argument("--chunk", type=int, default=5000, help="rows per read/file (bounds memory)")
+    args = ap.parse_args(argv)
+    if pa is None:
+        sys.exit("pyarrow is required: pip install pyarrow")
+    counts = Exporter(args.db, args.out, args.format, args.chunk).run()
+    print("Exported " + ", ".join(f"{t}={n}" for t, n in counts.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+# gazetteer.py
+# Offline city/town -> Indian state lookup from the bundled gazetteer_in.tsv, so
+# onboarding does not call out to a geocoder for every state-board student.
+#   Gazetteer.state_for(text)   - exact, then transliteration-aware, then fuzzy match
+#   lookup_state(city)          - async: offline first, then (optionally) Nominatim,
+#                                 throttled to its 1 req/s policy and cached with a TTL
+# Names are matched on two keys:
+#   norm     - lowercase ASCII with diacritics stripped, Devanagari transliterated and
+#              long vowels folded (aa->a, ee->i, oo->u): "Poona", "पूना" -> "puna"
+#   skeleton - consonants and vowels with aspirates folded (kh->k, sh->s, w->v ...),
+#              "h" and lone short "a" dropped (the inherent vowel, often silent) and
+#              repeats collapsed: "Nagpur", "नागपूर" -> "ngpur"; "Mangaon" -> "mngun"
+#              stays apart from "Mangan" -> "mngn"
+import asyncio
+import difflib
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import requests
+
+logger = logging.getLogger("whatsapp_mvp")
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer_in.tsv")
+FUZZY_CUTOFF = 0.88
+REMOTE_ENABLED = os.environ.get("GEOCODE_REMOTE", "1") == "1"
+REMOTE_TIMEOUT_S = 5
+REMOTE_MIN_INTERVAL_S = 1.1   # Nominatim usage policy: at most 1 request per second
+CACHE_TTL_S = 30 * 86400
+CACHE_MISS_TTL_S = 86400
+USER_AGENT = os.environ.get("GEOCODE_USER_AGENT", "btrlrn-edu-bot/1.0 (contact: support@example.com)")
+
+# ---------- transliteration ----------
+_DEV_CONS = {
+    "क": "k", "ख": "kh", "ग": "g", "घ": "gh", "ङ": "n", "च": "ch", "छ": "chh", "ज": "j", "झ": "jh", "ञ": "n",
+    "ट": "t", "ठ": "th", "ड": "d", "ढ": "dh", "ण": "n", "त": "t", "थ": "th", "द": "d", "ध": "dh", "न": "n",
+    "प": "p", "फ": "ph", "ब": "b", "भ": "bh", "म": "m", "य": "y", "र": "r", "ल": "l", "ळ": "l", "व": "v",
+    "श": "sh", "ष": "sh", "स": "s", "ह": "h",
+}
+_DEV_VOWELS = {"अ": "a", "आ": "aa", "इ": "i", "ई": "ee", "उ": "u", "ऊ": "oo", "ऋ": "ri", "ए": "e", "ऐ": "ai",
+               "ओ": "o", "औ": "au", "ऑ": "o"}
+_DEV_MATRAS = {"ा": "aa", "ि": "i", "ी": "ee", "ु": "u", "ू": "oo", "ृ": "ri", "े": "e", "ै": "ai", "ो": "o",
+               "ौ": "au", "ॉ": "o"}
+_DEV_MARKS = {"ं": "n", "ँ": "n", "ः": "h"}
+_VIRAMA, _NUKTA = "्", "़"
+
+def transliterate(text):
+    # Devanagari -> rough Latin; other characters pass through
+    out, i = [], 0
+    while i < len(text):
+        ch = text[i]
+        if ch in _DEV_CONS:
+            out.append(_DEV_CONS[ch])
+            nxt = text[i + 1] if i + 1 < len(text) else ""
+            if nxt == _NUKTA:
+                i += 1; nxt = text[i + 1] if i + 1 < len(text) else ""
+            if nxt in _DEV_MATRAS:
+                out.append(_DEV_MATRAS[nxt]); i += 1
+            elif nxt == _VIRAMA:
+                i += 1
+            else:
+                out.append("a")   # inherent vowel; the skeleton key ignores it where it is silent
+        elif ch in _DEV_VOWELS:
+            out.append(_DEV_VOWELS[ch])
+        elif ch in _DEV_MARKS:
+            out.append(_DEV_MARKS[ch])
+        elif ch != _NUKTA:
+            out.append(ch)
+        i += 1
+    return "".join(out)
+
+def norm(text):
+    t = unicodedata.normalize("NFKD", transliterate(text or ""))
+    t = "".join(c for c in t if not unicodedata.combining(c)).lower()
+    t = re.sub(r"[^a-z0-9]", "", t)
+    for a, b in (("aa", "a"), ("ee", "i"), ("oo", "u")):
+        t = t.replace(a, b)
+    return t
+
+_FOLD = (("chh", "c"), ("ch", "c"), ("kh", "k"), ("gh", "g"), ("jh", "j"), ("th", "t"), ("dh", "d"), ("ph", "f"),
+         ("bh", "b"), ("sh", "s"), ("ck", "k"), ("nb", "mb"), ("np", "mp"), ("w", "v"), ("z", "j"), ("q", "k"),
+         ("x", "ks"))
+_VOWEL_FOLD = str.maketrans("eoy", "iui")
+
+_VOWEL_RUN = re.compile(r"[aeiouy]+|[^aeiouy]")
+
+def skeleton(key):
+    # key is already norm()ed. Only the inherent "a" (and an English silent final "e":
+    # "Indore"/"Indor") may come or go: a vowel that is written in one spelling and
+    # missing in the other ("Mangaon"/"Mangan", "Vaijapur"/"Vijapur") is a different
+    # place, not a different spelling.
+    if not key:
+        return ""
+    for a, b in _FOLD:
+        key = key.replace(a, b)
+    key = re.sub(r"(?<=[^aeiouy])e$", "", key)
+    parts = [p.translate(_VOWEL_FOLD) for p in _VOWEL_RUN.findall(key) if p not in ("a", "h")]
+    return re.sub(r"(.)\1+", r"\1", "".join(parts))
+
+# ---------- offline index ----------
+class Gazetteer:
+    # Compact index: states are stored once, names map to a small int. Only the
+    # lookup keys are kept in memory, not the original rows.
+
+    def __init__(self, path=DATA_PATH):
+        self.states = []
+        self.by_norm = {}       # norm key -> state index (first line wins)
+        self.by_skel = {}       # skeleton -> state index, or -1 when it spans states
+        self.by_initial = {}    # first letter -> norm keys, for fuzzy matching
+        state_ids = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                name, state, aliases = (line.rstrip("\n").split("\t") + ["", ""])[:3]
+                sid = state_ids.get(state)
+                if sid is None:
+                    sid = state_ids[state] = len(self.states)
+                    self.states.append(state)
+                    self._add(state, sid)
+                for n in [name] + [a for a in aliases.split(",") if a.strip()]:
+                    self._add(n, sid)
+        self.states = tuple(self.states)
+        self._state_keys = {norm(s): i for i, s in enumerate(self.states)}
+        self.by_initial = {k: tuple(v) for k, v in self.by_initial.items()}
+
+    def _add(self, name, sid):
+        key = norm(name)
+        if not key or key in self.by_norm:
+            return
+        self.by_norm[key] = sid
+        self.by_initial.setdefault(key[0], []).append(key)
+        sk = skeleton(key)
+        if len(sk) >= 3:
+            self.by_skel[sk] = sid if self.by_skel.get(sk, sid) == sid else -1
+
+    def __len__(self):
+        return len(self.by_norm)
+
+    def state_for(self, text):
+        # "Pune", "poona", "पुणे", "Pune, Maharashtra", "Kolhapur city" -> state or None
+        parts = [p for p in re.split(r"[,/]", text or "") if p.strip()]
+        for p in parts[1:]:   # "city, state" - trust an explicit state
+            sid = self._state_keys.get(norm(p))
+            if sid is not None:
+                return self.states[sid]
+        if not parts:
+            return None
+        key = norm(re.sub(r"\b(city|district|dist|town|nagar palika)\b\.?", "", parts[0], flags=re.I))
+        if not key:
+            return None
+        sid = self.by_norm.get(key)
+        if sid is None:
+            sid = self.by_skel.get(skeleton(key), -1)
+            if sid == -1:
+                # typos only: the ending ("-pur"/"-puri", "-gaon"/"-gan") tells towns apart
+                close = [c for c in difflib.get_close_matches(key, self.by_initial.get(key[0], ()), n=3,
+                                                              cutoff=FUZZY_CUTOFF) if c[-3:] == key[-3:]]
+                sid = self.by_norm[close[0]] if close else -1
+            if sid == -1:   # "Hubli-Dharwad", "Vasai West": any known word
+                words = [norm(w) for w in re.split(r"[-\s]+", parts[0])]
+                sid = next((self.by_norm[w] for w in words if len(w) >= 3 and w in self.by_norm), -1)
+        return self.states[sid] if sid >= 0 else None
+
+_index = None
+_index_lock = threading.Lock()
+
+def index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = Gazetteer()
+                logger.info(f"[GEO] gazetteer loaded: {len(_index)} names, {len(_index.states)} states")
+    return _index
+
+def state_for(text):
+    return index().state_for(text)
+
+# ---------- remote fallback ----------
+class TTLCache:
+    def __init__(self, max_size=5000):
+        self.max_size = max_size
+        self._data = OrderedDict()   # key -> (value, expires_at)
+
+    def get(self, key, now=None):
+        item = self._data.get(key)
+        if item is None or item[1] < (now or time.time()):
+            self._data.pop(key, None)
+            return False, None
+        return True, item[0]
+
+    def put(self, key, value, ttl, now=None):
+        self._data[key] = (value, (now or time.time()) + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+_remote_cache = TTLCache()
+_remote_lock = None      # asyncio.Lock, created on first use inside the running loop
+_remote_last = 0.0
+_http = requests.Session()
+
+def nominatim_state(city):
+    # blocking; run it off the event loop
+    r = _http.get("https://nominatim.openstreetmap.org/search",
+                  params={"city": city, "country": "India", "format": "json", "addressdetails": 1, "limit": 1},
+                  headers={"User-Agent": USER_AGENT}, timeout=REMOTE_TIMEOUT_S)
+    r.raise_for_status()
+    arr = r.json()
+    if not arr:
+        return None
+    addr = arr[0].get("address", {})
+    found = addr.get("state") or addr.get("state_district") or ""
+    sid = index()._state_keys.get(norm(found))
+    return index().states[sid] if sid is not None else None
+
+async def lookup_state(city):
+    global _remote_lock, _remote_last
+    if not city or not city.strip():
+        return None
+    found = state_for(city)
+    if found or not REMOTE_ENABLED:
+        return found
+    key = norm(city)
+    hit, cached = _remote_cache.get(key)
+    if hit:
+        return cached
+    if _remote_lock is None:
+        _remote_lock = asyncio.Lock()
+    async with _remote_lock:   # one request at a time, spaced per the usage policy
+        hit, cached = _remote_cache.get(key)
+        if hit:
+            return cached
+        wait = _remote_last + REMOTE_MIN_INTERVAL_S - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        _remote_last = time.monotonic()
+        try:
+            found = await asyncio.to_thread(nominatim_state, city)
+        except Exception as e:
+            logger.warning(f"[GEO] remote lookup failed city={city!r}: {e}")
+            return None   # not cached, so a later try can still succeed
+    _remote_cache.put(key, found, CACHE_TTL_S if found else CACHE_MISS_TTL_S)
+    logger.info(f"[GEO] remote city={city!r} -> {found}")
+    return found
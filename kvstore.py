@@ -0,0 +1,281 @@
+# kvstore.py
+# Redis-protocol (RESP2) shared state for running several bot workers on one host:
+#   RespClient     - minimal pooled client for one server
+#   RedisBackend   - sessions, parsed lessons and per-student locks, sharded over
+#                    one or more servers by crc32 of the key
+# Users, history and the lessons table are still read from the shared mvp.db, so the
+# workers are not stateless and users are not sharded; spreading workers over hosts
+# needs those moved behind the backend too.
+#   StandInServer  - tiny in-process server speaking the same protocol, for local
+#                    runs and tests:  python kvstore.py --port 6390
+# Only the commands used here are implemented by the stand-in.
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+ID_EPOCH_MS = 1_704_067_200_000   # 2024-01-01, as app.SessionStore.ID_EPOCH_MS
+
+# deletes the lock only if we still own it
+RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+class RespError(Exception):
+    pass
+
+def encode_command(*args):
+    out = [b"*%d\r\n" % len(args)]
+    for a in args:
+        if not isinstance(a, bytes):
+            a = str(a).encode("utf-8")
+        out.append(b"$%d\r\n%s\r\n" % (len(a), a))
+    return b"".join(out)
+
+def read_reply(f):
+    line = f.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        n = int(rest)
+        if n < 0:
+            return None
+        data = f.read(n + 2)
+        return data[:-2]
+    if kind == b"*":
+        n = int(rest)
+        return None if n < 0 else [read_reply(f) for _ in range(n)]
+    raise RespError(f"bad reply: {line!r}")
+
+class RespClient:
+    def __init__(self, url, timeout=2.0, pool_size=8):
+        u = urlparse(url)
+        self.host, self.port = u.hostname or "127.0.0.1", u.port or 6379
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.password = u.password
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._pool = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        s = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (s, s.makefile("rb"))
+        if self.password:
+            self._call(conn, "AUTH", self.password)
+        if self.db:
+            self._call(conn, "SELECT", self.db)
+        return conn
+
+    @staticmethod
+    def _call(conn, *args):
+        conn[0].sendall(encode_command(*args))
+        return read_reply(conn[1])
+
+    def execute(self, *args):
+        with self._lock:
+            conn = self._pool.pop() if self._pool else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            reply = self._call(conn, *args)
+        except RespError:
+            self._release(conn)
+            raise
+        except (OSError, ConnectionError):
+            conn[0].close()
+            raise
+        self._release(conn)
+        return reply
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(conn); return
+        conn[0].close()
+
+class RedisBackend:
+    # Shared state for several workers on one host. Keys are sharded over the servers in
+    # `urls` by crc32 of the student id (lessons by lesson id). SQLite stays the record
+    # of history, users and lessons; this holds what workers must agree on.
+    SESSION_TTL = 7 * 86400
+    LESSON_TTL = 86400
+
+    def __init__(self, urls, prefix="btrlrn", lock_ttl_ms=10000):
+        self.nodes = [RespClient(u) for u in urls]
+        self.prefix = prefix
+        self.lock_ttl_ms = lock_ttl_ms
+        self._stats_lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def node(self, key):
+        return self.nodes[zlib.crc32(str(key).encode("utf-8")) % len(self.nodes)]
+
+    def _key(self, kind, key):
+        return f"{self.prefix}:{kind}:{key}"
+
+    def new_session_id(self):
+        # same layout as app.SessionStore.new_id, (ms since ID_EPOCH_MS) << 22, with a
+        # shared INCR counter in the low bits instead of the pid: unique across every
+        # worker, and later sessions still get larger ids (the sessions upsert keeps
+        # the larger one)
+        n = self.nodes[0].execute("INCR", self._key("counter", "session_id"))
+        return (int(time.time() * 1000) - ID_EPOCH_MS) << 22 | n % (1 << 22)
+
+    def get_session(self, wa_id):
+        raw = self.node(wa_id).execute("GET", self._key("session", wa_id))
+        return json.loads(raw) if raw else None
+
+    def set_session(self, wa_id, session, persisted=False):
+        # sessions live here, not in SQLite, so `persisted` changes nothing
+        self.node(wa_id).execute("SET", self._key("session", wa_id), json.dumps(session), "EX", self.SESSION_TTL)
+
+    def update_session(self, wa_id, fields):
+        # callers that race on one student hold lock(wa_id)
+        s = self.get_session(wa_id)
+        if s is None:
+            return False
+        s.update(fields)
+        self.set_session(wa_id, s)
+        return True
+
+    def flush(self):
+        return 0
+
+    def get_lesson(self, lesson_id):
+        raw = self.node(lesson_id).execute("GET", self._key("lesson", lesson_id))
+        with self._stats_lock:
+            if raw:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return json.loads(raw) if raw else None
+
+    def put_lesson(self, lesson_id, lesson):
+        self.node(lesson_id).execute("SET", self._key("lesson", lesson_id), json.dumps(lesson, ensure_ascii=False),
+                                     "EX", self.LESSON_TTL)
+
+    def invalidate_lesson(self, lesson_id):
+        self.node(lesson_id).execute("DEL", self._key("lesson", lesson_id))
+
+    @contextmanager
+    def lock(self, wa_id, timeout=5.0):
+        key, token = self._key("lock", wa_id), os.urandom(8).hex()
+        node = self.node(wa_id)
+        deadline = time.monotonic() + timeout
+        while node.execute("SET", key, token, "NX", "PX", self.lock_ttl_ms) is None:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"lock busy for {wa_id}")
+            time.sleep(0.01)
+        try:
+            yield
+        finally:
+            node.execute("EVAL", RELEASE_SCRIPT, 1, key, token)
+
+    def stats(self):
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {"backend": "redis", "nodes": len(self.nodes), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else None}
+
+# ---------- stand-in server ----------
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr=("127.0.0.1", 0)):
+        super().__init__(addr, _StandInHandler)
+        self.data = {}      # key -> (value bytes, expires_at or None)
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"redis://{self.server_address[0]}:{self.server_address[1]}/0"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="resp-standin", daemon=True).start()
+        return self
+
+    def _get(self, key):
+        v = self.data.get(key)
+        if v and v[1] is not None and v[1] <= time.monotonic():
+            del self.data[key]; v = None
+        return v[0] if v else None
+
+    def run(self, cmd, args):
+        with self.lock:
+            if cmd == "PING":
+                return "PONG"
+            if cmd in ("SELECT", "AUTH"):
+                return "OK"
+            if cmd == "GET":
+                return self._get(args[0])
+            if cmd == "SET":
+                key, val, opts = args[0], args[1], [a.decode().upper() for a in args[2:]]
+                ttl = None
+                for i, o in enumerate(opts):
+                    if o in ("EX", "PX"):
+                        ttl = int(opts[i + 1]) / (1 if o == "EX" else 1000)
+                if "NX" in opts and self._get(key) is not None:
+                    return None
+                self.data[key] = (val, time.monotonic() + ttl if ttl else None)
+                return "OK"
+            if cmd == "DEL":
+                return sum(1 for k in args if self._get(k) is not None and self.data.pop(k, None))
+            if cmd == "INCR":
+                n = int(self._get(args[0]) or 0) + 1
+                self.data[args[0]] = (str(n).encode(), None)
+                return n
+            if cmd == "EVAL" and args[0].decode() == RELEASE_SCRIPT:
+                key, token = args[2], args[3]
+                if self._get(key) == token:
+                    del self.data[key]; return 1
+                return 0
+            if cmd == "DBSIZE":
+                return len(self.data)
+            if cmd == "FLUSHDB":
+                self.data.clear(); return "OK"
+        raise RespError(f"ERR unknown command '{cmd}'")
+
+class _StandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                req = read_reply(self.rfile)
+            except (ConnectionError, OSError):
+                return
+            if not isinstance(req, list) or not req:
+                return
+            try:
+                out = self.server.run(req[0].decode().upper(), req[1:])
+            except RespError as e:
+                self.wfile.write(f"-{e}\r\n".encode()); continue
+            if out is None:
+                self.wfile.write(b"$-1\r\n")
+            elif isinstance(out, int):
+                self.wfile.write(b":%d\r\n" % out)
+            elif isinstance(out, str):
+                self.wfile.write(f"+{out}\r\n".encode())
+            else:
+                self.wfile.write(b"$%d\r\n%s\r\n" % (len(out), out))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Local Redis-protocol stand-in")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=6390)
+    args = ap.parse_args()
+    srv = StandInServer((args.host, args.port))
+    print(f"Listening on {srv.url}")
+    srv.serve_forever()
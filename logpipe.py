@@ -0,0 +1,108 @@
+# logpipe.py
+# Non-blocking logging for the WhatsApp and Telegram processes. Callers only put the
+# record on a bounded queue; a QueueListener thread formats it and does the file and
+# console I/O, so a slow disk or terminal never stalls a webhook or the event loop.
+#   request_id          - contextvar stamped on every record (set per inbound message)
+#   JsonFormatter       - one JSON object per line for logs/app.log
+#   Sampler             - keeps a fraction of high-volume lines (extra=HOT) per level;
+#                         the decision is made per request id, so a sampled request
+#                         keeps its whole trail. WARNING and above are never sampled.
+#   setup(logger, ...)  - wires it all up; returns the listener (stopped at exit)
+# When the queue is full the record is dropped and counted rather than blocking.
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import zlib
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+request_id = contextvars.ContextVar("request_id", default=None)
+HOT = {"hot": True}    # logger.info(..., extra=HOT) marks a per-message line as sampleable
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        out = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "msg": record.getMessage(),
+            "req": getattr(record, "req_id", None),
+            "thread": record.threadName,
+        }
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False)
+
+class Sampler(logging.Filter):
+    # rates: {levelno: fraction kept} for HOT records; missing levels keep everything
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        record.req_id = request_id.get()
+        if record.levelno >= logging.WARNING or not getattr(record, "hot", False):
+            return True
+        rate = self.rates.get(record.levelno, 1.0)
+        if rate >= 1.0:
+            return True
+        if record.req_id:
+            return (zlib.crc32(record.req_id.encode()) % 10000) < rate * 10000
+        return random.random() < rate
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only resolve what cannot cross threads (args, traceback objects); formatting
+        # is left to the listener's handlers.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_setup_lock = threading.Lock()
+
+def setup(logger, path, level=logging.INFO, console=True, sample=None, max_queue=10000):
+    with _setup_lock:
+        if any(isinstance(h, DroppingQueueHandler) for h in logger.handlers):
+            return None
+        handlers = []
+        file = RotatingFileHandler(path, maxBytes=2_000_000, backupCount=3, encoding="utf-8")
+        file.setFormatter(JsonFormatter())
+        handlers.append(file)
+        if console:
+            con = logging.StreamHandler(sys.stderr)
+            con.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+            handlers.append(con)
+        q = queue.Queue(max_queue)
+        qh = DroppingQueueHandler(q)
+        qh.addFilter(Sampler(sample or {}))
+        logger.setLevel(level)
+        logger.addHandler(qh)
+        logger.propagate = False   # a root handler would write on the caller's thread again
+        listener = QueueListener(q, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(stop, listener)
+        return listener
+
+def stop(listener):
+    # flush what is queued; safe to call more than once
+    if listener._thread is not None:
+        listener.stop()
+
+def dropped(logger):
+    return sum(h.dropped for h in logger.handlers if isinstance(h, DroppingQueueHandler))
@@ -0,0 +1,179 @@
+# matching.py
+# Free-text matching for onboarding answers (state, board, subject), so "mh", "maha",
+# "महाराष्ट्र", "maths" or "sst" are understood without another round-trip.
+#   MatchIndex(entries).search(text) -> ranked [(name, score)]
+#   MatchIndex(entries).best(text)   -> name when the top candidate is clear, else None
+# Keys are normalised with gazetteer.norm (Devanagari transliterated, long vowels
+# folded). Scoring: exact alias 1.0, alias prefix ("maha") up to 0.95, otherwise the
+# trigram Dice coefficient. The indexes are built once; a lookup touches only the
+# postings of the query's trigrams.
+from bisect import bisect_left
+from functools import lru_cache
+
+from gazetteer import norm
+
+class MatchIndex:
+    def __init__(self, entries):
+        # entries: {name: [aliases]}; the name itself is always an alias
+        self.names = tuple(entries)
+        self.exact = {}      # key -> ids
+        self.keys = []       # [(key, id)]
+        self.grams = {}      # trigram -> key positions
+        for i, name in enumerate(self.names):
+            for alias in [name, *entries[name]]:
+                key = norm(alias)
+                if not key or i in self.exact.get(key, ()):
+                    continue
+                self.exact.setdefault(key, []).append(i)
+                pos = len(self.keys)
+                self.keys.append((key, i))
+                for g in trigrams(key):
+                    self.grams.setdefault(g, []).append(pos)
+        self._sorted = sorted(self.keys)   # for prefix lookups
+
+    def search(self, text, limit=5, min_score=0.35):
+        q = norm(text)
+        if not q:
+            return []
+        scores = {}
+        for i in self.exact.get(q, ()):
+            scores[i] = 1.0
+        if len(q) >= 3:
+            # alias prefix: "maha" -> maharashtra, "karn" -> karnataka
+            at = bisect_left(self._sorted, (q, -1))
+            while at < len(self._sorted) and self._sorted[at][0].startswith(q):
+                key, i = self._sorted[at]
+                if key != q:
+                    scores[i] = max(scores.get(i, 0), 0.6 + 0.35 * len(q) / len(key))
+                at += 1
+            qg = trigrams(q)
+            common = {}
+            for g in qg:
+                for pos in self.grams.get(g, ()):
+                    common[pos] = common.get(pos, 0) + 1
+            for pos, n in common.items():
+                key, i = self.keys[pos]
+                s = 2 * n / (len(qg) + len(trigrams(key)))
+                if s > scores.get(i, 0):
+                    scores[i] = s
+        ranked = sorted(((s, self.names[i]) for i, s in scores.items() if s >= min_score), reverse=True)
+        return [(name, round(s, 3)) for s, name in ranked[:limit]]
+
+    def best(self, text, min_score=0.6, margin=0.1):
+        ranked = self.search(text, limit=2)
+        if not ranked or ranked[0][1] < min_score:
+            return None
+        if len(ranked) > 1 and ranked[0][1] - ranked[1][1] < margin:
+            return None
+        return ranked[0][0]
+
+@lru_cache(maxsize=4096)
+def trigrams(key):
+    padded = f"^{key}$"
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+# ---------- states ----------
+STATE_ALIASES = {
+    "Andhra Pradesh": ["AP", "Andhra", "आंध्र प्रदेश", "आंध्रप्रदेश"],
+    "Arunachal Pradesh": ["AR", "Arunachal", "अरुणाचल प्रदेश"],
+    "Assam": ["AS", "असम", "आसाम"],
+    "Bihar": ["BR", "बिहार"],
+    "Chhattisgarh": ["CG", "CT", "Chattisgarh", "छत्तीसगढ़", "छत्तीसगड"],
+    "Goa": ["GA", "गोवा"],
+    "Gujarat": ["GJ", "Gujrat", "गुजरात"],
+    "Haryana": ["HR", "हरियाणा"],
+    "Himachal Pradesh": ["HP", "Himachal", "हिमाचल प्रदेश"],
+    "Jharkhand": ["JH", "झारखंड", "झारखण्ड"],
+    "Karnataka": ["KA", "कर्नाटक"],
+    "Kerala": ["KL", "Kerela", "केरल", "केरळ"],
+    "Madhya Pradesh": ["MP", "मध्य प्रदेश", "मध्यप्रदेश"],
+    "Maharashtra": ["MH", "Maharastra", "महाराष्ट्र"],
+    "Manipur": ["MN", "मणिपुर", "मणिपूर"],
+    "Meghalaya": ["ML", "मेघालय"],
+    "Mizoram": ["MZ", "मिज़ोरम", "मिझोराम"],
+    "Nagaland": ["NL", "नागालैंड", "नागालँड"],
+    "Odisha": ["OD", "OR", "Orissa", "ओडिशा", "उड़ीसा"],
+    "Punjab": ["PB", "पंजाब"],
+    "Rajasthan": ["RJ", "राजस्थान"],
+    "Sikkim": ["SK", "सिक्किम"],
+    "Tamil Nadu": ["TN", "Tamilnadu", "तमिलनाडु", "तामिळनाडू"],
+    "Telangana": ["TS", "TG", "तेलंगाना", "तेलंगणा"],
+    "Tripura": ["TR", "त्रिपुरा"],
+    "Uttar Pradesh": ["UP", "उत्तर प्रदेश", "उत्तरप्रदेश"],
+    "Uttarakhand": ["UK", "UA", "Uttaranchal", "उत्तराखंड", "उत्तराखण्ड"],
+    "West Bengal": ["WB", "Bengal", "पश्चिम बंगाल", "बंगाल"],
+    "Andaman and Nicobar Islands": ["AN", "Andaman", "Andaman & Nicobar", "अंडमान निकोबार"],
+    "Chandigarh": ["CH", "चंडीगढ़"],
+    "Dadra and Nagar Haveli and Daman and Diu": ["DN", "DD", "DNHDD", "Daman", "Diu", "Dadra", "Silvassa", "दमन दीव"],
+    "Delhi": ["DL", "NCT", "New Delhi", "दिल्ली", "नई दिल्ली"],
+    "Jammu and Kashmir": ["JK", "J&K", "Kashmir", "Jammu", "जम्मू कश्मीर", "जम्मू और कश्मीर"],
+    "Ladakh": ["LA", "लद्दाख", "लडाख"],
+    "Lakshadweep": ["LD", "लक्षद्वीप"],
+    "Puducherry": ["PY", "Pondicherry", "पुडुचेरी", "पाँडिचेरी"],
+}
+
+# ---------- boards ----------
+BOARD_ALIASES = {
+    "CBSE": ["Central Board", "Central Board of Secondary Education", "NCERT", "सीबीएसई", "केंद्रीय बोर्ड"],
+    "ICSE": ["CISCE", "ISC", "आईसीएसई"],
+    "State": ["State Board", "SSC", "HSC", "Maharashtra Board", "राज्य बोर्ड", "राज्य मंडळ", "एसएससी"],
+}
+
+# ---------- subjects ----------
+# Concepts a student may type; a board's subject is matched through every concept
+# that appears in its name ("History & Civics & Geography" answers to "history",
+# "civics", "geography" and "sst").
+SUBJECT_CONCEPTS = {
+    "mathematics": ["math", "maths", "ganit", "गणित"],
+    "science": ["vigyan", "विज्ञान", "sci", "general science", "evs"],
+    "english": ["eng", "angrezi", "अंग्रेजी", "अंग्रेज़ी", "इंग्रजी"],
+    "hindi": ["हिंदी", "हिन्दी"],
+    "marathi": ["मराठी"],
+    "sanskrit": ["संस्कृत"],
+    "social science": ["sst", "social studies", "social", "samajik vigyan", "सामाजिक विज्ञान", "सामाजिक शास्त्र",
+                       "history", "geography", "civics"],
+    "history": ["itihas", "इतिहास", "sst"],
+    "civics": ["political science", "नागरिक शास्त्र", "नागरिकशास्त्र", "sst"],
+    "geography": ["geo", "bhugol", "भूगोल", "sst"],
+    "computer": ["computers", "it", "cs", "कंप्यूटर", "संगणक"],
+    "second language": ["2nd language", "2nd lang", "second lang", "दूसरी भाषा", "द्वितीय भाषा"],
+    "2nd lang": ["second language", "2nd language", "second lang"],
+    "physics": ["भौतिकी", "भौतिकशास्त्र"],
+    "chemistry": ["रसायन", "रसायनशास्त्र"],
+    "biology": ["bio", "जीव विज्ञान", "जीवशास्त्र"],
+}
+_CONCEPT_KEYS = {norm(c): aliases for c, aliases in SUBJECT_CONCEPTS.items()}
+
+STATES = MatchIndex(STATE_ALIASES)
+BOARDS = MatchIndex(BOARD_ALIASES)
+
+def match_state(text):
+    return STATES.best(text)
+
+def state_candidates(text, limit=4):
+    return [name for name, _ in STATES.search(text, limit=limit)]
+
+def match_board(text):
+    # 'CBSE' | 'ICSE' | 'State' | None
+    return BOARDS.best(text)
+
+@lru_cache(maxsize=256)
+def subject_index(choices):
+    entries = {}
+    names = {norm(choice) for choice in choices}
+    for choice in choices:
+        key = norm(choice)
+        found = [c for c in _CONCEPT_KEYS if len(c) >= 4 and c in key]
+        # "Social Science" is not a "science" subject; nor is "Computer Science" when
+        # "Science" is on the list too
+        found = [c for c in found if not any(c != o and c in o for o in found)]
+        found = [c for c in found if c == key or c not in names]
+        entries[choice] = [a for c in found for a in (c, *_CONCEPT_KEYS[c])]
+    return MatchIndex(entries)
+
+def match_subject(text, choices):
+    # the student's subject list decides what "sst" or "science" means
+    return subject_index(tuple(choices)).best(text)
+
+def subject_candidates(text, choices, limit=4):
+    return [name for name, _ in subject_index(tuple(choices)).search(text, limit=limit)]
@@ -0,0 +1,209 @@
+# metrics.py
+# In-process counters, gauges and histograms rendered in the Prometheus text format
+# (GET /metrics on the Flask app; serve(port) for processes without a web server).
+#   requests = metrics.counter("x_total", "help", ["channel"]); requests.inc("whatsapp")
+#   latency = metrics.histogram("x_seconds", "help", ["kind"]); latency.observe(0.2, "lesson")
+#   with latency.time("lesson"): ...
+#   metrics.gauge("x", "help", fn=lambda: {(): 3})   - sampled at scrape time
+# Label values are passed positionally in the order the labels were declared. An
+# observation is a dict lookup and a few adds under the metric's own lock; nothing is
+# formatted until a scrape.
+import sqlite3
+import sys
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import tracing
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.fn = fn            # () -> {label tuple: value}, read at scrape time
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self):
+        if self.fn is not None:
+            return [(self.name, k if isinstance(k, tuple) else (k,), v) for k, v in self.fn().items()]
+        with self._lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+class _Timer:
+    __slots__ = ("hist", "labels", "start")
+
+    def __init__(self, hist, labels):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, *self.labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._values.get(labels)
+            if h is None:
+                h = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            h[0][i] += 1
+            h[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(k, list(h[0]), h[1]) for k, h in self._values.items()]
+        out = []
+        for k, counts, total in items:
+            cum = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts):
+                cum += c
+                out.append((self.name + "_bucket", k + (le,), cum))
+            out.append((self.name + "_sum", k, total))
+            out.append((self.name + "_count", k, cum))
+        return out
+
+# ---------- registry ----------
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _register(cls, name, *args, **kwargs):
+    # idempotent, so modules imported by both processes can declare their metrics
+    with _registry_lock:
+        m = _registry.get(name)
+        if m is None:
+            m = _registry[name] = cls(name, *args, **kwargs)
+        return m
+
+def counter(name, help, labels=(), fn=None):
+    return _register(Counter, name, help, labels, fn)
+
+def gauge(name, help, labels=(), fn=None):
+    return _register(Gauge, name, help, labels, fn)
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help, labels, buckets)
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def render():
+    lines = []
+    with _registry_lock:
+        ms = list(_registry.values())
+    for m in ms:
+        try:
+            samples = m.samples()
+        except Exception as e:   # a broken callback must not take down the scrape
+            lines.append(f"# {m.name} unavailable: {_escape(e)}")
+            continue
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        names = m.labels + ("le",) if m.kind == "histogram" else m.labels
+        for name, values, v in samples:
+            if values:
+                pairs = ",".join(f'{n}="{_escape(x)}"' for n, x in zip(names, values))
+                lines.append(f"{name}{{{pairs}}} {v}")
+            else:
+                lines.append(f"{name} {v}")
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ---------- side server ----------
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port, host="127.0.0.1"):
+    # /metrics on a daemon thread, for the Telegram process (no Flask server there)
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+# ---------- SQLite ----------
+# Statement time also accumulates on the active trace span as db_s.
+db_queries = histogram("db_query_seconds", "SQLite statement latency by calling helper", ["helper"])
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            dt = time.perf_counter() - start
+            db_queries.observe(dt, self.connection.helper)
+            tracing.add("db_s", dt)
+
+    def executemany(self, sql, rows):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, rows)
+        finally:
+            dt = time.perf_counter() - start
+            db_queries.observe(dt, self.connection.helper)
+            tracing.add("db_s", dt)
+
+class TimedConnection(sqlite3.Connection):
+    # sqlite3.connect(..., factory=TimedConnection); helper labels the statements
+    helper = "other"
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, rows):
+        return self.cursor().executemany(sql, rows)
+
+def caller(depth=2):
+    # name of the function that called our caller: db() -> the helper using it
+    # ("SessionStore.flush" on 3.11+, where code objects carry the qualified name)
+    code = sys._getframe(depth).f_code
+    return getattr(code, "co_qualname", code.co_name)
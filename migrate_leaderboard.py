@@ -0,0 +1,7 @@
+# migrate_leaderboard.py
+# Creates the leaderboard tables and backfills them from quiz history
+import app
+
+app.init_db()
+n = app.rebuild_leaderboards()
+print(f"Leaderboards rebuilt from {n} history rows")
@@ -0,0 +1,61 @@
+# migrate_lesson_bodies.py
+# Moves lessons.intro_json / questions_json into content-addressed, compressed
+# lesson_bodies rows, then VACUUMs and prints a before/after report of the DB size
+# and load_lesson latency.
+import random, sqlite3, time
+import app
+
+BATCH = 500
+SAMPLE = 200
+
+def db_size():
+    con = sqlite3.connect(app.DB_PATH)
+    pages, page_size = con.execute("PRAGMA page_count").fetchone()[0], con.execute("PRAGMA page_size").fetchone()[0]
+    con.close()
+    return pages * page_size
+
+def time_load(ids):
+    # cold: first pass after clearing the body cache; warm: second pass
+    app._read_lesson_body.cache_clear(); app.state.lessons.clear()
+    out = []
+    for _ in range(2):
+        t0 = time.perf_counter()
+        for i in ids:
+            app.load_lesson(i)
+        out.append((time.perf_counter() - t0) / max(1, len(ids)) * 1000)
+    return out
+
+app.init_db()
+con = app.db(); cur = con.cursor()
+cur.execute("SELECT id FROM lessons")
+all_ids = [r[0] for r in cur.fetchall()]
+sample = random.sample(all_ids, min(SAMPLE, len(all_ids)))
+size_before = db_size()
+load_before = time_load(sample)
+
+moved, last = 0, 0
+while True:
+    cur.execute("""SELECT id, intro_json, questions_json FROM lessons
+                   WHERE id>? AND body_hash IS NULL ORDER BY id LIMIT ?""", (last, BATCH))
+    rows = cur.fetchall()
+    if not rows:
+        break
+    for r in rows:
+        intro, questions = app.lesson_content({"body_hash": None, "intro_json": r["intro_json"], "questions_json": r["questions_json"]})
+        h = app.store_lesson_body(cur, intro, questions)
+        cur.execute("UPDATE lessons SET body_hash=?, intro_json=NULL, questions_json=NULL WHERE id=?", (h, r["id"]))
+        app.invalidate_lesson(r["id"])
+    con.commit()  # short write transactions, one per batch
+    moved += len(rows); last = rows[-1]["id"]
+cur.execute("SELECT COUNT(*) FROM lesson_bodies")
+bodies = cur.fetchone()[0]
+con.close()
+
+con = sqlite3.connect(app.DB_PATH); con.execute("VACUUM"); con.close()
+size_after = db_size()
+load_after = time_load(sample)
+
+print(f"Lessons migrated: {moved} ({len(all_ids)} total), distinct bodies: {bodies}")
+print(f"DB size: {size_before / 1e6:.2f} MB -> {size_after / 1e6:.2f} MB")
+print(f"load_lesson (ms/call, cold/warm over {len(sample)} lessons): "
+      f"{load_before[0]:.3f}/{load_before[1]:.3f} -> {load_after[0]:.3f}/{load_after[1]:.3f}")
@@ -0,0 +1,117 @@
+# similarity.py
+# Near-duplicate detection for lesson text using character n-gram shingles and
+# bottom-k MinHash sketches. Pure Python, no external service.
+import re
+import threading
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict
+from itertools import chain
+
+SHINGLE = 3     # character n-gram size
+SKETCH = 64     # bottom-k sketch size
+
+# word characters plus the Indic blocks, whose vowel signs are not \w
+_NON_WORD = re.compile(r"[^\w\u0900-\u0DFF]+")
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return " ".join(_NON_WORD.sub(" ", text).replace("_", " ").split())
+
+def shingles(text, n=SHINGLE):
+    words = normalize(text).split()
+    grams = set()
+    for w in words:
+        w = f" {w} "
+        if len(w) <= n:
+            grams.add(w)
+            continue
+        for i in range(len(w) - n + 1):
+            grams.add(w[i:i + n])
+    return {zlib.crc32(g.encode("utf-8")) for g in grams}
+
+def sketch(text, k=SKETCH):
+    return frozenset(sorted(shingles(text))[:k])
+
+def similarity(a, b, k=SKETCH):
+    # Bottom-k estimate of the Jaccard similarity of the full shingle sets: the share
+    # of the k smallest hashes of the union that both sketches hold. (Any of those in
+    # a set is also in its own bottom-k sketch, so membership is exact; sketches of
+    # sets smaller than k are the sets themselves, and the estimate is then exact.)
+    if not a or not b:
+        return 0.0
+    union = sorted(a | b)[:k]
+    return sum(1 for h in union if h in a and h in b) / len(union)
+
+def dedupe(texts, threshold):
+    # keeps the first text of every group of near-duplicates, preserving order
+    kept, sketches = [], []
+    for t in texts:
+        s = sketch(t)
+        if any(similarity(s, o) >= threshold for o in sketches):
+            continue
+        kept.append(t); sketches.append(s)
+    return kept
+
+class SimilarityIndex:
+    # Sketches grouped by an owner key (e.g. (wa_id, subject)). Groups are loaded on
+    # first use through `loader(key) -> [(doc_id, text), ...]` and at most
+    # `max_keys` groups stay in memory (least recently used are dropped).
+    # Candidate documents come from an inverted index over sketch hashes, so a lookup
+    # only scores documents that share at least `min_shared` hashes with the query.
+
+    def __init__(self, loader, max_keys=5000, min_shared=8):
+        self.loader = loader
+        self.max_keys = max_keys
+        self.min_shared = min_shared
+        self._lock = threading.Lock()
+        self._groups = OrderedDict()  # key -> (docs {doc_id: sketch}, postings {hash: set(doc_id)})
+
+    def _group(self, key):
+        with self._lock:
+            g = self._groups.get(key)
+            if g is not None:
+                self._groups.move_to_end(key)
+                return g
+        rows = self.loader(key)
+        g = ({}, {})
+        for doc_id, text in rows:
+            self._add(g, doc_id, sketch(text))
+        with self._lock:
+            self._groups[key] = g
+            self._groups.move_to_end(key)
+            while len(self._groups) > self.max_keys:
+                self._groups.popitem(last=False)
+        return g
+
+    @staticmethod
+    def _add(g, doc_id, sk):
+        docs, postings = g
+        docs[doc_id] = sk
+        for h in sk:
+            postings.setdefault(h, set()).add(doc_id)
+
+    def add(self, key, doc_id, text):
+        # only groups already in memory are updated; others pick the row up on load
+        with self._lock:
+            g = self._groups.get(key)
+            if g is not None:
+                self._add(g, doc_id, sketch(text))
+
+    def forget(self, key):
+        with self._lock:
+            self._groups.pop(key, None)
+
+    def nearest(self, key, text=None, sk=None):
+        sk = sk if sk is not None else sketch(text)
+        docs, postings = self._group(key)
+        counts = Counter(chain.from_iterable(postings.get(h, ()) for h in sk))
+        need = min(self.min_shared, max(1, len(sk) // 4))  # short texts have small sketches
+        best_id, best = None, 0.0
+        for doc_id, shared in counts.items():
+            if shared < need:
+                continue
+            score = similarity(sk, docs[doc_id])
+            if score > best:
+                best_id, best = doc_id, score
+        return best_id, best
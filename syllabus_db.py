@@ -1,9 +1,13 @@
 # syllabus_db.py
+import os
 import sqlite3
-DB_PATH = 'mvp.db'
+import sys
+import threading
+import time
+DB_PATH = os.environ.get('SYLLABUS_DB', 'syllabus.db')
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
+def init_db(path=None):
+    conn = sqlite3.connect(path or DB_PATH)
     cur = conn.cursor()
     cur.execute('''
         CREATE TABLE IF NOT EXISTS syllabus (
@@ -16,18 +20,41 @@ def init_db():
             description TEXT
         )
     ''')
+    # Older loads inserted the same topic several times; keep the first copy so the
+    # natural key below can be enforced.
+    cur.execute('''
+        DELETE FROM syllabus WHERE id NOT IN (
+            SELECT MIN(id) FROM syllabus GROUP BY board, grade, subject, academic_year, topic
+        )
+    ''')
+    cur.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_syllabus_key
+        ON syllabus (board, grade, subject, academic_year, topic)
+    ''')
     conn.commit()
     conn.close()
 
+UPSERT_SQL = '''
+    INSERT INTO syllabus (board, grade, subject, academic_year, topic, description)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (board, grade, subject, academic_year, topic)
+    DO UPDATE SET description=excluded.description
+'''
+
 def insert_syllabus(board, grade, subject, academic_year, topic, description):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO syllabus (board, grade, subject, academic_year, topic, description)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (board, grade, subject, academic_year, topic, description))
-    conn.commit()
-    conn.close()
+    bulk_load_syllabus([(board, grade, subject, academic_year, topic, description)])
+
+def bulk_load_syllabus(rows, path=None):
+    # rows: iterable of (board, grade, subject, academic_year, topic, description).
+    # One transaction for the whole load; re-running it only refreshes descriptions.
+    rows = [(b, int(g), s, y, t, d) for b, g, s, y, t, d in rows]
+    conn = sqlite3.connect(path or DB_PATH)
+    try:
+        with conn:
+            conn.executemany(UPSERT_SQL, rows)
+    finally:
+        conn.close()
+    return len(rows)
 
 def get_syllabus(board, grade, subject, academic_year):
     conn = sqlite3.connect(DB_PATH)
@@ -35,11 +62,113 @@ def get_syllabus(board, grade, subject, academic_year):
     cur.execute('''
         SELECT topic, description FROM syllabus
         WHERE board=? AND grade=? AND subject=? AND academic_year=?
+        ORDER BY id
     ''', (board, grade, subject, academic_year))
     results = cur.fetchall()
     conn.close()
     return results
 
+# ---------- In-process topic index ----------
+def _norm(s):
+    return sys.intern((s or '').strip().casefold())
+
+def _grade(g):
+    try:
+        return int(str(g).strip())
+    except (TypeError, ValueError):
+        return None
+
+# Read-only copy of the syllabus grouped by (board, grade, subject) into tuples of
+# interned topic strings (syllabus order). The file is stat()ed at most every
+# `check_every` seconds and the index is rebuilt only if the syllabus rows changed.
+class TopicIndex:
+    def __init__(self, path=None, check_every=30.0):
+        self.path = path
+        self.check_every = check_every
+        self._lock = threading.Lock()
+        self._topics = {}
+        self._sets = {}
+        self._stat = None
+        self._fingerprint = None
+        self._checked_at = 0.0
+
+    def _file_stat(self):
+        path = self.path or DB_PATH
+        sig = []
+        for p in (path, path + '-wal'):
+            try:
+                st = os.stat(p)
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    def _load(self):
+        path = self.path or DB_PATH
+        if not os.path.exists(path):
+            return None, {}
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='syllabus'")
+            if not cur.fetchone():
+                return None, {}
+            fingerprint = cur.execute('SELECT COUNT(*), COALESCE(MAX(id), 0) FROM syllabus').fetchone()
+            if fingerprint == self._fingerprint:
+                return fingerprint, None
+            grouped = {}
+            for board, grade, subject, topic in cur.execute(
+                    'SELECT board, grade, subject, topic FROM syllabus ORDER BY id'):
+                if not topic:
+                    continue
+                key = (_norm(board), _grade(grade), _norm(subject))
+                seen = grouped.setdefault(key, {})
+                seen.setdefault(sys.intern(topic), None)  # dict keeps order, drops repeats
+            return fingerprint, {k: tuple(v) for k, v in grouped.items()}
+        finally:
+            conn.close()
+
+    def refresh(self, force=False):
+        with self._lock:
+            self._checked_at = time.monotonic()
+            stat = self._file_stat()
+            if not force and stat == self._stat and self._fingerprint is not None:
+                return False
+            self._stat = stat
+            if force:
+                self._fingerprint = None
+            fingerprint, topics = self._load()
+            if topics is None:
+                return False
+            self._topics = topics
+            self._sets = {k: frozenset(v) for k, v in topics.items()}
+            self._fingerprint = fingerprint
+            return True
+
+    def _maybe_refresh(self):
+        if self._fingerprint is None or time.monotonic() - self._checked_at >= self.check_every:
+            try:
+                self.refresh()
+            except sqlite3.Error:
+                pass  # keep serving the last good copy
+
+    def topics(self, board, grade, subject):
+        self._maybe_refresh()
+        return self._topics.get((_norm(board), _grade(grade), _norm(subject)), ())
+
+    def unseen(self, board, grade, subject, seen):
+        topics = self.topics(board, grade, subject)
+        if not seen:
+            return topics
+        if not isinstance(seen, (set, frozenset)):
+            seen = set(seen)
+        key = (_norm(board), _grade(grade), _norm(subject))
+        if self._sets.get(key, frozenset()).isdisjoint(seen):
+            return topics
+        return tuple(t for t in topics if t not in seen)
+
+topic_index = TopicIndex()
+
 if __name__ == '__main__':
     init_db()
 
@@ -260,15 +389,14 @@ if __name__ == '__main__':
         'Computer Science': 'Unit from ICT/Computer Science',
     }
 
-    # Insert all topics for Grades 6 to 12
+    # Insert all topics for Grades 6 to 12 in a single transaction
+    rows = []
     for grade in syllabus_data:
         board = 'Maharashtra' if grade == 6 else 'CBSE'  # Add logic for other boards as needed
-        academic_year = '2025-26'
-        if grade not in syllabus_data:
-            continue
         for subject, topics in syllabus_data[grade].items():
             for topic in topics:
-                insert_syllabus(board, grade, subject, academic_year, topic, subject_desc.get(subject, ''))
+                rows.append((board, grade, subject, academic_year, topic, subject_desc.get(subject, '')))
+    print(f"Loaded {bulk_load_syllabus(rows)} syllabus rows into {DB_PATH}")
 
     # Display all stored syllabus for Grades 6 to 12, using correct board per grade
     for grade in range(6, 13):
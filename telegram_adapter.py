@@ -4,7 +4,9 @@ import re
 import json
 import asyncio
 import logging
-import requests
+import time
+import string
+from functools import lru_cache
 from dotenv import load_dotenv
 import sqlite3
 from typing import Optional
@@ -59,30 +61,30 @@ def subjects_for_user(wa_id):
         return ["Mathematics", "Science", "English", "Social Science"]
 
 def parse_board_choice(text):
-    # Parse board choice from user input (A/B/C or CBSE/ICSE/State)
+    # Parse board choice from user input (A/B/C, or CBSE/ICSE/State in any spelling)
     t = (text or "").strip().lower()
-    if t in ("a", "cbse"): return "CBSE"
-    if t in ("b", "icse"): return "ICSE"
-    if t in ("c", "state"): return "State"
-    return None
+    if t == "a": return "CBSE"
+    if t == "b": return "ICSE"
+    if t == "c": return "State"
+    return matching.match_board(t)
 
 def best_match_state(text):
-    # Fuzzy match user input to a state name
-    t = (text or "").strip().lower()
-    for s in IN_STATES:
-        if t == s.lower():
-            return s
-    # Try partial match
-    for s in IN_STATES:
-        if t in s.lower():
-            return s
-    return None
+    # "mh", "maha", "महाराष्ट्र" -> "Maharashtra"; None when unclear
+    return matching.match_state(text)
 
 # ---------- Logging ----------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 
 # ---------- Load engine (your app.py) ----------
 import app as engine  # uses your DB, AI, helpers, logger
+import syllabus_db
+import userlocks
+import broadcast
+import gazetteer
+import matching
+import logpipe
+import metrics
+import tracing
 _engine_flask_app = engine.create_app()  # initializes DB, Gemini, logger, etc.
 logger = engine.logger  # reuse same logger
 
@@ -121,18 +123,10 @@ def ensure_user_subjects_table():
 ensure_user_subjects_table()
 
 def get_user_subject_level(wa_id, subject):
-    conn = engine.db(); cur = conn.cursor()
-    cur.execute('SELECT level FROM user_subjects WHERE wa_id=? AND subject=?', (wa_id, subject))
-    row = cur.fetchone(); conn.close()
-    return row['level'] if row else 1
+    return engine.get_subject_level(wa_id, subject)
 
 def set_user_subject_level(wa_id, subject, level):
-    conn = engine.db(); cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO user_subjects (wa_id, subject, level) VALUES (?, ?, ?)
-        ON CONFLICT(wa_id, subject) DO UPDATE SET level=excluded.level
-    ''', (wa_id, subject, level))
-    conn.commit(); conn.close()
+    engine.set_subject_level(wa_id, subject, level)
 
 # ---------- Add mastered_topics table if not exists ----------
 def ensure_mastered_topics_table():
@@ -183,8 +177,6 @@ IN_STATES = [
     "Ladakh","Lakshadweep","Puducherry"
 ]
 
-USER_AGENT = "btrlrn-edu-bot/1.0 (contact: support@example.com)"
-
 ADMIN_IDS = {8140354366}
 
 # ---------- i18n ----------
@@ -231,10 +223,12 @@ CAT = {
             "SUBJECT — choose subject\n"
             "PROFILE — edit profile\n"
             "STATS — see your scores\n"
+            "DAILY 7:30 — a new topic every day at that time\n"
             "RESET — reset session"
         ),
         "FINISH_PROFILE": "Let’s finish your profile first. 👍",
         "GENERATING": "💡 Generating today’s topic…",
+        "GENERATING_BUSY": "⏳ Your lesson is still being prepared. It will arrive here shortly.",
         "TOPIC": "📚 Today’s topic: {title} — Level {level}\n\n{intro}\n\nType *QUIZ* to begin.",
         "NO_LESSON": "Type START first to get today’s lesson.",
         "QUIZ_DONE": "You’ve completed today’s questions. Type START to begin again.",
@@ -245,9 +239,20 @@ CAT = {
         "PROFILE_UPDATED": "Profile updated. Type START to continue.",
         "PLEASE_ABCD": "Please tap A, B, C, or D.",
         "AI_ERROR": "Sorry, I couldn’t generate today’s topic. Please try START again.",
-        "RANK": "🏆 Leaderboard (MVP mock):\n1) You — 3 pts\n2) Student B — 2 pts\n3) Student C — 1 pt",
+        "RANK_HEADER": "🏆 This week — {subject}:",
+        "RANK_ROW": "{n}) {name} — {pts} pts",
+        "RANK_YOU": "{scope}: you are #{rank} with {pts} pts",
+        "RANK_CLASS": "Class",
+        "RANK_CITY": "City",
+        "RANK_STATE": "State",
+        "RANK_EMPTY": "🏆 No scores on the leaderboard this week yet. Finish a quiz to get on it!",
         "RESET_OK": "Session reset. Type START to begin.",
-        "STATS_HEADER": "📈 Recent quizzes:",
+        "STATS_HEADER": "📈 Your progress:",
+        "STATS_ROW": "- {subject} L{level}: {acc} ({correct}/{questions}), {attempts} quizzes, streak {streak} (best {best})",
+        "STATS_TREND": "  last 7 days: {acc} {arrow}",
+        "DAILY_SET": "⏰ You’ll get a new topic every day at {time} (IST). Type DAILY OFF to stop.",
+        "DAILY_OFF": "Daily topic turned off. Type DAILY 7:30 to turn it back on.",
+        "DAILY_USAGE": "Type DAILY followed by a time, e.g. DAILY 7:30 or DAILY 19:00.",
         "STATS_EMPTY": "No quiz history yet. Type START to begin!",
     },
     "hi": {
@@ -292,10 +297,12 @@ CAT = {
             "SUBJECT — विषय चुनें\n"
             "PROFILE — प्रोफ़ाइल बदलें\n"
             "STATS — आपके स्कोर\n"
+            "DAILY 7:30 — रोज़ इस समय नया टॉपिक\n"
             "RESET — सत्र रीसेट करें"
         ),
         "FINISH_PROFILE": "पहले आपकी प्रोफ़ाइल पूरी कर लें। 👍",
         "GENERATING": "💡 आज का टॉपिक बना रहा हूँ…",
+        "GENERATING_BUSY": "⏳ आपका लेसन अभी तैयार हो रहा है। थोड़ी देर में यहीं आ जाएगा।",
         "TOPIC": "📚 आज का टॉपिक: {title} — Level {level}\n\n{intro}\n\nशुरू करने के लिए *QUIZ* लिखें।",
         "NO_LESSON": "पहले START लिखकर आज का लेसन लें।",
         "QUIZ_DONE": "आज के प्रश्न पूरे हो गए। नया शुरू करने के लिए START लिखें।",
@@ -306,9 +313,20 @@ CAT = {
         "PROFILE_UPDATED": "प्रोफ़ाइल अपडेट हुई। आगे बढ़ने के लिए START लिखें।",
         "PLEASE_ABCD": "कृपया A, B, C या D पर टैप करें।",
         "AI_ERROR": "क्षमा करें, अभी टॉपिक नहीं बना सका। कृपया START फिर से लिखें।",
-        "RANK": "🏆 लीडरबोर्ड (MVP):\n1) आप — 3\n2) Student B — 2\n3) Student C — 1",
+        "RANK_HEADER": "🏆 इस सप्ताह — {subject}:",
+        "RANK_ROW": "{n}) {name} — {pts} अंक",
+        "RANK_YOU": "{scope}: आप #{rank} पर हैं, {pts} अंक",
+        "RANK_CLASS": "कक्षा",
+        "RANK_CITY": "शहर",
+        "RANK_STATE": "राज्य",
+        "RANK_EMPTY": "🏆 इस सप्ताह लीडरबोर्ड पर अभी कोई स्कोर नहीं। क्विज़ पूरा करें और जगह बनाएँ!",
         "RESET_OK": "सत्र रीसेट हुआ। START लिखें।",
-        "STATS_HEADER": "📈 हाल के क्विज़:",
+        "STATS_HEADER": "📈 आपकी प्रगति:",
+        "STATS_ROW": "- {subject} L{level}: {acc} ({correct}/{questions}), {attempts} क्विज़, लगातार {streak} (सर्वश्रेष्ठ {best})",
+        "STATS_TREND": "  पिछले 7 दिन: {acc} {arrow}",
+        "DAILY_SET": "⏰ आपको रोज़ {time} (IST) पर नया टॉपिक मिलेगा। बंद करने के लिए DAILY OFF लिखें।",
+        "DAILY_OFF": "रोज़ का टॉपिक बंद कर दिया गया। फिर से शुरू करने के लिए DAILY 7:30 लिखें।",
+        "DAILY_USAGE": "DAILY के बाद समय लिखें, जैसे DAILY 7:30 या DAILY 19:00।",
         "STATS_EMPTY": "अभी कोई क्विज़ नहीं। START लिखें!",
     },
     "mr": {
@@ -353,10 +371,12 @@ CAT = {
             "SUBJECT — विषय निवडा\n"
             "PROFILE — प्रोफाइल बदला\n"
             "STATS — तुमचे स्कोअर्स\n"
+            "DAILY 7:30 — रोज या वेळी नवीन विषय\n"
             "RESET — सत्र रीसेट"
         ),
         "FINISH_PROFILE": "आधी तुमची प्रोफाइल पूर्ण करूया. 👍",
         "GENERATING": "💡 आजचा विषय तयार करत आहे…",
+        "GENERATING_BUSY": "⏳ तुमचा लेसन अजून तयार होत आहे. थोड्याच वेळात इथे येईल.",
         "TOPIC": "📚 आजचा विषय: {title} — Level {level}\n\n{intro}\n\nसुरू करण्यासाठी *QUIZ* लिहा.",
         "NO_LESSON": "पहिले START लिहा आणि आजचा लेसन घ्या.",
         "QUIZ_DONE": "आजचे प्रश्न पूर्ण. नवीन सुरू करण्यासाठी START लिहा.",
@@ -367,18 +387,60 @@ CAT = {
         "PROFILE_UPDATED": "प्रोफाइल अपडेट. पुढे जाण्यासाठी START लिहा.",
         "PLEASE_ABCD": "कृपया A, B, C किंवा D टॅप करा.",
         "AI_ERROR": "क्षमस्व, आत्ताच विषय तयार करू शकलो नाही. START पुन्हा लिहा.",
-        "RANK": "🏆 लीडरबोर्ड (MVP):\n1) तुम्ही — 3\n2) Student B — 2\n3) Student C — 1",
+        "RANK_HEADER": "🏆 या आठवड्यात — {subject}:",
+        "RANK_ROW": "{n}) {name} — {pts} गुण",
+        "RANK_YOU": "{scope}: तुम्ही #{rank} वर आहात, {pts} गुण",
+        "RANK_CLASS": "वर्ग",
+        "RANK_CITY": "शहर",
+        "RANK_STATE": "राज्य",
+        "RANK_EMPTY": "🏆 या आठवड्यात लीडरबोर्डवर अजून स्कोअर नाही. क्विझ पूर्ण करा आणि जागा मिळवा!",
         "RESET_OK": "सत्र रीसेट. START लिहा.",
-        "STATS_HEADER": "📈 अलीकडील क्विझ:",
+        "STATS_HEADER": "📈 तुमची प्रगती:",
+        "STATS_ROW": "- {subject} L{level}: {acc} ({correct}/{questions}), {attempts} क्विझ, सलग {streak} (सर्वोत्तम {best})",
+        "STATS_TREND": "  मागील 7 दिवस: {acc} {arrow}",
+        "DAILY_SET": "⏰ तुम्हाला रोज {time} (IST) वाजता नवीन विषय मिळेल. बंद करण्यासाठी DAILY OFF लिहा.",
+        "DAILY_OFF": "रोजचा विषय बंद केला. पुन्हा सुरू करण्यासाठी DAILY 7:30 लिहा.",
+        "DAILY_USAGE": "DAILY नंतर वेळ लिहा, उदा. DAILY 7:30 किंवा DAILY 19:00.",
         "STATS_EMPTY": "अजून क्विज़ नाही. START लिहा!",
     },
 }
 
+def compile_catalog(cat, base="en"):
+    # Flattens CAT into lang -> key -> message once at startup: missing keys fall back
+    # to the base language here rather than on every call, and a message is either a
+    # ready string (no placeholders) or the bound str.format of its template.
+    # Returns (compiled, problems); a translation whose placeholders differ from the
+    # base text is replaced by the base text, since it would fail at format time.
+    parse = string.Formatter().parse
+    def fields(text):
+        return {f for _, f, _, _ in parse(text) if f is not None}
+    compiled, problems = {}, []
+    for lang, entries in cat.items():
+        out = {}
+        for key in cat[base].keys() | entries.keys():
+            text = entries.get(key)
+            if text is None:
+                problems.append(f"{lang}: missing {key}")
+                text = cat[base][key]
+            elif lang != base and key in cat[base] and fields(text) != fields(cat[base][key]):
+                problems.append(f"{lang}: placeholders of {key} differ from {base}")
+                text = cat[base][key]
+            out[key] = text.format if fields(text) else text.format()
+        compiled[lang] = out
+    return compiled, problems
+
+_MSG, _i18n_problems = compile_catalog(CAT)
+for _p in _i18n_problems:
+    logger.warning(f"[I18N] {_p}")
+
 def t(key: str, lang: str, **kwargs) -> str:
-    lang = lang if lang in CAT else "en"
-    return (CAT[lang].get(key) or CAT["en"].get(key, key)).format(**kwargs)
+    msg = (_MSG.get(lang) or _MSG["en"]).get(key, key)
+    return msg if msg.__class__ is str else msg(**kwargs)
 
 # ---------- Keyboards ----------
+# Keyboards depend only on language and a few arguments, and PTB markups are
+# immutable, so each one is built once and shared.
+@lru_cache(maxsize=None)
 def kb_lang():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(CAT["en"]["LANG_EN"], callback_data="LANG:en"),
@@ -386,6 +448,7 @@ def kb_lang():
          InlineKeyboardButton(CAT["mr"]["LANG_MR"], callback_data="LANG:mr")]
     ])
 
+@lru_cache(maxsize=None)
 def kb_boards(lang):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(t("BOARD_BTN_CBSE", lang), callback_data="BOARD:CBSE"),
@@ -393,12 +456,14 @@ def kb_boards(lang):
         [InlineKeyboardButton(t("BOARD_BTN_STATE", lang), callback_data="BOARD:STATE")]
     ])
 
+@lru_cache(maxsize=None)
 def kb_yesno(lang):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(t("YES", lang), callback_data="YN:Y"),
          InlineKeyboardButton(t("NO", lang), callback_data="YN:N")]
     ])
 
+@lru_cache(maxsize=64)
 def kb_states_page(lang, start=0, size=8):
     chunk = IN_STATES[start:start+size]
     rows = [[InlineKeyboardButton(name, callback_data=f"STATE:{name}")]
@@ -412,6 +477,17 @@ def kb_states_page(lang, start=0, size=8):
         rows.append(nav)
     return InlineKeyboardMarkup(rows)
 
+def kb_state_choices(names):
+    return _kb_state_choices(tuple(names))
+
+@lru_cache(maxsize=512)
+def _kb_state_choices(names):
+    # the closest states to what was typed, instead of paging through all of them
+    rows = [[InlineKeyboardButton(name, callback_data=f"STATE:{name}")] for name in names]
+    rows.append([InlineKeyboardButton("Other…", callback_data="PG:0")])
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
 def kb_grades(lang):
     rows = []
     row = []
@@ -423,21 +499,29 @@ def kb_grades(lang):
     return InlineKeyboardMarkup(rows)
 
 def kb_subjects(subs):
+    return _kb_subjects(tuple(subs))
+
+@lru_cache(maxsize=256)
+def _kb_subjects(subs):
     return InlineKeyboardMarkup([[InlineKeyboardButton(name, callback_data=f"SUBJ:{i}")]
                                  for i, name in enumerate(subs)])
 
-def kb_abcd():
+@lru_cache(maxsize=None)
+def kb_abcd(q_index=0):
+    # ANS:<choice>:<q_index>, so a tap is tied to the question it was shown with
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("A", callback_data="ANS:A"), InlineKeyboardButton("B", callback_data="ANS:B")],
-        [InlineKeyboardButton("C", callback_data="ANS:C"), InlineKeyboardButton("D", callback_data="ANS:D")],
+        [InlineKeyboardButton(c, callback_data=f"ANS:{c}:{q_index}") for c in "AB"],
+        [InlineKeyboardButton(c, callback_data=f"ANS:{c}:{q_index}") for c in "CD"],
     ])
 
 
+@lru_cache(maxsize=None)
 def kb_next_question():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Next Question", callback_data="NEXTQ")]
     ])
 
+@lru_cache(maxsize=None)
 def kb_continue():
     return InlineKeyboardMarkup([
         [
@@ -461,26 +545,10 @@ def valid_indian_mobile10(s: str) -> bool:
     return bool(re.match(r"^[6-9]\d{9}$", s or ""))
 
 # ---------- Geocoding ----------
-def lookup_state_from_city(city: str) -> str | None:
-    try:
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {"city": city, "country": "India", "format": "json", "addressdetails": 1, "limit": 1}
-        headers = {"User-Agent": USER_AGENT}
-        r = requests.get(url, params=params, headers=headers, timeout=8)
-        r.raise_for_status()
-        arr = r.json()
-        if not arr: return None
-        addr = arr[0].get("address", {})
-        state = addr.get("state") or addr.get("state_district")
-        if state in IN_STATES:
-            return state
-        for s in IN_STATES:
-            if s.lower() == (state or "").lower():
-                return s
-        return None
-    except Exception as e:
-        logger.warning(f"[TG] geocode fail city={city}: {e}")
-        return None
+async def lookup_state_from_city(city: str) -> str | None:
+    # bundled gazetteer first; Nominatim only for towns it does not know
+    state = await gazetteer.lookup_state(city)
+    return state if state in IN_STATES else None
 
 # ---------- Language helpers ----------
 def get_lang(wa_id: str) -> str:
@@ -492,9 +560,15 @@ def set_lang(wa_id: str, lang: str):
     engine.upsert_user(wa_id, language=lang)
 
 # ---------- Translation using engine's Gemini ----------
-def translate_lesson_if_needed(lesson: dict, lang: str) -> dict:
+translate_seconds = metrics.histogram("translate_seconds", "Lesson translation latency, including parsing", ["lang"])
+
+def translate_lesson_if_needed(lesson: dict, lang: str, wa_id=None, subject=None) -> dict:
     if lang == "en":
         return lesson
+    with translate_seconds.time(lang), tracing.span("translate", kind="translate", lang=lang):
+        return _translate_lesson(lesson, lang, wa_id, subject)
+
+def _translate_lesson(lesson, lang, wa_id, subject):
     try:
         prompt = (
             "Translate the following lesson JSON to the target language. "
@@ -502,8 +576,9 @@ def translate_lesson_if_needed(lesson: dict, lang: str) -> dict:
             f"Target language code: {lang} "
             "Return JSON only.\n\n" + json.dumps(lesson, ensure_ascii=False)
         )
-        resp = engine.gemini_model.generate_content(prompt, generation_config={"temperature": 0.2})
+        resp = engine.gemini_call("translate", prompt, generation_config={"temperature": 0.2})
         txt = (resp.text or "").strip()
+        engine.record_token_usage(wa_id, subject, "translate", resp, prompt, txt)
         m = re.search(r"(\{.*\})", txt, flags=re.S)
         raw = m.group(1) if m else txt
         data = json.loads(raw)
@@ -513,6 +588,31 @@ def translate_lesson_if_needed(lesson: dict, lang: str) -> dict:
         logger.warning(f"[TG] translate fail; using original EN. err={e}")
     return lesson
 
+# ---------- Leaderboard ----------
+def leaderboard_text(wa_id, lang):
+    view = engine.leaderboard_view(wa_id)
+    if not view or not view["top"]:
+        return t("RANK_EMPTY", lang)
+    lines = [t("RANK_HEADER", lang, subject=view["subject"])]
+    for i, r in enumerate(view["top"], 1):
+        lines.append(t("RANK_ROW", lang, n=i, name=engine.display_name(r), pts=r["points"]))
+    for name, (rank, pts) in view["ranks"].items():
+        lines.append(t("RANK_YOU", lang, scope=t(f"RANK_{name.upper()}", lang), rank=rank, pts=pts))
+    return "\n".join(lines)
+
+def stats_text(wa_id, lang):
+    rows = engine.all_subject_stats(wa_id)
+    if not rows:
+        return t("STATS_EMPTY", lang)
+    lines = [t("STATS_HEADER", lang)]
+    for s in rows:
+        lines.append(t("STATS_ROW", lang, subject=s["subject"], level=get_user_subject_level(wa_id, s["subject"]),
+                       acc=engine.pct(s["accuracy"]), correct=s["correct"], questions=s["questions"],
+                       attempts=s["attempts"], streak=s["streak"], best=s["best_streak"]))
+        if s["questions_7d"]:
+            lines.append(t("STATS_TREND", lang, acc=engine.pct(s["accuracy_7d"]), arrow=engine.trend_arrow(s)))
+    return "\n".join(lines)
+
 # ---------- ID helpers ----------
 def uid_from_tg(update: Update) -> str:
     if update and getattr(update, 'effective_chat', None) and getattr(update.effective_chat, 'id', None):
@@ -523,6 +623,86 @@ def uid_from_tg(update: Update) -> str:
         return ""
     return ""
 
+# ---------- Per-user guard ----------
+user_locks = userlocks.AsyncKeyedLocks()
+update_dedupe = userlocks.Deduper(window=float(os.environ.get("DEDUPE_WINDOW_S", "2")))
+update_inflight = userlocks.InFlight()
+
+def per_user(handler):
+    # Runs a student's updates one at a time and drops double taps: the same callback
+    # query or message again, the same button/text at the same step within the de-dup
+    # window, or while the previous identical one is still being handled.
+    async def wrapped(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        logpipe.request_id.set(f"tg{update.update_id}")
+        wa_id = uid_from_tg(update)
+        query = getattr(update, "callback_query", None)
+        step = engine.dedupe_step(engine.get_session(wa_id) if wa_id else None)
+        if query is not None:
+            keys, key = [f"cb:{query.id}"], f"{wa_id}:btn:{query.data}:{step}"
+            command = "btn_" + (query.data or "").split(":", 1)[0].lower()
+        else:
+            m = update.message
+            command = engine.command_label(m.text if m else "")
+            keys = [f"msg:{m.chat_id}:{m.message_id}"] if m else []
+            key = f"{wa_id}:txt:{(m.text or '').strip().upper() if m else ''}:{step}"
+        engine.inbound_total.inc("telegram", command)
+        dup = [update_dedupe.seen(k) for k in keys + [key]]
+        if any(dup) or not update_inflight.begin(key):
+            logger.info(f"[TG] DUPLICATE from={wa_id} key={key!r} dropped", extra=logpipe.HOT)
+            if query is not None:
+                try:
+                    await query.answer()
+                except Exception:
+                    pass
+            return
+        # START typed while the Continue button's lesson is still being made (or the
+        # other way round): different keys, same lesson, so one at a time per student
+        generates = starts_lesson(update)
+        try:
+            if generates and not engine.generating.begin(wa_id):
+                logger.info(f"[TG] start_in_progress from={wa_id} key={key!r}", extra=logpipe.HOT)
+                generates = False
+                busy = t("GENERATING_BUSY", get_lang(wa_id))
+                if query is not None:
+                    await query.answer(busy)
+                elif update.message:
+                    await update.message.reply_text(busy)
+                return
+            async with user_locks.hold(wa_id):
+                with tracing.span(f"telegram {command}", req=f"tg{update.update_id}"):
+                    return await handler(update, ctx)
+        finally:
+            if generates:
+                engine.generating.end(wa_id)
+            update_inflight.end(key)
+    return wrapped
+
+_bot_loop = None   # the bot's event loop, for run_locked() from other threads
+
+async def _remember_loop(application):
+    global _bot_loop
+    _bot_loop = asyncio.get_running_loop()
+
+def run_locked(wa_id, fn):
+    # fn() under the student's per_user lock, from a thread outside the event loop
+    # (the broadcast sender); runs it directly when the bot is not running
+    if _bot_loop is None or not _bot_loop.is_running():
+        return fn()
+
+    async def locked():
+        async with user_locks.hold(wa_id):
+            return fn()
+    return asyncio.run_coroutine_threadsafe(locked(), _bot_loop).result(timeout=30)
+
+def starts_lesson(update):
+    # updates that end in ai_generate_lesson
+    query = getattr(update, "callback_query", None)
+    if query is not None:
+        data = query.data or ""
+        return data in ("START", "CONTINUE_LEARNING") or data.startswith("SUBJ:")
+    m = update.message
+    return bool(m and (m.text or "").strip().upper() == "START")
+
 def step_header(lang: str, n: int, title_key: str) -> str:
     return f"{t('STEP', lang, n=n, title=t(title_key, lang))}"
 
@@ -551,16 +731,16 @@ async def send_quiz_question(update_or_query, wa_id, lesson, q_index):
                 try:
                     await update_or_query.message.reply_photo(photo=image_url, caption=q['q'])
                     return await update_or_query.message.reply_text(
-                            "\n".join(q['options']), reply_markup=kb_abcd(), parse_mode="Markdown"
+                            "\n".join(q['options']), reply_markup=kb_abcd(q_index), parse_mode="Markdown"
                     )
                 except Exception as e:
                     logger.warning(f"[TG] Failed to send image: {image_url} error: {e}")
                     # fallback to text only
-                    return await update_or_query.message.reply_text(textq, reply_markup=kb_abcd())
+                    return await update_or_query.message.reply_text(textq, reply_markup=kb_abcd(q_index))
             else:
-                return await update_or_query.message.reply_text(textq, reply_markup=kb_abcd())
+                return await update_or_query.message.reply_text(textq, reply_markup=kb_abcd(q_index))
         if update_or_query.callback_query is not None:
-            return await update_or_query.callback_query.edit_message_text(textq, reply_markup=kb_abcd())
+            return await update_or_query.callback_query.edit_message_text(textq, reply_markup=kb_abcd(q_index))
     # fallback: do nothing if neither is available
     return
 
@@ -598,24 +778,59 @@ async def admin_stats_handler(update, context):
         if getattr(update, 'message', None):
             return await update.message.reply_text("Not authorized.")
         return
-    import sqlite3
-    conn = engine.db(); conn.row_factory = sqlite3.Row; cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS total FROM users WHERE wa_id LIKE 'telegram:%'")
-    total = cur.fetchone()["total"]
-    cur.execute("SELECT COUNT(*) AS online FROM users WHERE wa_id LIKE 'telegram:%' AND last_seen >= datetime('now','-10 minutes')")
-    online = cur.fetchone()["online"]
-    cur.execute("SELECT COUNT(*) AS dau FROM users WHERE wa_id LIKE 'telegram:%' AND last_seen >= date('now')")
-    dau = cur.fetchone()["dau"]
-    cur.execute("SELECT COUNT(*) AS wau FROM users WHERE wa_id LIKE 'telegram:%' AND last_seen >= date('now','-6 days')")
-    wau = cur.fetchone()["wau"]
-    conn.close()
+    s = engine.activity_stats("telegram")
+    c = engine.state.stats()
     if getattr(update, 'message', None):
         return await update.message.reply_text(
-            f"👥 Total: {total}\n🟢 Online(10m): {online}\n📅 DAU: {dau}\n📈 WAU: {wau}",
+            f"👥 Total: {s['total']}\n🟢 Online(10m): {s['online']}\n📅 DAU: {s['dau']}\n📈 WAU: {s['wau']}\n🗓️ MAU: {s['mau']}\n✉️ Msgs today: {s['messages']}"
+            f"\n🗃️ Lesson cache ({c['backend']}): {engine.pct(c['hit_rate'])} hits",
             parse_mode="Markdown"
         )
     return
 
+async def admin_tokens_handler(update, context):
+    if not (update.effective_user and update.effective_user.id in ADMIN_IDS):
+        if getattr(update, 'message', None):
+            return await update.message.reply_text("Not authorized.")
+        return
+    report = engine.token_usage_report(days=30, top=10)
+    lines = ["💸 Top users by tokens (30d):"]
+    for i, r in enumerate(report["top_users"], 1):
+        lines.append(f"{i}) {r['wa_id']} — {r['tokens']} tok, {r['lessons']} lessons")
+    if not report["top_users"]:
+        lines.append("(no usage yet)")
+    lines.append("")
+    lines.append("📊 Avg tokens per lesson:")
+    for r in report["per_day"][-14:]:
+        lines.append(f"{r['day']}: {r['avg_total']:.0f} (prompt {r['avg_prompt']:.0f}) × {r['lessons']}")
+    if getattr(update, 'message', None):
+        return await update.message.reply_text("\n".join(lines))
+    return
+
+async def admin_delivery_handler(update, context):
+    if not (update.effective_user and update.effective_user.id in ADMIN_IDS):
+        if getattr(update, 'message', None):
+            return await update.message.reply_text("Not authorized.")
+        return
+    def secs(x):
+        return f"{x:.0f}s" if x is not None else "–"
+    # status callbacks are batched in the WhatsApp process, so this can lag by up to 5 s
+    lines = ["📬 WhatsApp delivery (last 12h, IST; up to 5 s behind):"]
+    for h in engine.delivery_health(hours=12):
+        lines.append(f"{h['hour'][-5:]} sent {h['sent']}, fail {engine.pct(h['fail_rate'])}, "
+                     f"delivered p50/p90 {secs(h['deliver_p50'])}/{secs(h['deliver_p90'])}, read p50 {secs(h['read_p50'])}")
+    if len(lines) == 1:
+        lines.append("(no messages)")
+    bad = engine.failing_recipients()
+    if bad:
+        lines.append("")
+        lines.append("⚠️ Repeated failures (7d):")
+        for r in bad[:10]:
+            lines.append(f"{r['to_addr']} — {r['failures']}× (code {r['error_code']})")
+    if getattr(update, 'message', None):
+        return await update.message.reply_text("\n".join(lines))
+    return
+
 async def whereami_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Admin-only command to show where the bot is running
     if not (update.effective_user and update.effective_user.id in ADMIN_IDS):
@@ -670,6 +885,7 @@ async def reset_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def contact_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     wa_id = uid_from_tg(update)
+    engine.activity.touch(wa_id)
     engine.upsert_user(wa_id, last_seen=_now_iso())
     u = rowdict(engine.get_user(wa_id))
     if not u or "first_seen" not in u or not u["first_seen"]:
@@ -687,15 +903,17 @@ async def contact_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return await update.message.reply_text(t("PHONE_BAD", lang), parse_mode="Markdown")
         return
 def topics_for_user(wa_id, board, grade, subject):
-    # Get all topics from syllabus_db (no mastery check)
-    conn = engine.db(); cur = conn.cursor()
-    cur.execute("SELECT topic FROM syllabus WHERE board=? AND grade=? AND subject=?", (board, grade, subject))
-    all_topics = [r[0] for r in cur.fetchall()]
-    conn.close()
-    return all_topics
+    # All syllabus topics for board/grade/subject (no mastery check), from the in-memory index
+    return list(syllabus_db.topic_index.topics(board, grade, subject))
+
+def unseen_topics_for_user(wa_id, board, grade, subject):
+    # Syllabus topics this student has not mastered yet, in syllabus order
+    seen = get_mastered_topics(wa_id, board, grade, subject)
+    return list(syllabus_db.topic_index.unseen(board, grade, subject, seen))
 
 async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_text: Optional[str] = None):
     wa_id = uid_from_tg(update)
+    engine.activity.touch(wa_id)
     engine.upsert_user(wa_id, last_seen=_now_iso())
     u = rowdict(engine.get_user(wa_id))
     if not u or not u.get("first_seen"):
@@ -708,7 +926,7 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
     else:
         text = (update.message.text.strip() if update.message and update.message.text else "")
         up = text.upper()
-    logger.info(f"[TG] INBOUND from={wa_id} body={text!r}")
+    logger.info(f"[TG] INBOUND from={wa_id} body={text!r}", extra=logpipe.HOT)
 
     user = rowdict(engine.get_user(wa_id))
     sess = rowdict(engine.get_session(wa_id))
@@ -789,7 +1007,7 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
                     return await update.message.reply_text(f"{step_header(lang, 8, 'GRADE')}\n{t('ASK_GRADE', lang)}", reply_markup=kb_grades(lang))
                 return
             city = (rowdict(engine.get_user(wa_id)) or {}).get("city","")
-            guessed = lookup_state_from_city(city)
+            guessed = await lookup_state_from_city(city)
             engine.upsert_user(wa_id, board="STATE")  # temporary until confirmation
             if guessed:
                 engine.set_session(wa_id, f"confirm_state:{guessed}")
@@ -825,8 +1043,11 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
         if stage.startswith("pick_state:"):
             pick = best_match_state(text)
             if not pick:
+                near = matching.state_candidates(text)
                 if update.message:
-                    return await update.message.reply_text(t("INVALID_CHOICE", lang), reply_markup=kb_states_page(lang, 0))
+                    return await update.message.reply_text(
+                        t("PICK_STATE", lang) if near else t("INVALID_CHOICE", lang),
+                        reply_markup=kb_state_choices(near) if near else kb_states_page(lang, 0))
                 return
             engine.upsert_user(wa_id, board=f"STATE: {pick}", state=pick)
             engine.set_session(wa_id, "ask_grade")
@@ -897,23 +1118,27 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
 
     if up == "RANK":
         if update.message:
-            return await update.message.reply_text(t("RANK", lang))
+            return await update.message.reply_text(leaderboard_text(wa_id, lang))
         return
 
     if up == "STATS":
-        conn = engine.db(); cur = conn.cursor()
-        cur.execute("SELECT subject, level, score, total FROM history WHERE wa_id=? ORDER BY taken_at DESC LIMIT 5", (wa_id,))
-        rows = cur.fetchall(); conn.close()
-        if not rows:
-            if update.message:
-                return await update.message.reply_text(t("STATS_EMPTY", lang))
-            return
-        lines = [t("STATS_HEADER", lang)] + [f"- {r['subject']} L{r['level']}: {r['score']}/{r['total']}" for r in rows]
         if update.message:
-            return await update.message.reply_text("\n".join(lines))
+            return await update.message.reply_text(stats_text(wa_id, lang))
         return
 
-
+    if up.startswith("DAILY"):
+        arg = text[5:].strip()
+        if arg.upper() == "OFF":
+            engine.upsert_user(wa_id, daily_time=None)
+            reply = t("DAILY_OFF", lang)
+        elif broadcast.parse_daily_time(arg):
+            engine.upsert_user(wa_id, daily_time=broadcast.parse_daily_time(arg))
+            reply = t("DAILY_SET", lang, time=broadcast.parse_daily_time(arg))
+        else:
+            reply = t("DAILY_USAGE", lang)
+        if update.message:
+            return await update.message.reply_text(reply)
+        return
 
     if up == "SUBJECT":
         # Immediately show subject options
@@ -940,7 +1165,7 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
             conn = engine.db(); cur = conn.cursor()
             cur.execute('SELECT subject, level FROM user_subjects WHERE wa_id=?', (wa_id,))
             subjects_levels = cur.fetchall()
-            logger.info(f"[DEBUG] user_subjects for {wa_id}: {subjects_levels}")
+            logger.debug(f"[DEBUG] user_subjects for {wa_id}: {subjects_levels}", extra=logpipe.HOT)
             conn.close()
         except Exception as e:
             logger.warning(f"[DEBUG] Failed to fetch user_subjects for {wa_id}: {e}")
@@ -951,8 +1176,8 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
             subject = user.get("subject") if user else None
             level = get_user_subject_level(wa_id, subject) if subject else 1
             trouble = engine.recent_trouble_concepts(wa_id, subject) if user else None
-            logger.info(f"[DEBUG] Lesson generation for wa_id={wa_id}, subject={subject!r}, level={level}")
-            raw_lesson = engine.ai_generate_lesson(
+            logger.debug(f"[DEBUG] Lesson generation for wa_id={wa_id}, subject={subject!r}, level={level}", extra=logpipe.HOT)
+            raw_lesson = await asyncio.to_thread(engine.ai_generate_lesson,
                 board=user.get("board") if user else None,
                 grade=user.get("grade") if user else None,
                 subject_label=subject,
@@ -962,7 +1187,7 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
                 recent_mistakes=trouble,
                 wa_id=wa_id
             ) if subject else None
-            lesson = translate_lesson_if_needed(raw_lesson, lang) if raw_lesson else None
+            lesson = await asyncio.to_thread(translate_lesson_if_needed, raw_lesson, lang, wa_id=wa_id, subject=subject) if raw_lesson else None
             lesson_id = engine.save_lesson(
                 wa_id=wa_id,
                 board=user.get("board") if user else None,
@@ -971,7 +1196,8 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
                 level=level,
                 title=lesson["title"] if lesson else None,
                 intro=lesson["intro"] if lesson else None,
-                questions=lesson["questions"] if lesson else None
+                questions=lesson["questions"] if lesson else None,
+                topic=raw_lesson.get("topic")
             ) if lesson else None
             engine.set_session(wa_id, "lesson", 0, 0, lesson_id)
             intro = "\n".join(lesson["intro"][:3]) if lesson and "intro" in lesson else ""
@@ -1016,7 +1242,7 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
             if update.message:
                 return await update.message.reply_text(t("QUIZ_DONE", lang))
             return
-        engine.update_session(wa_id, stage="quiz")
+        engine.update_session(wa_id, stage="quiz", q_sent_at=time.time())
         return await send_quiz_question(update, wa_id, lesson, idx)
 
     # Handle editing each profile field (accept any input when stage starts with 'edit_')
@@ -1035,7 +1261,8 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
         # Validate subject
         if field == "subject":
             subs = subjects_for_user(wa_id)
-            if value not in subs:
+            value = matching.match_subject(value, subs)
+            if not value:
                 if update.message:
                     return await update.message.reply_text(f"Invalid subject. Please pick one of: {', '.join(subs)}")
                 return
@@ -1044,7 +1271,7 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
 
         # If city is edited, re-guess state and prompt for confirmation or selection
         if field == "city":
-            guessed = lookup_state_from_city(value)
+            guessed = await lookup_state_from_city(value)
             if guessed:
                 engine.set_session(wa_id, f"confirm_state:{guessed}")
                 if update.message:
@@ -1068,8 +1295,15 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
             return await update.message.reply_text(t("PROFILE_UPDATED", lang))
         return
 
+    # a typed subject name ("maths", "विज्ञान") picks it like its letter would
+    if sess and sess.get("stage") == "choose_subject" and len(up) > 1:
+        subs = subjects_for_user(wa_id)
+        hit = matching.match_subject(text, subs)
+        if hit:
+            up = "ABCDEFGH"[subs.index(hit)]
+
     # A/B/C/D/E via text for subject/quiz/profile
-    if len(up) == 1 and up in "ABCDE":
+    if len(up) == 1 and up in "ABCDEFGH":
         # Profile editing menu
         if sess and "stage" in sess and sess["stage"] == "profile_menu":
             # Map A-E to profile fields
@@ -1115,7 +1349,7 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
                         await ctx.bot.send_message(chat_id=chat_id, text=confirm_msg, parse_mode="Markdown")
                 # Generate and send next lesson
                 trouble = engine.recent_trouble_concepts(wa_id, subject)
-                raw_lesson = engine.ai_generate_lesson(
+                raw_lesson = await asyncio.to_thread(engine.ai_generate_lesson,
                     board=user.get("board"),
                     grade=user.get("grade"),
                     subject_label=subject,
@@ -1129,7 +1363,7 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
                     if update.message:
                         return await update.message.reply_text("Could not generate lesson. Please try again.")
                     return
-                lesson = translate_lesson_if_needed(raw_lesson, lang) if raw_lesson else None
+                lesson = await asyncio.to_thread(translate_lesson_if_needed, raw_lesson, lang, wa_id=wa_id, subject=subject) if raw_lesson else None
                 lesson_id = engine.save_lesson(
                     wa_id=wa_id,
                     board=user.get("board"),
@@ -1138,7 +1372,8 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
                     level=level,
                     title=lesson["title"] if lesson else None,
                     intro=lesson["intro"] if lesson else None,
-                    questions=lesson["questions"] if lesson else None
+                    questions=lesson["questions"] if lesson else None,
+                    topic=raw_lesson.get("topic")
                 ) if lesson else None
                 engine.set_session(wa_id, "lesson", 0, 0, lesson_id)
                 intro = "\n".join(lesson["intro"][:3]) if lesson and "intro" in lesson else ""
@@ -1171,12 +1406,6 @@ async def text_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE, forced_te
         if sess and "stage" in sess and sess["stage"] == "quiz":
             user = rowdict(engine.get_user(wa_id))
             reply = engine.process_ai_answer(user, sess, up)
-            # If lesson is completed, increment level for this subject
-            if reply and "🎉" in reply:
-                subject = user.get("subject") if user else None
-                if subject:
-                    prev_level = get_user_subject_level(wa_id, subject)
-                    set_user_subject_level(wa_id, subject, prev_level + 1)
             if update.message:
                 if "🎉" in reply:
                     return await update.message.reply_text(reply)
@@ -1196,6 +1425,8 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Handle Continue Learning and Change Subject buttons simply
     query = update.callback_query if hasattr(update, 'callback_query') else None
     data = query.data if query and hasattr(query, 'data') else ""
+    if data not in ("CONTINUE_LEARNING", "SUBJECT"):  # those are counted by text_handler
+        engine.activity.touch(uid_from_tg(update))
     if data == "CONTINUE_LEARNING":
         # Simulate user sending 'Start' in chat
         await text_handler(update, ctx, forced_text="Start")
@@ -1281,7 +1512,7 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         subject = user["subject"] if user and "subject" in user else None
         level = get_user_subject_level(wa_id, subject) if subject else 1
         trouble = engine.recent_trouble_concepts(wa_id, subject)
-        raw_lesson = engine.ai_generate_lesson(
+        raw_lesson = await asyncio.to_thread(engine.ai_generate_lesson,
             board=user.get("board") if user else None,
             grade=user.get("grade") if user else None,
             subject_label=subject,
@@ -1295,7 +1526,7 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             if query and getattr(query, 'edit_message_text', None):
                 return await query.edit_message_text("Could not generate lesson. Please try again.")
             return
-        lesson = translate_lesson_if_needed(raw_lesson, lang) if raw_lesson else None
+        lesson = await asyncio.to_thread(translate_lesson_if_needed, raw_lesson, lang, wa_id=wa_id, subject=subject) if raw_lesson else None
         lesson_id = engine.save_lesson(
             wa_id=wa_id,
             board=user.get("board") if user else None,
@@ -1304,7 +1535,8 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             level=level,
             title=lesson["title"] if lesson else None,
             intro=lesson["intro"] if lesson else None,
-            questions=lesson["questions"] if lesson else None
+            questions=lesson["questions"] if lesson else None,
+            topic=raw_lesson.get("topic")
         ) if lesson else None
         engine.set_session(wa_id, "lesson", 0, 0, lesson_id)
         intro = "\n".join(lesson["intro"][:3]) if lesson and "intro" in lesson else ""
@@ -1366,7 +1598,7 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return
         city = (rowdict(engine.get_user(wa_id)) or {}).get("city","")
         engine.upsert_user(wa_id, board="STATE")
-        guessed = lookup_state_from_city(city) if city else None
+        guessed = await lookup_state_from_city(city) if city else None
         if guessed:
             engine.set_session(wa_id, f"confirm_state:{guessed}")
             if query:
@@ -1479,7 +1711,7 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                     await ctx.bot.send_message(chat_id=chat_id, text=confirm_msg, parse_mode="Markdown")
             # Generate and send next lesson
             trouble = engine.recent_trouble_concepts(wa_id, subject)
-            raw_lesson = engine.ai_generate_lesson(
+            raw_lesson = await asyncio.to_thread(engine.ai_generate_lesson,
                 board=user.get("board"),
                 grade=user.get("grade"),
                 subject_label=subject,
@@ -1493,7 +1725,7 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 if update.message:
                     return await update.message.reply_text("Could not generate lesson. Please try again.")
                 return
-            lesson = translate_lesson_if_needed(raw_lesson, lang) if raw_lesson else None
+            lesson = await asyncio.to_thread(translate_lesson_if_needed, raw_lesson, lang, wa_id=wa_id, subject=subject) if raw_lesson else None
             lesson_id = engine.save_lesson(
                 wa_id=wa_id,
                 board=user.get("board"),
@@ -1502,7 +1734,8 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 level=level,
                 title=lesson["title"] if lesson else None,
                 intro=lesson["intro"] if lesson else None,
-                questions=lesson["questions"] if lesson else None
+                questions=lesson["questions"] if lesson else None,
+                topic=raw_lesson.get("topic")
             ) if lesson else None
             engine.set_session(wa_id, "lesson", 0, 0, lesson_id)
             intro = "\n".join(lesson["intro"][:3]) if lesson and "intro" in lesson else ""
@@ -1541,12 +1774,18 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     # Answer buttons
     if data.startswith("ANS:"):
-        choice = data.split(":",1)[1]
+        _, choice, *asked = data.split(":")
         sess = rowdict(engine.get_session(wa_id))
         if not (sess and sess["stage"] == "quiz"):
             if query:
                 return await query.edit_message_text(t("SESSION_EXPIRED", lang))
             return
+        if asked and asked[0] != str(sess["q_index"]):
+            # a second tap on a question that is already answered
+            logger.info(f"[TG] {wa_id} stale answer {data} at q_index={sess['q_index']} ignored", extra=logpipe.HOT)
+            if query:
+                await query.answer()
+            return
         reply = engine.process_ai_answer(user, sess, choice)
         if query:
             if "🎉" in reply:
@@ -1566,13 +1805,21 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if query:
         return await query.answer("OK")
 
+class TracedRequest(HTTPXRequest):
+    # Bot API calls made while handling an update show up as "send" spans in its trace
+    async def do_request(self, url, method, *args, **kwargs):
+        if tracing.ref() is None:
+            return await super().do_request(url, method, *args, **kwargs)
+        with tracing.span("telegram.api", kind="send", call=url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
 if __name__ == "__main__":
     # Load your bot token from environment or config
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     if not token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN environment variable not set.")
 
-    req = HTTPXRequest(
+    req = TracedRequest(
         connect_timeout=20.0,
         read_timeout=20.0,
         write_timeout=20.0,
@@ -1580,20 +1827,43 @@ if __name__ == "__main__":
         http_version="1.1",
     )
 
-    app = Application.builder().token(token).request(req).build()
+    # concurrent updates: the per_user lock keeps each student's updates in order,
+    # and a double tap arriving while a lesson is generated meets the de-dup guards
+    app = Application.builder().token(token).request(req).concurrent_updates(True).post_init(_remember_loop).build()
 
-    app.add_handler(CommandHandler("start", start_cmd))
+    app.add_handler(CommandHandler("start", per_user(start_cmd)))
     app.add_handler(CommandHandler("adminstats", admin_stats_handler))
+    app.add_handler(CommandHandler("admintokens", admin_tokens_handler))
+    app.add_handler(CommandHandler("admindelivery", admin_delivery_handler))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("whereami", whereami_cmd))
-    app.add_handler(CommandHandler("quiz", quiz_cmd))
-    app.add_handler(CommandHandler("subject", subject_cmd))
-    app.add_handler(CommandHandler("profile", profile_cmd))
-    app.add_handler(CommandHandler("stats", stats_cmd))
-    app.add_handler(CommandHandler("reset", reset_cmd))
-
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
-    app.add_handler(CallbackQueryHandler(on_button))
+    app.add_handler(CommandHandler("quiz", per_user(quiz_cmd)))
+    app.add_handler(CommandHandler("subject", per_user(subject_cmd)))
+    app.add_handler(CommandHandler("profile", per_user(profile_cmd)))
+    app.add_handler(CommandHandler("stats", per_user(stats_cmd)))
+    app.add_handler(CommandHandler("reset", per_user(reset_cmd)))
+
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_user(text_handler)))
+    app.add_handler(CallbackQueryHandler(per_user(on_button)))
+
+    # Daily topic push for Telegram students (see broadcast.py); sends go straight to
+    # the Bot API from the broadcast thread, not through the bot's event loop
+    if os.environ.get("BROADCAST_ENABLED", "0") == "1":
+        tg_sender = broadcast.TelegramSender(token, rate=float(os.environ.get("TELEGRAM_BROADCAST_RATE", "25")))
+        broadcast.register_channel(
+            "telegram",
+            lambda lesson, level, lang: t("TOPIC", lang, title=lesson["title"], level=level, intro="\n".join(lesson["intro"][:3])),
+            tg_sender.send,
+            translate=lambda lesson, lang: translate_lesson_if_needed(lesson, lang),
+            rate=tg_sender.rate,
+            locked=run_locked)
+        broadcast.start(engine)
+
+    # Prometheus scrape endpoint; the bot has no web server of its own. METRICS_PORT=0 disables it.
+    metrics_port = int(os.environ.get("METRICS_PORT", "9464"))
+    if metrics_port:
+        metrics.serve(metrics_port, os.environ.get("METRICS_HOST", "127.0.0.1"))
+        logger.info(f"[TG] metrics on :{metrics_port}/metrics")
 
     # Run the bot
     app.run_polling()
\ No newline at end of file
@@ -0,0 +1,101 @@
+# test_kvstore.py
+# RedisBackend against two in-process StandInServer shards:
+#   python -m pytest tests   (or python -m unittest discover tests)
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import kvstore
+
+class RedisBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = [kvstore.StandInServer().start() for _ in range(2)]
+        self.backend = kvstore.RedisBackend([s.url for s in self.servers], lock_ttl_ms=2000)
+
+    def tearDown(self):
+        for s in self.servers:
+            s.shutdown(); s.server_close()
+
+    def session(self, wa_id, **fields):
+        s = {"id": self.backend.new_session_id(), "wa_id": wa_id, "stage": "idle", "q_index": 0, "score": 0,
+             "lesson_id": None, "created_at": int(time.time()), "q_sent_at": None}
+        s.update(fields)
+        return s
+
+    def test_sessions(self):
+        self.assertIsNone(self.backend.get_session("whatsapp:+911"))
+        self.assertFalse(self.backend.update_session("whatsapp:+911", {"q_index": 1}))
+        s = self.session("whatsapp:+911", stage="quiz", lesson_id=7)
+        self.backend.set_session("whatsapp:+911", s)
+        self.assertEqual(self.backend.get_session("whatsapp:+911"), s)
+        self.assertTrue(self.backend.update_session("whatsapp:+911", {"q_index": 2, "score": 1}))
+        got = self.backend.get_session("whatsapp:+911")
+        self.assertEqual((got["stage"], got["q_index"], got["score"], got["id"]), ("quiz", 2, 1, s["id"]))
+        self.backend.set_session("whatsapp:+911", self.session("whatsapp:+911"), persisted=True)
+        self.assertEqual(self.backend.get_session("whatsapp:+911")["stage"], "idle")
+        self.assertEqual(self.backend.flush(), 0)
+
+    def test_sessions_are_sharded(self):
+        for i in range(40):
+            self.backend.set_session(f"tg:{i}", self.session(f"tg:{i}"))
+        sizes = [s.run("DBSIZE", []) for s in self.servers]
+        self.assertEqual(sum(sizes), 41)   # and the session id counter
+        self.assertTrue(all(sizes))
+        for i in range(40):
+            self.assertEqual(self.backend.get_session(f"tg:{i}")["wa_id"], f"tg:{i}")
+
+    def test_session_ids_are_unique_and_increasing(self):
+        other = kvstore.RedisBackend([s.url for s in self.servers])
+        ids = [b.new_session_id() for _ in range(200) for b in (self.backend, other)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+        time.sleep(0.002)
+        self.assertGreater(other.new_session_id(), ids[-1])
+
+    def test_lessons(self):
+        lesson = {"id": 5, "title": "भिन्न", "intro": ["a"], "questions": [{"q": "?", "ans": "A"}],
+                  "subject_label": "Mathematics", "level": 1, "board": "CBSE", "grade": "7", "topic": None}
+        self.assertIsNone(self.backend.get_lesson(5))
+        self.backend.put_lesson(5, lesson)
+        self.assertEqual(self.backend.get_lesson(5), lesson)
+        self.backend.invalidate_lesson(5)
+        self.assertIsNone(self.backend.get_lesson(5))
+        stats = self.backend.stats()
+        self.assertEqual((stats["backend"], stats["nodes"], stats["hits"], stats["misses"]), ("redis", 2, 1, 2))
+
+    def test_session_expiry(self):
+        self.backend.SESSION_TTL = 1
+        self.backend.set_session("tg:1", self.session("tg:1"))
+        time.sleep(1.1)
+        self.assertIsNone(self.backend.get_session("tg:1"))
+
+    def test_lock_is_exclusive(self):
+        inside, overlaps = [0], [0]
+
+        def worker():
+            for _ in range(20):
+                with self.backend.lock("whatsapp:+912"):
+                    inside[0] += 1
+                    overlaps[0] += inside[0] > 1
+                    time.sleep(0.001)
+                    inside[0] -= 1
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(overlaps[0], 0)
+
+    def test_lock_timeout_and_release(self):
+        with self.backend.lock("whatsapp:+913"):
+            with self.assertRaises(TimeoutError):
+                with self.backend.lock("whatsapp:+913", timeout=0.05):
+                    pass
+        with self.backend.lock("whatsapp:+913", timeout=0.05):
+            pass
+
+if __name__ == "__main__":
+    unittest.main()
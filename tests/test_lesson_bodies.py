@@ -0,0 +1,64 @@
+# test_lesson_bodies.py
+# The shared lesson body cache against a throwaway SQLite file:
+#   python -m pytest tests   (or python -m unittest discover tests)
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+for k, v in {"SYLLABUS_DB": os.path.join(ROOT, "syllabus.db"), "GEOCODE_REMOTE": "0",
+             "BROADCAST_ENABLED": "0", "METRICS_PORT": "0", "LOG_LEVEL": "WARNING"}.items():
+    os.environ.setdefault(k, v)
+
+INTRO = ["Fractions name parts of a whole.", "3/4 means three of four equal parts."]
+QUESTIONS = [{"q": "What is 1/2 of 8?", "options": ["A) 2", "B) 4", "C) 6", "D) 8"], "answer": "B"}]
+
+class LessonBodyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.chdir(tempfile.mkdtemp(prefix="btrlrn_test_"))   # logs/ and mvp.db
+        os.makedirs("logs", exist_ok=True)
+        import app as engine
+        cls.engine, cls.saved_path = engine, engine.DB_PATH
+        engine.DB_PATH = os.path.abspath("mvp.db")
+        engine.init_db()
+        engine._read_lesson_body.cache_clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine._read_lesson_body.cache_clear()
+        cls.engine.DB_PATH = cls.saved_path
+
+    def store(self, intro, questions):
+        conn = self.engine.db(); cur = conn.cursor()
+        h = self.engine.store_lesson_body(cur, intro, questions)
+        conn.commit(); conn.close()
+        return h
+
+    def test_bodies_are_read_only(self):
+        h = self.store(INTRO, QUESTIONS)
+        intro, questions = self.engine.lesson_body(h)
+        self.assertEqual((list(intro), questions[0]["options"][1]), (INTRO, "B) 4"))
+        self.assertIs(self.engine.lesson_body(h)[1], questions)
+        with self.assertRaises(AttributeError):
+            intro.append("more")
+        with self.assertRaises(TypeError):
+            questions[0]["answer"] = "C"
+        with self.assertRaises(TypeError):
+            questions[0].update(answer="C")
+        self.assertEqual(self.engine.lesson_body(h)[1][0]["answer"], "B")
+        self.assertEqual(json.loads(json.dumps({"intro": intro, "questions": questions})),
+                         {"intro": INTRO, "questions": QUESTIONS})
+        self.assertEqual(self.engine.encode_lesson_body(intro, questions)[0], h)
+
+    def test_missing_body_is_not_cached(self):
+        h = self.engine.encode_lesson_body(["Later"], [])[0]
+        self.assertEqual(self.engine.lesson_body(h), ((), ()))
+        self.store(["Later"], [])
+        self.assertEqual(self.engine.lesson_body(h), (("Later",), ()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+# test_matching.py
+# Subject matching against the real subject lists in syllabus.db:
+#   python -m pytest tests   (or python -m unittest discover tests)
+import os
+import sqlite3
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import matching
+
+def syllabus_subjects():
+    conn = sqlite3.connect(os.path.join(ROOT, "syllabus.db"))
+    rows = conn.execute("SELECT DISTINCT board, grade, subject FROM syllabus ORDER BY id").fetchall()
+    conn.close()
+    lists = {}
+    for board, grade, subject in rows:
+        lists.setdefault((board, grade), []).append(subject)
+    return lists
+
+class SubjectMatchTest(unittest.TestCase):
+    def test_every_subject_resolves_to_itself(self):
+        lists = syllabus_subjects()
+        self.assertTrue(lists)
+        for (board, grade), subjects in lists.items():
+            for subject in subjects:
+                for text in (subject, subject.lower(), subject.upper()):
+                    with self.subTest(board=board, grade=grade, text=text):
+                        self.assertEqual(matching.match_subject(text, subjects), subject)
+
+    def test_concept_aliases_prefer_the_plain_subject(self):
+        subjects = ["English", "Hindi", "Mathematics", "Science", "History", "Geography", "Civics", "Sanskrit",
+                    "Computer Science"]
+        for text, want in (("sci", "Science"), ("evs", "Science"), ("विज्ञान", "Science"), ("maths", "Mathematics"),
+                           ("cs", "Computer Science"), ("computer", "Computer Science")):
+            with self.subTest(text=text):
+                self.assertEqual(matching.match_subject(text, subjects), want)
+        self.assertEqual(matching.match_subject("science", ["Mathematics", "Computer Science"]), "Computer Science")
+        self.assertIsNone(matching.match_subject("sst", subjects))   # history, geography or civics
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# test_next_topic.py
+# Topic choice from the real syllabus.db, with mastery and lessons in a throwaway mvp.db:
+#   python -m pytest tests   (or python -m unittest discover tests)
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+for k, v in {"SYLLABUS_DB": os.path.join(ROOT, "syllabus.db"), "GEOCODE_REMOTE": "0",
+             "BROADCAST_ENABLED": "0", "METRICS_PORT": "0", "LOG_LEVEL": "WARNING"}.items():
+    os.environ.setdefault(k, v)
+
+class NextTopicTest(unittest.TestCase):
+    # CBSE Mathematics starts with "Integers" in grade 7 and has it in grade 6 as well
+    @classmethod
+    def setUpClass(cls):
+        os.chdir(tempfile.mkdtemp(prefix="btrlrn_test_"))   # logs/ and mvp.db
+        os.makedirs("logs", exist_ok=True)
+        import app as engine
+        cls.engine, cls.saved_path = engine, engine.DB_PATH
+        engine.DB_PATH = os.path.abspath("mvp.db")
+        engine.init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.DB_PATH = cls.saved_path
+
+    def lesson(self, wa_id, board, grade, topic):
+        conn = self.engine.db(); cur = conn.cursor()
+        cur.execute("INSERT INTO lessons (wa_id, board, grade, subject_label, level, title, created_at, topic) VALUES (?,?,?,?,?,?,?,?)",
+                    (wa_id, board, grade, "Mathematics", 1, topic, int(time.time()), topic))
+        conn.commit(); conn.close()
+
+    def test_mastery_in_another_grade_does_not_count(self):
+        wa_id = "whatsapp:+919800000001"
+        self.engine.mark_topic_mastered(wa_id, "CBSE", 6, "Mathematics", "Integers")
+        self.lesson(wa_id, "CBSE", "6", "Integers")
+        self.assertEqual(self.engine.next_topic(wa_id, "CBSE", "7", "Mathematics"), "Integers")
+        self.engine.mark_topic_mastered(wa_id, "CBSE", 7, "Mathematics", "Integers")
+        self.assertEqual(self.engine.next_topic(wa_id, "CBSE", "7", "Mathematics"), "Fractions and Decimals")
+
+    def test_lessons_on_another_board_do_not_count(self):
+        wa_id = "whatsapp:+919800000002"
+        self.lesson(wa_id, "ICSE", "7", "Integers")
+        self.assertEqual(self.engine.next_topic(wa_id, "CBSE", "7", "Mathematics"), "Integers")
+        self.lesson(wa_id, "cbse", "7", "Integers")   # the profile's board as typed
+        self.assertEqual(self.engine.next_topic(wa_id, "CBSE", "7", "Mathematics"), "Fractions and Decimals")
+
+if __name__ == "__main__":
+    unittest.main()
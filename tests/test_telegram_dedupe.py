@@ -0,0 +1,86 @@
+# test_telegram_dedupe.py
+# Double taps on the Telegram lesson buttons, through the per_user-wrapped handlers
+# with the stand-ins in benchmarks/fakes.py, against a throwaway mvp.db:
+#   python -m pytest tests   (or python -m unittest discover tests)
+import asyncio
+import os
+import runpy
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+class DoubleStartTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.chdir(tempfile.mkdtemp(prefix="btrlrn_test_"))   # logs/ and migrate_users_seen's mvp.db
+        os.makedirs("logs", exist_ok=True)
+        for k, v in {"SYLLABUS_DB": os.path.join(ROOT, "syllabus.db"), "GEOCODE_REMOTE": "0",
+                     "BROADCAST_ENABLED": "0", "METRICS_PORT": "0", "LOG_LEVEL": "WARNING"}.items():
+            os.environ.setdefault(k, v)
+        from fakes import FakeGemini
+        import app as engine
+        engine.DB_PATH = os.path.abspath(engine.DB_PATH)   # the engine's jobs outlive the chdir
+        cls.gemini = FakeGemini(latency=0.3, jitter=0)
+        engine.create_app(gemini=cls.gemini, twilio=object())
+        with redirect_stdout(None):   # users.first_seen/last_seen, which the Telegram adapter writes
+            runpy.run_path(os.path.join(ROOT, "migrate_users_seen.py"))
+        import telegram_adapter as ta
+        cls.engine, cls.ta = engine, ta
+
+    def run_updates(self, chat, *steps):
+        from telegram import Bot
+        from fakes import FakeBotRequest, TelegramUpdates
+        ta = self.ta
+
+        async def go():
+            bot = Bot("123456:TEST", request=FakeBotRequest(0), get_updates_request=FakeBotRequest(0))
+            await bot.initialize()
+            updates, ctx = TelegramUpdates(bot), SimpleNamespace(bot=bot)
+            text, button = ta.per_user(ta.text_handler), ta.per_user(ta.on_button)
+            calls = [button(updates.button(chat, data[4:]), ctx) if data.startswith("btn:")
+                     else text(updates.message(chat, data), ctx) for data in steps]
+            await asyncio.gather(*calls)
+        asyncio.run(go())
+
+    def student(self, chat):
+        wa_id = f"telegram:{chat}"
+        self.engine.upsert_user(wa_id, first_name="Asha", last_name="K", dob="2012-04-25", city="Pune",
+                                state="Maharashtra", board="CBSE", grade="7", subject="Mathematics", level=1)
+        self.engine.set_session(wa_id, "idle")
+        return wa_id
+
+    def lessons(self, wa_id):
+        conn = self.engine.db(); cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM lessons WHERE wa_id=?", (wa_id,))
+        n = cur.fetchone()[0]
+        conn.close()
+        return n
+
+    def test_double_start_makes_one_lesson(self):
+        wa_id = self.student(7001)
+        calls = self.gemini.calls
+        self.run_updates(7001, "START", "START")
+        self.assertEqual(self.lessons(wa_id), 1)
+        self.assertEqual(self.gemini.calls - calls, 1)
+        self.assertEqual(self.engine.get_session(wa_id)["stage"], "lesson")
+
+    def test_start_and_continue_make_one_lesson(self):
+        wa_id = self.student(7002)
+        self.run_updates(7002, "btn:CONTINUE_LEARNING", "START", "btn:START")
+        self.assertEqual(self.lessons(wa_id), 1)
+        self.assertNotIn(wa_id, self.engine.generating._keys)
+
+    def test_start_again_later_makes_a_new_lesson(self):
+        wa_id = self.student(7003)
+        self.run_updates(7003, "START")
+        self.run_updates(7003, "btn:START")
+        self.assertEqual(self.lessons(wa_id), 2)
+
+if __name__ == "__main__":
+    unittest.main()
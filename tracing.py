@@ -0,0 +1,208 @@
+# tracing.py
+# Lightweight spans for following one inbound message through the webhook, the
+# background lesson job, Gemini, the DB and the outbound send.
+#   with tracing.span("whatsapp", command="start"): ...   - root when nothing is active
+#   threading.Thread(target=tracing.wrap(fn))             - carry the span into a thread
+#   tracing.ref() / span(..., parent=ref)                 - carry it through a queue row
+#   tracing.add("db_s", dt)                               - accumulate on the active span
+# The active span lives in a contextvar, so asyncio tasks inherit it on their own.
+# A root that loses the sampling draw leaves NOT_SAMPLED there instead, so the spans
+# under it (threads and queue rows included) are skipped rather than starting traces.
+# Finished spans go to an in-memory ring buffer (TRACE_BUFFER spans) and, when
+# TRACE_FILE is set, to a JSON-lines file written by a background thread.
+# summarize() turns the spans of many traces into end-to-end percentiles with the
+# time split by span kind (db / model / translate / send / other):
+#   python tracing.py logs/traces.jsonl [root-name]
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+ENABLED = os.environ.get("TRACING", "1") == "1"
+SAMPLE = float(os.environ.get("TRACE_SAMPLE", "1"))
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+
+NOT_SAMPLED = "-"   # in the contextvar and as ref(): inside a trace that is not recorded
+_current = contextvars.ContextVar("trace_span", default=None)
+_buffer = deque(maxlen=int(os.environ.get("TRACE_BUFFER", "5000")))
+_pending = []
+_pending_lock = threading.Lock()
+_writer = None
+
+class Span:
+    __slots__ = ("trace", "id", "parent", "name", "kind", "attrs", "start", "t0")
+
+    def __init__(self, trace, parent, name, kind, attrs):
+        self.trace, self.parent, self.name, self.kind, self.attrs = trace, parent, name, kind, attrs
+        self.id = f"{random.getrandbits(32):08x}"
+        self.start, self.t0 = time.time(), time.perf_counter()
+
+class span:
+    # context manager; a no-op when tracing is off or the trace was not sampled
+    __slots__ = ("name", "kind", "attrs", "parent", "s", "token")
+
+    def __init__(self, name, kind=None, parent=None, **attrs):
+        self.name, self.kind, self.parent, self.attrs = name, kind, parent, attrs
+        self.s = self.token = None
+
+    def __enter__(self):
+        if not ENABLED:
+            return None
+        cur = _current.get()
+        if self.parent == NOT_SAMPLED or (not self.parent and cur is NOT_SAMPLED):
+            self.token = _current.set(NOT_SAMPLED)
+            return None
+        if self.parent:    # "trace:span" from ref(), e.g. stored on an outbox row
+            trace, _, parent = self.parent.partition(":")
+        elif cur is not None:
+            trace, parent = cur.trace, cur.id
+        elif random.random() < SAMPLE:
+            trace, parent = f"{random.getrandbits(64):016x}", None
+        else:
+            self.token = _current.set(NOT_SAMPLED)
+            return None
+        self.s = Span(trace, parent, self.name, self.kind, self.attrs)
+        self.token = _current.set(self.s)
+        return self.s
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.token is not None:
+            _current.reset(self.token)
+        if self.s is None:
+            return False
+        s = self.s
+        rec = {"trace": s.trace, "span": s.id, "parent": s.parent, "name": s.name, "kind": s.kind,
+               "start": round(s.start, 6), "dur": round(time.perf_counter() - s.t0, 6), "attrs": s.attrs}
+        if exc is not None:
+            rec["error"] = f"{exc_type.__name__}: {exc}"[:200]
+        _export(rec)
+        return False
+
+def traced(name, kind=None):
+    # decorator form of span()
+    def deco(fn):
+        def wrapper(*args, **kwargs):
+            with span(name, kind):
+                return fn(*args, **kwargs)
+        wrapper.__name__, wrapper.__doc__, wrapper.__wrapped__ = fn.__name__, fn.__doc__, fn
+        return wrapper
+    return deco
+
+def wrap(fn):
+    # run fn in a copy of the caller's context (the active span included)
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+def ref():
+    s = _current.get()
+    return s if s is None or s is NOT_SAMPLED else f"{s.trace}:{s.id}"
+
+def add(key, value):
+    s = _current.get()
+    if s is not None and s is not NOT_SAMPLED:
+        s.attrs[key] = s.attrs.get(key, 0) + value
+
+def set_attr(key, value):
+    s = _current.get()
+    if s is not None and s is not NOT_SAMPLED:
+        s.attrs[key] = value
+
+# ---------- export ----------
+def _export(rec):
+    _buffer.append(rec)
+    if TRACE_FILE:
+        with _pending_lock:
+            _pending.append(rec)
+        _start_writer()
+
+def _start_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _pending_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, name="trace-writer", daemon=True)
+            _writer.start()
+
+def flush():
+    global _pending
+    with _pending_lock:
+        recs, _pending = _pending, []
+    if recs:
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in recs))
+    return len(recs)
+
+def _write_loop():
+    while True:
+        time.sleep(1)
+        try:
+            flush()
+        except OSError:
+            pass
+
+def recent(limit=None):
+    spans = list(_buffer)
+    return spans[-limit:] if limit else spans
+
+# ---------- analysis ----------
+def _pct(xs, p):
+    return xs[min(len(xs) - 1, int(len(xs) * p / 100))] if xs else None
+
+def breakdown(spans):
+    # one trace -> (end-to-end seconds, {kind: seconds}). Each span's own time (its
+    # duration minus the part covered by its children) goes to its kind, its db_s to
+    # "db"; whatever the spans do not cover (queue waits) ends up in "other".
+    children = {}
+    for s in spans:
+        children.setdefault(s["parent"], []).append(s)
+    parts = {}
+    for s in spans:
+        end = s["start"] + s["dur"]
+        covered = sum(max(0.0, min(end, c["start"] + c["dur"]) - max(s["start"], c["start"]))
+                      for c in children.get(s["span"], ()))
+        db_s = min(s["attrs"].get("db_s", 0), max(0.0, s["dur"] - covered))
+        own = max(0.0, s["dur"] - covered - db_s)
+        kind = s["kind"] or "other"
+        parts[kind] = parts.get(kind, 0.0) + own
+        parts["db"] = parts.get("db", 0.0) + db_s
+    e2e = max(s["start"] + s["dur"] for s in spans) - min(s["start"] for s in spans)
+    parts["other"] = parts.get("other", 0.0) + max(0.0, e2e - sum(parts.values()))
+    return e2e, parts
+
+def summarize(spans, root=None):
+    # percentiles of end-to-end trace latency, and the split of the p99 traces
+    traces = {}
+    for s in spans:
+        traces.setdefault(s["trace"], []).append(s)
+    rows = []
+    for tid, ss in traces.items():
+        roots = [s for s in ss if s["parent"] is None]
+        if not roots or (root and roots[0]["name"] != root):
+            continue
+        e2e, parts = breakdown(ss)
+        rows.append((e2e, parts, roots[0]["name"], tid))
+    if not rows:
+        return {"traces": 0}
+    rows.sort(key=lambda r: r[0])
+    lat = [r[0] for r in rows]
+    tail = rows[int(len(rows) * 0.99):] or rows[-1:]
+    kinds = sorted({k for r in rows for k in r[1]})
+    def avg(rs):
+        return {k: round(sum(r[1].get(k, 0.0) for r in rs) / len(rs), 4) for k in kinds}
+    return {"traces": len(rows), "p50_s": round(_pct(lat, 50), 4), "p90_s": round(_pct(lat, 90), 4),
+            "p99_s": round(_pct(lat, 99), 4), "mean_split_s": avg(rows), "p99_split_s": avg(tail),
+            "slowest": tail[-1][3]}
+
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python tracing.py TRACE_FILE [root-span-name]")
+    print(json.dumps(summarize(load(sys.argv[1]), sys.argv[2] if len(sys.argv) > 2 else None), indent=2))
@@ -0,0 +1,96 @@
+# userlocks.py
+# Per-student serialization and duplicate suppression for inbound updates (double
+# taps, webhook retries). Lock entries exist only while someone holds or waits for
+# them, and the de-dup memory is a bounded time window, so memory stays small
+# however many students there are.
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+class KeyedLocks:
+    # one threading.Lock per key, for the Flask worker threads
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}   # key -> [lock, holders + waiters]
+
+    @contextmanager
+    def hold(self, key, timeout=30.0):
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(timeout=timeout)
+        try:
+            if not acquired:
+                raise TimeoutError(f"lock busy for {key}")
+            yield
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+class AsyncKeyedLocks:
+    # one asyncio.Lock per key, for the Telegram event loop
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+class Deduper:
+    # seen(key) is True if the same key was seen within `window` seconds
+
+    def __init__(self, window=2.0, max_keys=20000):
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()   # key -> ts, oldest first
+
+    def seen(self, key, now=None):
+        now = now or time.monotonic()
+        with self._lock:
+            while self._seen and (next(iter(self._seen.values())) < now - self.window or len(self._seen) >= self.max_keys):
+                self._seen.popitem(last=False)
+            if key in self._seen:
+                return True
+            self._seen[key] = now
+            return False
+
+class InFlight:
+    # begin(key) is False while the same key is still being handled
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = set()
+
+    def begin(self, key):
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            return True
+
+    def end(self, key):
+        with self._lock:
+            self._keys.discard(key)